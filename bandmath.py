@@ -0,0 +1,201 @@
+import ast
+import hashlib
+import multiprocessing
+import os
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy
+import rasterio
+import instrument
+from processing import band_file, band_path
+from utils import bounded_imap, scene_directory
+
+
+# Named indices; Sentinel NBR uses the 20m narrow NIR band 8A like the usual definition
+PRESETS = {
+    "landsat": {"NDVI": "(B5-B4)/(B5+B4)",
+                "NDWI": "(B3-B5)/(B3+B5)",
+                "NBR": "(B5-B7)/(B5+B7)"},
+    "sentinel": {"NDVI": "(B08-B04)/(B08+B04)",
+                 "NDWI": "(B03-B08)/(B03+B08)",
+                 "NBR": "(B8A-B12)/(B8A+B12)"},
+}
+FUNCTIONS = {'sqrt': numpy.sqrt, 'abs': numpy.abs, 'log': numpy.log, 'exp': numpy.exp,
+             'min': numpy.minimum, 'max': numpy.maximum}
+OPERATORS = {ast.Add: numpy.add, ast.Sub: numpy.subtract, ast.Mult: numpy.multiply,
+             ast.Div: numpy.true_divide, ast.Pow: numpy.power}
+BAND_NAME = re.compile(r"^B(\d{1,2}|8A)$")
+# Scaled integer outputs: value * INT_SCALE stored as int16, INT_NODATA outside the data
+INT_SCALE = 10000
+INT_NODATA = -32768
+# Rough working set per pixel of a block: float32 inputs, temporaries and the result
+BLOCK_BYTES_PER_BAND_PIXEL = 16
+DEFAULT_BLOCK_BUDGET = 16 * 1024 * 1024
+BLOCK_ROW_STEP = 6
+# Blocks per worker that may wait to be written
+PENDING_BLOCKS_PER_WORKER = 2
+
+
+def _compile(node):
+    """ Turns an expression tree into a function of a dict of float32 band windows """
+    if isinstance(node, ast.Expression):
+        return _compile(node.body)
+    if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+        left, right, operator = _compile(node.left), _compile(node.right), OPERATORS[type(node.op)]
+        return lambda bands: operator(left(bands), right(bands))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        operand = _compile(node.operand)
+        if isinstance(node.op, ast.USub):
+            return lambda bands: numpy.negative(operand(bands))
+        return operand
+    if isinstance(node, ast.Num):
+        value = numpy.float32(node.n)  # keeps the whole evaluation in float32
+        return lambda bands: value
+    if isinstance(node, ast.Name) and BAND_NAME.match(node.id):
+        name = node.id
+        return lambda bands: bands[name]
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS
+            and not node.keywords):
+        function, arguments = FUNCTIONS[node.func.id], [_compile(argument) for argument in node.args]
+        return lambda bands: function(*[argument(bands) for argument in arguments])
+    raise ValueError("Unsupported band math expression: " + ast.dump(node))
+
+
+def parse_expression(expression):
+    """ Compiles a band math expression such as (B5-B4)/(B5+B4).
+    :returns:
+        (Tuple) the vectorized function and the sorted band names it uses
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError:
+        raise ValueError("Invalid band math expression: " + expression)
+    bands = sorted(set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name)
+                       and BAND_NAME.match(node.id)))
+    return _compile(tree), bands
+
+
+def expression_bands(expression, satellite):
+    """ Band numbers ("5", "08", "8A") an expression or preset needs, e.g. for downloading """
+    expression = PRESETS[satellite].get(expression.upper(), expression)
+    return [name[1:] for name in parse_expression(expression)[1]]
+
+
+class BandMath(object):
+    'Evaluates a band math expression block by block into a single-band GeoTIFF'
+
+    stage = "bandmath"
+
+    def __init__(self, scene, expression, satellite, dtype="float32", workers=None, memory_budget=None,
+                 scene_path=None):
+        self.scene = scene
+        self.satellite = satellite
+        self.name = expression.upper() if expression.upper() in PRESETS[satellite] else None
+        self.expression = PRESETS[satellite].get(expression.upper(), expression)
+        self.function, self.band_names = parse_expression(self.expression)
+        if not self.band_names:
+            raise ValueError("Band math expression uses no bands: " + expression)
+        if dtype not in ("float32", "int16"):
+            raise ValueError("Band math output must be float32 or int16, not " + str(dtype))
+        self.dtype = dtype
+        self.workers = workers or multiprocessing.cpu_count()
+        self.memory_budget = memory_budget or DEFAULT_BLOCK_BUDGET  # bytes per block
+
+        self.scene_path = scene_path or scene_directory(satellite, scene)
+        self.output_dir = self.scene_path + "processed/"
+        if not os.path.exists(self.output_dir):
+            os.mkdir(self.output_dir)
+        self.bands_path = [band_path(self.scene_path, band_file(scene, name[1:], satellite))
+                           for name in self.band_names]
+        label = self.name or "index_" + hashlib.sha1(self.expression.replace(" ", "")).hexdigest()[:8]
+        self.output_file = self.output_dir + self.scene + "_" + label + ".TIF"
+        self._local = threading.local()
+        self._opened = []
+        self._opened_lock = threading.Lock()
+
+    def input_files(self):
+        return list(self.bands_path)
+
+    def cache_params(self):
+        return {'expression': self.expression.replace(" ", ""), 'dtype': self.dtype}
+
+    def _sources(self):
+        """ Band datasets of the calling thread; rasterio handles are not shared between threads """
+        if getattr(self._local, "sources", None) is None:
+            self._local.sources = [rasterio.open(path) for path in self.bands_path]
+            with self._opened_lock:
+                self._opened.extend(self._local.sources)
+        return self._local.sources
+
+    def _blocks(self, shape):
+        rows = int(self.memory_budget // (shape[1] * BLOCK_BYTES_PER_BAND_PIXEL * (len(self.bands_path) + 2)))
+        # Whole multiples of 6 rows keep blocks aligned with the pixels of 20m and 60m bands
+        rows = max(BLOCK_ROW_STEP, rows - rows % BLOCK_ROW_STEP)
+        for row in range(0, shape[0], rows):
+            yield ((row, min(row + rows, shape[0])), (0, shape[1]))
+
+    def _evaluate(self, window):
+        """ Reads one block of every band on the output grid and evaluates the expression on it """
+        (row_start, row_stop), (col_start, col_stop) = window
+        shape = (row_stop - row_start, col_stop - col_start)
+        bands = {}
+        nodata = numpy.zeros(shape, dtype=bool)
+        for name, src in zip(self.band_names, self._sources()):
+            # Coarser bands (e.g. 20m next to 10m) are read upsampled onto the output grid
+            scale = src.width / float(self.width)
+            src_window = ((int(row_start * scale), int(numpy.ceil(row_stop * scale))),
+                          (int(col_start * scale), int(numpy.ceil(col_stop * scale))))
+            data = src.read(1, window=src_window, out=numpy.empty(shape, dtype=src.dtypes[0]))
+            nodata |= data == 0
+            bands[name] = data.astype(numpy.float32)
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            result = numpy.asarray(self.function(bands), dtype=numpy.float32)
+        nodata |= ~numpy.isfinite(result)
+        if self.dtype == "int16":
+            scaled = numpy.clip(numpy.round(result * INT_SCALE), -32767, 32767).astype(numpy.int16)
+            scaled[nodata] = INT_NODATA
+            return window, scaled
+        result[nodata] = numpy.nan
+        return window, result
+
+    @instrument.timed
+    def run(self):
+        """ Evaluates the expression over the whole scene, spreading blocks over a thread pool.
+        GDAL reads and NumPy arithmetic release the GIL, so blocks are computed in parallel.
+        :returns:
+            (String) the path to the index image
+        """
+        print "Calculating " + (self.name or self.expression) + " for scene " + self.scene
+
+        # The finest band sets the output grid
+        meta = None
+        for path in self.bands_path:
+            with rasterio.open(path) as src:
+                if meta is None or src.width > self.width:
+                    meta, self.width, shape = src.meta.copy(), src.width, src.shape
+        meta.update({'driver': 'GTiff', 'count': 1, 'dtype': self.dtype,
+                     'nodata': numpy.nan if self.dtype == "float32" else INT_NODATA,
+                     'tiled': True, 'blockxsize': 256, 'blockysize': 256,
+                     'compress': 'deflate', 'predictor': 3 if self.dtype == "float32" else 2})
+
+        pool = ThreadPool(self.workers)
+        try:
+            with rasterio.open(self.output_file, 'w', **meta) as dst:
+                # Blocks come back in order and are written from this thread only
+                for window, block in bounded_imap(pool, self._evaluate, self._blocks(shape),
+                                                  self.workers * PENDING_BLOCKS_PER_WORKER):
+                    dst.write(block, 1, window=window)
+                if self.dtype == "int16":
+                    dst.update_tags(scale_factor=str(1.0 / INT_SCALE))
+                dst.update_tags(expression=self.expression)
+        finally:
+            pool.close()
+            pool.join()
+            for src in self._opened:
+                src.close()
+            del self._opened[:]
+            self._local = threading.local()
+        print "This file is saved to " + self.output_file
+        return self.output_file
@@ -0,0 +1,390 @@
+"""Benchmarks for the opensat processing stages.
+
+    $ python benchmark.py warp --size 4000 --cores 1,2,4,8
+    $ python benchmark.py startup
+    $ python benchmark.py suite --sizes 1000,4000,full --output results.json
+
+Synthetic scenes are written to a temporary opensat home directory, so the
+benchmarks never touch ~/openasat. The suite times every stage of the
+Landsat and Sentinel pipelines and a download from a local HTTP server, and
+saves the results as JSON so runs on different commits can be compared.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import numpy
+import rasterio
+from affine import Affine
+
+
+LANDSAT_SCENE = "LC80130322016100LGN00"
+LANDSAT_CRS = {'init': 'epsg:32618'}
+LANDSAT_ORIGIN = (300000.0, 4500000.0)
+SENTINEL_SCENE = "S2A_tile_20160823_18TWL_0"
+SENTINEL_CRS = {'init': 'epsg:32618'}
+SENTINEL_ORIGIN = (499980.0, 4500000.0)
+SENTINEL_RESOLUTIONS = {"01": 60, "02": 10, "03": 10, "04": 10, "05": 20, "06": 20, "07": 20,
+                        "08": 10, "8A": 20, "09": 60, "10": 60, "11": 20, "12": 20}
+# Width and height in pixels of a whole scene at 30m (Landsat) and 10m (Sentinel)
+FULL_SIZES = {"landsat": 7700, "sentinel": 10980}
+# Rows generated and written at a time, so full-size scenes fit in memory
+STRIP_ROWS = 512
+# Cold-start budget for "opensat.py --help" and "import opensat", in seconds
+STARTUP_TARGET = 0.3
+
+
+def use_temporary_home():
+    home = tempfile.mkdtemp(prefix="opensat-bench-")
+    os.environ["HOME"] = home
+    os.environ.pop("OPENSAT_HOME", None)
+    return home
+
+
+def _write_band(path, size, resolution, origin, crs, low, high, seed):
+    """ Writes a uint16 band strip by strip: blocky fields of land cover between low and high,
+    per-pixel noise and a nodata collar on the left like a real scene edge """
+    rng = numpy.random.RandomState(seed)
+    field_pixels = 64
+    fields = rng.uniform(0.0, 1.0, (size // field_pixels + 1, size // field_pixels + 1))
+    columns = numpy.arange(size) // field_pixels
+    with rasterio.open(path, 'w', driver='GTiff', width=size, height=size, count=1, dtype=numpy.uint16,
+                       crs=crs, transform=Affine(resolution, 0.0, origin[0], 0.0, -resolution, origin[1])) as dst:
+        for row in range(0, size, STRIP_ROWS):
+            rows = min(STRIP_ROWS, size - row)
+            field = fields[(numpy.arange(row, row + rows) // field_pixels)][:, columns]
+            data = low + field * (high - low) * 0.8 + rng.gamma(2.0, (high - low) * 0.05, (rows, size))
+            data = data.clip(1, 65534).astype(numpy.uint16)
+            data[:, :size // 10] = 0
+            dst.write(data, 1, window=((row, row + rows), (0, size)))
+
+
+def write_landsat_scene(home, size, bands="432", seed=0):
+    """ Writes uint16 Landsat 8 bands (DN 5000-30000 in UTM 18N; the pan band 8 at 15m and twice the size)
+    and an MTL file in the layout Processing expects """
+    scene_path = home + "/openasat/landsat/" + LANDSAT_SCENE + "/"
+    if not os.path.exists(scene_path + "processed"):
+        os.makedirs(scene_path + "processed")
+
+    for i, band in enumerate(bands):
+        scale = 2 if band == "8" else 1
+        _write_band(scene_path + LANDSAT_SCENE + "_B" + band + ".TIF", size * scale, 30.0 / scale,
+                    LANDSAT_ORIGIN, LANDSAT_CRS, 5000, 30000, seed + i)
+
+    with open(scene_path + LANDSAT_SCENE + "_MTL.txt", 'w') as f:
+        f.write("GROUP = L1_METADATA_FILE\n    CLOUD_COVER = 12.34\nEND\n")
+    return scene_path
+
+
+def write_sentinel_scene(home, size, bands=("02", "03", "04"), seed=0):
+    """ Writes lossless JPEG2000 Sentinel-2 bands (reflectance 0-10000 in UTM 18N; size is for the 10m bands)
+    and a tileInfo.json in the layout Processing expects """
+    try:
+        from rasterio.shutil import copy as copy_dataset
+    except ImportError:
+        from rasterio import copy as copy_dataset
+
+    scene_path = home + "/openasat/sentinel/" + SENTINEL_SCENE + "/"
+    if not os.path.exists(scene_path + "processed"):
+        os.makedirs(scene_path + "processed")
+
+    for i, band in enumerate(bands):
+        scale = SENTINEL_RESOLUTIONS[band] // 10
+        # The JPEG2000 driver can only copy whole datasets, so each band is written as GeoTIFF first
+        temp_path = scene_path + "B" + band + ".tmp.tif"
+        _write_band(temp_path, size // scale, 10.0 * scale, SENTINEL_ORIGIN, SENTINEL_CRS, 300, 10000, seed + i)
+        copy_dataset(temp_path, scene_path + "B" + band + ".jp2", driver='JP2OpenJPEG', REVERSIBLE='YES',
+                     QUALITY='100')
+        os.remove(temp_path)
+
+    with open(scene_path + "tileInfo.json", 'w') as f:
+        json.dump({'cloudyPixelPercentage': 12.34}, f)
+    return scene_path
+
+
+def write_mask(home, satellite, size):
+    """ Writes a shapefile covering the middle quarter of a synthetic scene """
+    import fiona
+
+    origin, crs, resolution = {'landsat': (LANDSAT_ORIGIN, LANDSAT_CRS, 30.0),
+                               'sentinel': (SENTINEL_ORIGIN, SENTINEL_CRS, 10.0)}[satellite]
+    extent = size * resolution
+    left, top = origin[0] + extent / 4, origin[1] - extent / 4
+    right, bottom = origin[0] + extent * 3 / 4, origin[1] - extent * 3 / 4
+    path = home + "/mask_" + satellite + ".shp"
+    schema = {'geometry': 'Polygon', 'properties': {'id': 'int'}}
+    with fiona.open(path, 'w', driver='ESRI Shapefile', crs=crs, schema=schema) as dst:
+        dst.write({'geometry': {'type': 'Polygon',
+                                'coordinates': [[(left, top), (right, top), (right, bottom), (left, bottom), (left, top)]]},
+                   'properties': {'id': 1}})
+    return path
+
+
+def _timed(function):
+    start = time.time()
+    result = function()
+    return time.time() - start, result
+
+
+def bench_warp(size, cores, strips):
+    """ Times Processing._warp for several worker counts and checks the output is bit-identical """
+    from processing import Processing
+
+    home = use_temporary_home()
+    write_landsat_scene(home, size)
+
+    def warp(workers, threads, warp_strips):
+        process = Processing(LANDSAT_SCENE, "432", "landsat", warp_workers=workers, warp_threads=threads,
+                             warp_strips=warp_strips)
+        image_data = process._get_image_data()
+        new_bands = process._generate_new_bands(image_data['shape'])
+        seconds, _ = _timed(lambda: process._warp(image_data, process.bands_path, new_bands))
+        return seconds, new_bands
+
+    baseline, expected = warp(1, 2, 1)  # previous behaviour: one band after another, 2 GDAL threads
+    print "%-8s %-8s %-8s %10s %8s %10s" % ("cores", "strips", "threads", "seconds", "speedup", "identical")
+    print "%-8s %-8s %-8s %10.3f %8.2f %10s" % ("serial", 1, 2, baseline, 1.0, True)
+    for core_count in cores:
+        workers = min(core_count, 3 * strips)
+        threads = max(1, core_count // workers)
+        seconds, new_bands = warp(workers, threads, strips)
+        identical = all(numpy.array_equal(a, b) for a, b in zip(expected, new_bands))
+        print "%-8s %-8s %-8s %10.3f %8.2f %10s" % (core_count, strips, threads, seconds, baseline / seconds, identical)
+
+
+def bench_startup(runs=5):
+    """ Times fresh interpreters running the CLI help and importing the library """
+    here = os.path.dirname(os.path.abspath(__file__))
+    commands = [("opensat.py --help", [sys.executable, os.path.join(here, "opensat.py"), "--help"]),
+                ("import opensat", [sys.executable, "-c", "import opensat"])]
+    devnull = open(os.devnull, 'w')
+    print "%-20s %10s %10s %8s" % ("command", "median", "target", "ok")
+    for name, command in commands:
+        times = []
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(command, cwd=here, stdout=devnull)
+            times.append(time.time() - start)
+        median = sorted(times)[len(times) // 2]
+        print "%-20s %10.3f %10.3f %8s" % (name, median, STARTUP_TARGET, median <= STARTUP_TARGET)
+    devnull.close()
+
+
+# name, satellite, processing bands, processing options, masked
+PIPELINES = [
+    ("landsat stack", "landsat", "432", {}, False),
+    ("landsat pansharpen", "landsat", "4328", {}, False),
+    ("landsat windowed", "landsat", "432", {'memory_budget': 256 * 1024 * 1024}, False),
+    ("landsat cog", "landsat", "432", {'output_format': 'cog', 'compress': 'deflate'}, False),
+    ("landsat stack + mask", "landsat", "432", {}, True),
+    ("sentinel stack", "sentinel", "432", {}, False),
+    ("sentinel stack + mask", "sentinel", "432", {}, True),
+]
+
+
+def _scene_size(satellite, size):
+    return FULL_SIZES[satellite] if size == "full" else int(size)
+
+
+def _print_result(result):
+    stages = ", ".join("%s %.2f" % (stage, total['seconds']) for stage, total in sorted(result['stages'].items()))
+    print "%-24s %8s %10.3f %10.1f   %s" % (result['benchmark'], result['size'], result['seconds'],
+                                           result['peak_rss_mb'], stages)
+
+
+def bench_pipelines(sizes):
+    """ Times every end-to-end pipeline and its stages on synthetic scenes of each size """
+    import instrument
+    from ingest import ingest
+    from pipeline import process_scene
+
+    home = use_temporary_home()
+    results = []
+    for size in sizes:
+        scene_sizes = dict((satellite, _scene_size(satellite, size)) for satellite in FULL_SIZES)
+        print "Writing synthetic scenes: Landsat " + str(scene_sizes['landsat']) + \
+            "px, Sentinel " + str(scene_sizes['sentinel']) + "px"
+        scene_paths = {'landsat': write_landsat_scene(home, scene_sizes['landsat'], "2348"),
+                       'sentinel': write_sentinel_scene(home, scene_sizes['sentinel'])}
+        scenes = {'landsat': LANDSAT_SCENE, 'sentinel': SENTINEL_SCENE}
+        masks = dict((satellite, write_mask(home, satellite, scene_sizes[satellite])) for satellite in FULL_SIZES)
+
+        if not results:  # warm up imports and GDAL before the first timing
+            process_scene(LANDSAT_SCENE, "432", "landsat")
+
+        for name, satellite, bands, options, masked in PIPELINES:
+            # Start from an empty output directory, or the processing cache would skip the run
+            shutil.rmtree(scene_paths[satellite] + "processed")
+            os.mkdir(scene_paths[satellite] + "processed")
+            instrument.reset()
+            seconds, _ = _timed(lambda: process_scene(scenes[satellite], bands, satellite,
+                                                      masks[satellite] if masked else None, **options))
+            stage_records = instrument.records()
+            results.append({'benchmark': name,
+                            'satellite': satellite,
+                            'size': scene_sizes[satellite],
+                            'seconds': round(seconds, 3),
+                            'peak_rss_mb': max(record['peak_rss_mb'] for record in stage_records),
+                            'stages': instrument.totals(stage_records)})
+
+        # Transcoding the JP2 bands once, then the Sentinel stack again on the GeoTIFF copies
+        jp2_bands = [scene_paths['sentinel'] + name for name in sorted(os.listdir(scene_paths['sentinel']))
+                     if name.endswith(".jp2")]
+        for name, run in (("sentinel ingest", lambda: ingest(jp2_bands)),
+                          ("sentinel stack ingested", lambda: process_scene(SENTINEL_SCENE, "432", "sentinel"))):
+            shutil.rmtree(scene_paths['sentinel'] + "processed")
+            os.mkdir(scene_paths['sentinel'] + "processed")
+            instrument.reset()
+            seconds, _ = _timed(run)
+            stage_records = instrument.records()
+            results.append({'benchmark': name,
+                            'satellite': 'sentinel',
+                            'size': scene_sizes['sentinel'],
+                            'seconds': round(seconds, 3),
+                            'peak_rss_mb': max(record['peak_rss_mb'] for record in stage_records),
+                            'stages': instrument.totals(stage_records)})
+    shutil.rmtree(home)
+    return results
+
+
+class _FileHandler(SimpleHTTPRequestHandler):
+    'Serves the directory of its server'
+
+    def translate_path(self, path):
+        return os.path.join(self.server.directory, path.split("?")[0].lstrip("/"))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _FileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def bench_download(sizes, workers=4):
+    """ Times download() of a synthetic Landsat scene served over HTTP on localhost """
+    import instrument
+    import opensat
+
+    results = []
+    for size in sizes:
+        home = use_temporary_home()
+        scene_size = _scene_size("landsat", size)
+        served = write_landsat_scene(home + "/served", scene_size, "2348")
+        server = _FileServer(("127.0.0.1", 0), _FileHandler)
+        server.directory = served
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            pic = opensat.Landsat(LANDSAT_SCENE, None)
+            pic.band_url = "http://127.0.0.1:%d/%s" % (server.server_address[1], LANDSAT_SCENE)
+            instrument.reset()
+            seconds, paths = _timed(lambda: opensat.download(pic, "2,3,4,8", workers))
+        finally:
+            server.shutdown()
+        record = [record for record in instrument.records() if record['stage'] == "download"][0]
+        results.append({'benchmark': "download " + str(workers) + " workers",
+                        'satellite': "landsat",
+                        'size': scene_size,
+                        'seconds': round(seconds, 3),
+                        'peak_rss_mb': record['peak_rss_mb'],
+                        'bytes': record['bytes'],
+                        'bytes_per_second': record['bytes_per_second'],
+                        'failed': paths.count(None),
+                        'stages': instrument.totals([record])})
+        shutil.rmtree(home)
+    return results
+
+
+def _commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, results):
+    from cache import PROCESSING_VERSION
+
+    data = {'commit': _commit(),
+            'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'host': platform.node(),
+            'cpus': multiprocessing.cpu_count(),
+            'python': platform.python_version(),
+            'gdal': rasterio.__gdal_version__ if hasattr(rasterio, '__gdal_version__') else None,
+            'version': PROCESSING_VERSION,
+            'results': results}
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    print "Results are saved to " + path
+
+
+def compare(old_path, new_path):
+    """ Prints the speedup of every benchmark between two saved result files """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    before = dict(((result['benchmark'], result['size']), result) for result in old['results'])
+    print "%-24s %8s %10s %10s %8s %12s" % ("benchmark", "size", str(old['commit']), str(new['commit']),
+                                            "speedup", "peak MB")
+    for result in new['results']:
+        previous = before.get((result['benchmark'], result['size']))
+        if previous is None:
+            continue
+        print "%-24s %8s %10.3f %10.3f %8.2f %5.0f->%-5.0f" % (
+            result['benchmark'], result['size'], previous['seconds'], result['seconds'],
+            previous['seconds'] / result['seconds'] if result['seconds'] else 0,
+            previous['peak_rss_mb'], result['peak_rss_mb'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("stage", choices=["warp", "startup", "pipelines", "download", "suite", "compare"],
+                        help="stage to benchmark; suite runs pipelines and download")
+    parser.add_argument("files", nargs="*", help="old and new result files to compare")
+    parser.add_argument("--size", type=int, default=4000, help="synthetic band width and height in pixels")
+    parser.add_argument("--sizes", default="1000,4000", help="scene sizes in pixels of the 30m/10m bands, or full")
+    parser.add_argument("--cores", default="1,2,4,8", help="core counts to try")
+    parser.add_argument("--strips", type=int, default=4, help="row strips per band")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent downloads")
+    parser.add_argument("--output", help="JSON results file (default: benchmark-<commit>.json)")
+    args = parser.parse_args()
+
+    cores = [int(core) for core in args.cores.split(",")]
+    sizes = [size if size == "full" else int(size) for size in args.sizes.split(",")]
+    if args.stage == "warp":
+        bench_warp(args.size, cores, args.strips)
+    elif args.stage == "startup":
+        bench_startup()
+    elif args.stage == "compare":
+        if len(args.files) != 2:
+            parser.error("compare needs an old and a new result file")
+        compare(*args.files)
+    else:
+        results = []
+        if args.stage in ("pipelines", "suite"):
+            results.extend(bench_pipelines(sizes))
+        if args.stage in ("download", "suite"):
+            results.extend(bench_download(sizes, args.workers))
+        print "\n%-24s %8s %10s %10s   %s" % ("benchmark", "size", "seconds", "peak MB", "stages")
+        for result in results:
+            _print_result(result)
+        save_results(args.output or "benchmark-" + (_commit() or time.strftime("%Y%m%d-%H%M%S")) + ".json", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+import instrument
+from utils import bcolors
+
+
+# Bump when a change to the processing code alters the pixels it writes, so older outputs are rebuilt.
+# 2: destination grids are cached and snapped onto earlier scenes of a footprint, saturated pixels keep their stretch
+PROCESSING_VERSION = 2
+MANIFEST_NAME = "opensat_info.json"
+# ingest.CACHE_SUFFIX, kept here so the cache and the store do not import rasterio
+INGEST_SUFFIX = ".ingest.tif"
+
+
+def fingerprint(path):
+    """ Size and modification time of a file, None when it does not exist """
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': int(stat.st_mtime * 1000)}
+
+
+def band_name(name):
+    """ A downloaded band and its GeoTIFF copy share a name: B04.jp2 and B04.ingest.tif are both B04 """
+    if name.endswith(INGEST_SUFFIX):
+        return name[:-len(INGEST_SUFFIX)]
+    return os.path.splitext(name)[0]
+
+
+def cache_key(stage, inputs, params):
+    """ Hash of everything an output depends on: stage, input files, parameters and code version """
+    description = {'stage': stage,
+                   'inputs': sorted([os.path.basename(path), fingerprint(path)] for path in inputs),
+                   'params': params,
+                   'version': PROCESSING_VERSION}
+    return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+
+class Manifest(object):
+    'Records how every output of a directory was made, in opensat_info.json next to the outputs'
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def fresh(self, output_file, key):
+        """ True when output_file exists untouched and was made with the same key """
+        entry = self.entries.get(os.path.basename(output_file))
+        return (entry is not None and entry['key'] == key and
+                entry['output'] == fingerprint(output_file))
+
+    def fresh_after_eviction(self, output_file, stage, inputs, params):
+        """ True when output_file exists untouched and was made with the same stage, parameters and
+        code from the same inputs, of which only bands the scene store evicted since are gone """
+        entry = self.entries.get(os.path.basename(output_file))
+        if (entry is None or not entry.get('evicted') or entry['stage'] != stage or
+                entry['version'] != PROCESSING_VERSION or entry['output'] != fingerprint(output_file) or
+                entry['params'] != json.loads(json.dumps(params))):
+            return False
+        recorded = dict((band_name(name), (name, value)) for name, value in entry['inputs'].items())
+        if set(band_name(os.path.basename(path)) for path in inputs) != set(recorded):
+            return False
+        for path in inputs:
+            name, value = recorded[band_name(os.path.basename(path))]
+            current = fingerprint(path)
+            if current is None:
+                if band_name(name) not in entry['evicted']:
+                    return False
+            elif os.path.basename(path) != name or current != value:
+                return False
+        return True
+
+    def record(self, output_file, key, stage, inputs, params, seconds=None):
+        """ Adds the entry of output_file """
+        entry = {
+            'key': key,
+            'stage': stage,
+            'inputs': dict((os.path.basename(path), fingerprint(path)) for path in inputs),
+            'params': params,
+            'version': PROCESSING_VERSION,
+            'output': fingerprint(output_file),
+            'seconds': seconds,
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S")
+        }
+        with self._locked():
+            self.entries[os.path.basename(output_file)] = entry
+            self._save()
+
+    def evicted(self, names):
+        """ Notes that the scene store deleted these input files, so outputs made from them
+        stay up to date without them """
+        bands = set(band_name(name) for name in names)
+        with self._locked():
+            for entry in self.entries.values():
+                used = bands.intersection(band_name(name) for name in entry['inputs'])
+                if used:
+                    entry['evicted'] = sorted(used.union(entry.get('evicted', [])))
+            self._save()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """ Other processes may be updating the manifest of the same directory, so it is re-read
+        and rewritten under an exclusive lock """
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.entries = self._load()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _save(self):
+        # A temporary name of our own, so two writers never share a half-written file
+        fd, part_path = tempfile.mkstemp(prefix=MANIFEST_NAME + ".", suffix=".part", dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.chmod(part_path, 0644)
+            os.rename(part_path, self.path)
+        except BaseException:
+            os.remove(part_path)
+            raise
+
+
+def cached(stage, output_file, inputs, params, build):
+    """ Runs build() unless output_file was already made from the same inputs and parameters.
+    :returns:
+        (String) the path to the up-to-date output
+    """
+    key = cache_key(stage, inputs, params)
+    manifest = Manifest(os.path.dirname(output_file))
+    if manifest.fresh(output_file, key) or manifest.fresh_after_eviction(output_file, stage, inputs, params):
+        print bcolors.OKGREEN + os.path.basename(output_file) + " is up to date, skipping " + stage + bcolors.ENDC
+        instrument.skipped(stage, output_file=output_file)
+        return output_file
+    if os.path.isfile(output_file):
+        print bcolors.WARNING + os.path.basename(output_file) + " is stale, running " + stage + " again" + bcolors.ENDC
+
+    start = time.time()
+    output_file = build()
+    manifest.record(output_file, key, stage, inputs, params, round(time.time() - start, 3))
+    return output_file
+
+
+def shapefile_parts(path):
+    """ The files that make up a shapefile (.shp, .shx, .dbf, .prj, ...) """
+    base = os.path.splitext(path)[0]
+    directory = os.path.dirname(base) or "."
+    name = os.path.basename(base)
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                  if os.path.splitext(f)[0] == name)
@@ -0,0 +1,171 @@
+import json
+import os
+import sqlite3
+import time
+import requests
+from multiprocessing.pool import ThreadPool
+from utils import bcolors, data_root
+
+
+API_URL = "https://api.developmentseed.org/satellites"
+API_LIMIT = 500  # results per page
+DEFAULT_TTL = 24 * 3600  # seconds before a location is synced again
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    scene_id TEXT PRIMARY KEY,
+    satellite TEXT NOT NULL,
+    location TEXT NOT NULL,
+    date TEXT NOT NULL,
+    cloud_coverage REAL,
+    thumbnail TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_by_date ON scenes (satellite, location, date);
+CREATE INDEX IF NOT EXISTS scenes_by_clouds ON scenes (satellite, location, cloud_coverage);
+CREATE TABLE IF NOT EXISTS syncs (
+    satellite TEXT NOT NULL,
+    location TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    latest_date TEXT,
+    PRIMARY KEY (satellite, location)
+);
+"""
+
+
+class Catalog(object):
+    'Local SQLite index of the scenes returned by the developmentseed API'
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, api_url=API_URL):
+        if path is None:
+            directory = data_root()
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            path = directory + "catalog.db"
+        self.path = path
+        self.ttl = ttl
+        self.api_url = api_url
+        self.session = requests.Session()
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def _last_sync(self, satellite, location):
+        return self.db.execute("SELECT synced_at, latest_date FROM syncs WHERE satellite = ? AND location = ?",
+                               (satellite, location)).fetchone()
+
+    def _request(self, query):
+        """ Requests every page of results for a search query.
+        Paging stops at the total the API reports in meta.found, or at the first short page when it reports none.
+        """
+        results = []
+        seen = set()
+        page = 1
+        while True:
+            url = self.api_url + "?search=" + query + "&limit=" + str(API_LIMIT) + "&page=" + str(page)
+            r = self.session.get(url, timeout=60)
+            if r.status_code != 200:
+                raise requests.exceptions.HTTPError(str(r.status_code) + " ERROR. Please check later.")
+            data = r.json()
+            page_results = data.get("results", [])
+            if page_results and page_results[0]["scene_id"] in seen:
+                raise ValueError("The API returned page " + str(page) + " again, it does not seem to page results")
+            seen.update(scene["scene_id"] for scene in page_results)
+            results.extend(page_results)
+            found = data.get("meta", {}).get("found")
+            if len(page_results) < API_LIMIT or (found is not None and len(results) >= found):
+                return results
+            page += 1
+
+    def _query(self, satellite, pic, refresh):
+        """ Search query still needed for a location, or None while its last sync is fresh """
+        last_sync = self._last_sync(satellite, pic.location)
+        if last_sync is None or refresh:
+            return pic.api_query
+        if time.time() - last_sync["synced_at"] < self.ttl:
+            return None
+        if last_sync["latest_date"]:
+            return pic.api_query + "+AND+date:[" + last_sync["latest_date"] + "+TO+" + time.strftime("%Y-%m-%d") + "]"
+        return pic.api_query
+
+    def sync(self, locations, refresh=False, workers=8):
+        """ Brings the scenes of many (satellite, location) pairs up to date.
+        Nothing is requested for a location while its last sync is younger than the ttl,
+        and only scenes from the latest known date onwards are requested afterwards.
+        The API is queried concurrently; the results are stored from this thread.
+        :returns:
+            (Integer) number of scenes received from the API
+        """
+        jobs = []
+        for satellite, pic in locations:
+            query = self._query(satellite, pic, refresh)
+            if query is not None:
+                jobs.append((satellite, pic.location, query))
+        if not jobs:
+            return 0
+
+        def fetch(job):
+            try:
+                return self._request(job[2]), None
+            except (requests.exceptions.RequestException, ValueError) as e:
+                return None, e
+
+        pool = ThreadPool(min(workers, len(jobs)))
+        try:
+            responses = pool.map(fetch, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        received = 0
+        for (satellite, location, query), (results, error) in zip(jobs, responses):
+            if error is None:
+                self.store(satellite, location, results)
+                received += len(results)
+            elif self._last_sync(satellite, location) is None:
+                print bcolors.FAIL + location + ": " + str(error) + bcolors.ENDC
+            else:
+                print bcolors.WARNING + "Could not reach the API for " + location + " (" + str(error) + "), using the local catalog" + bcolors.ENDC
+        return received
+
+    def store(self, satellite, location, results):
+        """ Inserts or refreshes API results and records the sync """
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(scene["scene_id"], satellite, location, scene["date"], scene["cloud_coverage"],
+                                  scene.get("thumbnail"), json.dumps(scene)) for scene in results])
+            latest = self.db.execute("SELECT MAX(date) FROM scenes WHERE satellite = ? AND location = ?",
+                                     (satellite, location)).fetchone()[0]
+            self.db.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?)",
+                            (satellite, location, time.time(), latest))
+
+    def scenes(self, locations, clouds=None, date_start=None, date_end=None):
+        """ Indexed query of the stored scenes of many (satellite, location) pairs; dates are exclusive ISO strings.
+        :returns:
+            (List) rows with scene_id, satellite, date, cloud_coverage and thumbnail, oldest first
+        """
+        sql = "SELECT scene_id, satellite, date, cloud_coverage, thumbnail FROM scenes WHERE satellite = ? AND location = ?"
+        params = []
+        if clouds is not None:
+            sql += " AND cloud_coverage <= ?"
+            params.append(float(clouds))
+        if date_start is not None:
+            sql += " AND date > ?"
+            params.append(date_start)
+        if date_end is not None:
+            sql += " AND date < ?"
+            params.append(date_end)
+
+        rows = {}
+        for satellite, pic in locations:
+            for row in self.db.execute(sql, [satellite, pic.location] + params):
+                rows[row["scene_id"]] = row
+        return sorted(rows.values(), key=lambda row: (row["date"], row["scene_id"]))
+
+    def cloud_coverage(self, scene_id):
+        """ Stored cloud coverage of a scene, None when it is not in the catalog """
+        row = self.db.execute("SELECT cloud_coverage FROM scenes WHERE scene_id = ?", (scene_id,)).fetchone()
+        return row["cloud_coverage"] if row is not None else None
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,148 @@
+import os
+import struct
+
+
+FORMATS = ("gtiff", "cog")
+COMPRESSIONS = ("deflate", "lzw", "zstd")
+
+# TIFF tags needed to check the layout
+IMAGE_WIDTH = 256
+TILE_WIDTH = 322
+TILE_OFFSETS = 324
+FIELD_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+
+
+def creation_options(output_format="gtiff", compress=None, blocksize=512):
+    """ GTiff creation options for a processed image """
+    options = {}
+    if compress:
+        options['compress'] = compress
+        options['predictor'] = 2
+    if output_format == "cog":
+        options.update({'tiled': True, 'blockxsize': blocksize, 'blockysize': blocksize})
+    return options
+
+
+def overview_factors(shape, blocksize=512):
+    """ Overview levels down to the first one that fits into a single tile """
+    factors = []
+    factor = 2
+    while max(shape) / float(factor / 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def finalize(path, output_format="gtiff", compress=None, blocksize=512):
+    """ Turns a freshly written tiled GeoTIFF into a Cloud-Optimized GeoTIFF.
+    Overviews are built in place and the file is then rewritten so that all IFDs
+    come first and the image data is ordered from the smallest overview to full resolution.
+    """
+    if output_format != "cog":
+        return path
+
+    import rasterio
+    from rasterio.warp import RESAMPLING
+    try:
+        from rasterio.shutil import copy as copy_dataset
+    except ImportError:  # rasterio < 1.0
+        from rasterio import copy as copy_dataset
+
+    print "Building overviews for " + os.path.basename(path)
+    with rasterio.open(path, 'r+') as dst:
+        factors = overview_factors(dst.shape, blocksize)
+        if factors:
+            dst.build_overviews(factors, RESAMPLING.average)
+            dst.update_tags(ns='rio_overview', resampling='average')
+
+    temp_path = path + ".cog"
+    options = creation_options(output_format, compress, blocksize)
+    options['copy_src_overviews'] = True
+    copy_dataset(path, temp_path, driver='GTiff', **options)
+    os.rename(temp_path, path)
+
+    errors = validate(path)
+    for error in errors:
+        print "COG check failed for " + os.path.basename(path) + ": " + error
+    return path
+
+
+def _read_ifds(f):
+    """ Yields (ifd offset, tags) for every IFD of a classic or Big TIFF.
+    Only the first value of each tag is decoded, which is all the layout check needs.
+    """
+    header = f.read(16)
+    endian = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if endian is None:
+        raise ValueError("not a TIFF file")
+    version = struct.unpack(endian + 'H', header[2:4])[0]
+    if version == 42:
+        offset_format, count_format, entry_size, inline_size = 'I', 'H', 12, 4
+        offset = struct.unpack(endian + 'I', header[4:8])[0]
+    elif version == 43:
+        offset_format, count_format, entry_size, inline_size = 'Q', 'Q', 20, 8
+        offset = struct.unpack(endian + 'Q', header[8:16])[0]
+    else:
+        raise ValueError("not a TIFF file")
+
+    count_size = struct.calcsize(count_format)
+    offset_size = struct.calcsize(offset_format)
+    while offset:
+        f.seek(offset)
+        entries = struct.unpack(endian + count_format, f.read(count_size))[0]
+        data = f.read(entries * entry_size + offset_size)
+        tags = {}
+        for i in range(entries):
+            entry = data[i * entry_size:(i + 1) * entry_size]
+            tag, field_type = struct.unpack(endian + 'HH', entry[:4])
+            count = struct.unpack(endian + count_format.replace('H', 'I'), entry[4:4 + inline_size])[0]
+            value = entry[4 + inline_size:]
+            size = FIELD_SIZES.get(field_type, 1)
+            if size * count > inline_size:
+                here = f.tell()
+                f.seek(struct.unpack(endian + offset_format, value)[0])
+                value = f.read(size)
+                f.seek(here)
+            value_format = {1: 'B', 2: 'B', 3: 'H', 4: 'I', 16: 'Q'}.get(field_type)
+            if value_format:
+                tags[tag] = struct.unpack(endian + value_format, value[:struct.calcsize(value_format)])[0]
+        yield offset, tags
+        offset = struct.unpack(endian + offset_format, data[-offset_size:])[0]
+
+
+def validate(path):
+    """ Checks the Cloud-Optimized GeoTIFF layout of a file.
+    :returns:
+        (List) descriptions of every problem found, empty for a valid COG
+    """
+    import rasterio
+
+    with rasterio.open(path) as src:
+        shape = src.shape
+        overviews = src.overviews(1)
+
+    with open(path, 'rb') as f:
+        try:
+            ifds = list(_read_ifds(f))
+        except (ValueError, struct.error) as e:
+            return [str(e)]
+
+    errors = []
+    if any(TILE_WIDTH not in tags for _, tags in ifds):
+        errors.append("image is not tiled")
+        return errors
+    if max(shape) > 512 and not overviews:
+        errors.append("image has no internal overviews")
+    if ifds[0][1].get(IMAGE_WIDTH) != shape[1]:
+        errors.append("the full resolution image is not the first IFD")
+
+    widths = [tags.get(IMAGE_WIDTH) for _, tags in ifds]
+    if widths != sorted(widths, reverse=True):
+        errors.append("overviews are not sorted from largest to smallest")
+
+    data_starts = [tags.get(TILE_OFFSETS) for _, tags in ifds]
+    if max(offset for offset, _ in ifds) > min(data_starts):
+        errors.append("IFDs are not all located before the image data")
+    if data_starts != sorted(data_starts, reverse=True):
+        errors.append("image data is not ordered from the smallest overview to full resolution")
+    return errors
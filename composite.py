@@ -0,0 +1,173 @@
+import multiprocessing
+import os
+import numpy
+import rasterio
+import cog
+import instrument
+import quality
+from mosaic import BLOCK_SIZE, block_grid, blocks, cloud_cover, intersects, read_block, union_grid
+from utils import bcolors, bounded_imap
+
+
+METHODS = ("median", "percentile", "best")
+
+# Datasets opened once by every worker process
+_inputs = {}
+
+
+def quality_file(path):
+    """ Quality band saved next to a processed image with --quality-band """
+    return os.path.splitext(path)[0] + "_quality.TIF"
+
+
+def _open_inputs(input_files, quality_files):
+    _inputs['sources'] = [rasterio.open(path) for path in input_files]
+    _inputs['quality'] = [rasterio.open(path) if path else None for path in quality_files]
+
+
+def _close_inputs():
+    for src in _inputs.get('sources', []) + [q for q in _inputs.get('quality', []) if q is not None]:
+        src.close()
+    _inputs.clear()
+
+
+def nanpercentile(values, percentile):
+    """ Percentile over the first axis ignoring NaN, with linear interpolation like numpy.nanpercentile.
+    Sorting the whole stack at once is much faster than numpy's pixel by pixel NaN reductions.
+    """
+    ordered = numpy.sort(values, axis=0)  # NaN sorts last
+    count = (~numpy.isnan(values)).sum(axis=0)
+    last = (count - 1).clip(min=0)
+    position = last * (percentile / 100.0)
+    lower = numpy.floor(position).astype(numpy.intp)
+    upper = numpy.minimum(lower + 1, last)
+    low = numpy.take_along_axis(ordered, lower[numpy.newaxis], axis=0)[0]
+    high = numpy.take_along_axis(ordered, upper[numpy.newaxis], axis=0)[0]
+    weight = position - lower
+    result = low * (1 - weight) + high * weight  # numpy's weighting, so halves round the same way
+    result[count == 0] = numpy.nan
+    return result
+
+
+def _composite_block(job):
+    """ Reads one block of every scene and reduces it across the time axis """
+    window, transform, method, percentile, nodata, bits = job
+    (row_start, row_stop), (col_start, col_stop) = window
+    shape = (row_stop - row_start, col_stop - col_start)
+    block_transform, block_bounds = block_grid(transform, window)
+
+    stack, flagged = [], []
+    for src, quality_src in zip(_inputs['sources'], _inputs['quality']):
+        if not intersects(block_bounds, tuple(src.bounds)):
+            continue
+        stack.append(read_block(src, block_transform, shape, nodata))
+        if method == "best":
+            if quality_src is not None:
+                classes = read_block(quality_src, block_transform, shape, 0)[0]
+                flagged.append((classes & bits) != 0)
+            else:
+                flagged.append(numpy.zeros(shape, dtype=bool))
+
+    dtype = _inputs['sources'][0].dtypes[0]
+    count = _inputs['sources'][0].count
+    if not stack:
+        return window, numpy.full((count,) + shape, nodata, dtype=dtype)
+    stack = numpy.stack(stack)  # time, band, row, column
+    valid = (stack != nodata).any(axis=1)
+
+    if method == "best":
+        # Scenes are ordered from the least cloudy; a clear pixel beats a flagged one of a less cloudy scene
+        times = numpy.arange(len(stack)).reshape(-1, 1, 1)
+        rank = numpy.where(valid, times + numpy.stack(flagged) * len(stack), 2 * len(stack))
+        choice = rank.argmin(axis=0)
+        block = numpy.take_along_axis(stack, choice[numpy.newaxis, numpy.newaxis], axis=0)[0]
+        block[:, ~valid.any(axis=0)] = nodata
+        return window, block
+
+    values = stack.astype(numpy.float32)
+    values[~numpy.broadcast_to(valid[:, numpy.newaxis], values.shape)] = numpy.nan
+    reduced = nanpercentile(values, 50 if method == "median" else percentile)
+    empty = numpy.isnan(reduced)
+    block = numpy.round(numpy.nan_to_num(reduced)).astype(dtype)
+    block[empty] = nodata
+    return window, block
+
+
+class Composite(object):
+    'Reduces a time series of processed scenes of one footprint into a single cloud-free image'
+
+    stage = "composite"
+
+    def __init__(self, input_files, output_file, method="median", percentile=50, workers=None,
+                 output_format="gtiff", compress=None, flags=quality.DEFAULT_FLAGS, catalog=None):
+        if method not in METHODS:
+            raise ValueError("Unknown composite method " + str(method) + "; use one of " + ", ".join(METHODS))
+        if not 0 <= percentile <= 100:
+            raise ValueError("The composite percentile must be between 0 and 100")
+        if not input_files:
+            raise ValueError("A composite needs at least one input image")
+        self.input_files = list(input_files)
+        self.output_file = output_file
+        self.method = method
+        self.percentile = percentile
+        self.workers = workers or multiprocessing.cpu_count()
+        self.output_format = output_format
+        self.compress = compress
+        self.bits = quality.parse_flags(flags)
+        self.catalog = catalog
+
+    def _ordered_inputs(self):
+        """ Best-quality composites look at the least cloudy scenes first """
+        if self.method != "best":
+            return list(self.input_files)
+        clouds = dict((path, cloud_cover(path, self.catalog)) for path in self.input_files)
+        return sorted(self.input_files, key=lambda path: clouds[path])
+
+    @instrument.timed
+    def run(self):
+        """ Streams the same block of every scene through a process pool, so memory grows with
+        the block size times the number of scenes and not with the scene size.
+        :returns:
+            (String) the path to the composite
+        """
+        input_files = self._ordered_inputs()
+        quality_files = [quality_file(path) if os.path.isfile(quality_file(path)) else None
+                         for path in input_files]
+        label = self.method if self.method != "percentile" else "percentile " + str(self.percentile)
+        print "Compositing " + str(len(input_files)) + " scenes (" + label + ") into " + self.output_file
+
+        _open_inputs(input_files, quality_files)
+        try:
+            sources = _inputs['sources']
+            first = sources[0]
+            mismatched = [src.name for src in sources if src.crs != first.crs or src.count != first.count]
+            if mismatched:
+                raise ValueError("Composite inputs need the same projection and band count: " + ", ".join(mismatched))
+            transform, width, height = union_grid(sources)
+            nodata = first.nodata if first.nodata is not None else 0
+            options = {'driver': 'GTiff', 'width': width, 'height': height, 'count': first.count,
+                       'dtype': first.dtypes[0], 'nodata': nodata, 'transform': transform, 'crs': first.crs,
+                       'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE}
+            if first.count == 3:
+                options['photometric'] = 'RGB'
+            options.update(cog.creation_options(self.output_format, self.compress, BLOCK_SIZE))
+        finally:
+            _close_inputs()
+
+        jobs = ((window, transform, self.method, self.percentile, nodata, self.bits)
+                for window in blocks(width, height))
+        # Every worker opens the scenes once; handles are not shared between processes
+        pool = multiprocessing.Pool(self.workers, _open_inputs, (input_files, quality_files))
+        try:
+            with rasterio.open(self.output_file, 'w', **options) as dst:
+                for window, block in bounded_imap(pool, _composite_block, jobs, 2 * self.workers):
+                    dst.write(block, window=window)
+                dst.update_tags(COMPOSITE=label, SCENES=str(len(input_files)))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        cog.finalize(self.output_file, self.output_format, self.compress)
+        print bcolors.OKGREEN + "The composite is saved to " + self.output_file + bcolors.ENDC
+        return self.output_file
@@ -0,0 +1,292 @@
+import hashlib
+import os
+import threading
+import time
+import Queue
+import requests
+from multiprocessing.pool import ThreadPool
+from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
+from tqdm import tqdm
+from utils import bcolors
+
+
+CHUNK_SIZE = 1024 * 1024
+# Failures worth another attempt, including a connection that drops in the middle of the body
+NETWORK_ERRORS = (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                  requests.exceptions.ChunkedEncodingError, ProtocolError, ReadTimeoutError)
+
+
+def pooled_session(connections):
+    """ requests Session keeping up to connections keep-alive connections per host """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class Downloader(object):
+    'Downloads scene files concurrently over one pooled HTTP session'
+
+    def __init__(self, workers=4, retries=10, backoff=1, timeout=240, checksum=None, expected=None, session=None):
+        self.workers = max(1, int(workers))
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.checksum = checksum  # hashlib algorithm name, e.g. "md5" or "sha256"
+        self.expected = expected or {}  # file name -> expected hex digest
+        self.checksums = {}
+        self.bytes_downloaded = 0  # over every run, for the throughput of a download
+        self._bytes_lock = threading.Lock()
+
+        # One keep-alive connection per worker, shared by every file of every scene
+        self.session = session or pooled_session(self.workers)
+
+    def _fetch(self, job):
+        """ Downloads one file, retrying with exponential backoff on network errors """
+        url, directory = job
+        local_filename = url.split('/')[-1]
+        local_path = directory + "/" + local_filename
+
+        if os.path.isfile(local_path):
+            tqdm.write(local_filename + " is already downloaded")
+            return local_path
+
+        position = self._slots.get()  # free progress bar line
+        try:
+            return self._fetch_with_retries(url, local_path, position)
+        finally:
+            self._slots.put(position)
+
+    def _fetch_with_retries(self, url, local_path, position):
+        """ Streams url into a .part file, resuming with a Range request after a failure,
+        and renames it into place once the size (and optional checksum) is verified """
+        local_filename = url.split('/')[-1]
+        part_path = local_path + ".part"
+        digest = None
+        hashed = 0  # bytes of the .part file already fed into digest
+
+        for attempt in range(self.retries):
+            offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            if self.checksum and (digest is None or hashed != offset):
+                digest, hashed = self._hash_part(part_path)
+                offset = hashed
+
+            try:
+                request_headers = {'Range': 'bytes=' + str(offset) + '-'} if offset else {}
+                response = self.session.get(url, stream=True, timeout=self.timeout, headers=request_headers)
+                headers = response.headers
+
+                if response.status_code == 416:
+                    # Nothing left to fetch: either the .part is already complete or it is stale
+                    size = int(headers.get("content-range", "*/-1").split("/")[-1])
+                    if size != offset:
+                        self._discard(part_path)
+                        digest = None
+                        continue
+                elif response.status_code not in (200, 206) or "content-length" not in headers:
+                    tqdm.write(bcolors.FAIL + "Ooops... SERVER ERROR. Looks like " + local_filename + " doesn't exist" + bcolors.ENDC)
+                    return None
+                else:
+                    if response.status_code == 200 and offset:
+                        # Server ignored the Range header, start over
+                        offset = 0
+                        digest = hashlib.new(self.checksum) if self.checksum else None
+                        hashed = 0
+                    size = offset + int(headers['content-length'])
+
+                    with open(part_path, 'ab' if offset else 'wb') as f:
+                        with tqdm(total=size, initial=offset, unit='B', unit_scale=True, desc=local_filename,
+                                  position=position + 1, leave=False) as bar:
+                            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                                f.write(chunk)
+                                self._count(len(chunk))
+                                if digest is not None:
+                                    digest.update(chunk)
+                                    hashed += len(chunk)
+                                bar.update(len(chunk))
+            except NETWORK_ERRORS:
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+
+            if os.path.getsize(part_path) != size:
+                tqdm.write(bcolors.WARNING + local_filename + " is incomplete, resuming" + bcolors.ENDC)
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+
+            if digest is not None and not self._verify(local_filename, digest.hexdigest(), headers):
+                tqdm.write(bcolors.WARNING + local_filename + " failed the " + self.checksum + " check, downloading again" + bcolors.ENDC)
+                self._discard(part_path)
+                digest = None
+                continue
+
+            os.rename(part_path, local_path)
+            tqdm.write(bcolors.OKGREEN + "Success! " + local_filename + " is downloaded!" + bcolors.ENDC)
+            return local_path
+
+        tqdm.write(bcolors.FAIL + "Giving up on " + local_filename + " after " + str(self.retries) + " attempts" + bcolors.ENDC)
+        return None
+
+    def _count(self, size):
+        with self._bytes_lock:
+            self.bytes_downloaded += size
+
+    def _hash_part(self, part_path):
+        """ Feeds an existing .part file into a fresh digest so a resumed download can be verified """
+        digest = hashlib.new(self.checksum)
+        hashed = 0
+        if os.path.isfile(part_path):
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    hashed += len(chunk)
+        return digest, hashed
+
+    def _verify(self, local_filename, hexdigest, headers):
+        """ Compares the digest with the expected one, or with an md5 ETag when nothing was given """
+        self.checksums[local_filename] = hexdigest
+        expected = self.expected.get(local_filename)
+        if expected is None and self.checksum == "md5":
+            etag = headers.get("etag", "").strip('"')
+            if len(etag) == 32 and "-" not in etag:  # multipart ETags are not plain md5
+                expected = etag
+        return expected is None or expected.lower() == hexdigest
+
+    def _discard(self, part_path):
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+
+    def run(self, urls, directory):
+        """ Downloads all urls into directory using a bounded worker pool.
+        :returns:
+            (List) local paths of the files that were downloaded, None for failures
+        """
+        jobs = [(url, directory) for url in urls]
+        workers = min(self.workers, max(1, len(jobs)))
+        self._slots = Queue.Queue()
+        for position in range(workers):
+            self._slots.put(position)
+
+        pool = ThreadPool(workers)
+        paths = []
+        try:
+            with tqdm(total=len(jobs), unit='file', desc='Total', position=0) as total:
+                for path in pool.imap(self._fetch, jobs):
+                    paths.append(path)
+                    total.update(1)
+        finally:
+            pool.close()
+            pool.join()
+        print "Files are saved to " + directory + "\n"
+        return paths
+
+
+# Pixels kept around the AOI so reprojection has data at the window edges
+AOI_PAD = 8
+
+
+def clear_vsicurl_cache(url):
+    """ Makes GDAL forget what it learned about a remote file, including that it could not be read.
+    Without this a retry gets the cached failure back instead of asking the server again.
+    rasterio does not wrap the call, so it goes through ctypes to the GDAL that rasterio is linked with.
+    """
+    import ctypes
+    import rasterio._base
+
+    gdal = ctypes.CDLL(rasterio._base.__file__)
+    if hasattr(gdal, "VSICurlPartialClearCache"):  # GDAL 2.4
+        gdal.VSICurlPartialClearCache(ctypes.c_char_p("/vsicurl/" + url))
+    else:
+        gdal.VSICurlClearCache()
+
+
+class AOIFetcher(object):
+    'Reads only the part of every band that covers a mask, using HTTP range requests'
+
+    def __init__(self, mask, workers=4, downloader=None):
+        self.mask = mask
+        self.workers = max(1, int(workers))
+        self.downloader = downloader or Downloader(workers=workers)
+        # Open remote files without listing the bucket, and read them through GDAL's range reader
+        os.environ.setdefault("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+        os.environ.setdefault("CPL_VSIL_CURL_ALLOWED_EXTENSIONS", ".TIF,.tif,.jp2")
+
+    def _read_window(self, url):
+        """ Reads the part of a remote band covered by the mask through GDAL's range reader.
+        :returns:
+            (Tuple) the pixels and the GeoTIFF profile of the window, None when the mask misses the band
+        """
+        import rasterio
+        from mask import load_geometries, geometry_window
+
+        with rasterio.open("/vsicurl/" + url) as src:
+            window = geometry_window(src, load_geometries(self.mask, src.crs), AOI_PAD)
+            if window is None:
+                return None
+            data = src.read(1, window=window)
+            meta = src.meta.copy()
+            meta.update({"driver": "GTiff",
+                         "height": data.shape[0],
+                         "width": data.shape[1],
+                         "transform": src.window_transform(window)})
+        return data, meta
+
+    def _fetch_window(self, job):
+        """ Fetches the AOI window of one band, retrying with exponential backoff like a whole download """
+        import rasterio
+        from rasterio.errors import RasterioIOError
+
+        url, directory = job
+        local_filename = url.split('/')[-1]
+        if local_filename.endswith(".jp2"):
+            local_filename = local_filename.replace(".jp2", ".tif")
+        local_path = directory + "/" + local_filename
+        if os.path.isfile(local_path):
+            tqdm.write(local_filename + " is already downloaded")
+            return local_path
+
+        retries, backoff = self.downloader.retries, self.downloader.backoff
+        for attempt in range(retries):
+            try:
+                window = self._read_window(url)
+                break
+            except RasterioIOError:
+                # GDAL reports HTTP errors and dropped connections of /vsicurl/ as I/O errors
+                time.sleep(backoff * 2 ** attempt)
+                clear_vsicurl_cache(url)
+        else:
+            tqdm.write(bcolors.FAIL + "Giving up on " + local_filename + " after " + str(retries) + " attempts" + bcolors.ENDC)
+            return None
+        if window is None:
+            tqdm.write(bcolors.FAIL + "The mask does not overlap " + local_filename + bcolors.ENDC)
+            return None
+        data, meta = window
+        self.downloader._count(data.nbytes)
+
+        with rasterio.open(local_path + ".part", "w", **meta) as dst:
+            dst.write(data, 1)
+        os.rename(local_path + ".part", local_path)
+        tqdm.write(bcolors.OKGREEN + "Success! The AOI part of " + local_filename + " is downloaded!" + bcolors.ENDC)
+        return local_path
+
+    def run(self, urls, directory):
+        """ Fetches the AOI windows of the raster urls; metadata files are downloaded whole.
+        :returns:
+            (List) local paths in the order of urls, None for failures
+        """
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+        rasters = [url for url in urls if url.endswith((".TIF", ".jp2"))]
+        others = [url for url in urls if url not in rasters]
+
+        paths = dict(zip(others, self.downloader.run(others, directory)))
+        pool = ThreadPool(min(self.workers, max(1, len(rasters))))
+        try:
+            with tqdm(total=len(rasters), unit='file', desc='AOI', position=0) as total:
+                for url, path in zip(rasters, pool.imap(self._fetch_window, [(url, directory) for url in rasters])):
+                    paths[url] = path
+                    total.update(1)
+        finally:
+            pool.close()
+            pool.join()
+        return [paths[url] for url in urls]
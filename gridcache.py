@@ -0,0 +1,88 @@
+import json
+import os
+import sqlite3
+from utils import crs_key, data_root
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS grids (
+    key TEXT PRIMARY KEY,
+    src_crs TEXT NOT NULL,
+    dst_crs TEXT NOT NULL,
+    src_pixel REAL NOT NULL,
+    src_bounds TEXT NOT NULL,
+    dst_transform TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS grids_by_footprint ON grids (src_crs, dst_crs, src_pixel);
+"""
+# Scenes whose source extents overlap by at least this share are the same footprint
+MIN_OVERLAP = 0.5
+
+
+def _bounds(transform, shape):
+    left, top = transform[2], transform[5]
+    return (left, top + transform[4] * shape[0], left + transform[0] * shape[1], top)
+
+
+def _overlap(a, b):
+    """ Share of the smaller of two extents covered by both """
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    area = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    return width * height / area
+
+
+def snap(dst_transform, reference):
+    """ Moves a destination grid onto the pixel lattice of a reference grid and takes its pixel size,
+    so the outputs of both line up pixel for pixel """
+    left, x_pixel, _, top, _, y_pixel = reference
+    columns = round((dst_transform[0] - left) / x_pixel)
+    rows = round((dst_transform[3] - top) / y_pixel)
+    return (left + columns * x_pixel, x_pixel, 0.0, top + rows * y_pixel, 0.0, y_pixel)
+
+
+class GridCache(object):
+    'Destination grids of reprojected scenes, kept in grids.db so repeated footprints share one aligned grid'
+
+    def __init__(self, path=None):
+        if path is None:
+            directory = data_root()
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            path = directory + "grids.db"
+        # Processing workers share the database, so wait for each other's writes
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(SCHEMA)
+
+    def grid(self, src_crs, src_transform, shape, dst_crs, compute):
+        """ Destination grid (GDAL geotransform) of a source grid.
+        A source grid seen before gets its grid back without projecting anything. A new one is computed,
+        then snapped onto the grid of an earlier scene of the same footprint when there is one.
+        :returns:
+            (Tuple) the geotransform and whether it came from the cache
+        """
+        src_key, dst_key = crs_key(src_crs), crs_key(dst_crs)
+        src_transform = tuple(float(value) for value in src_transform[:6])
+        key = json.dumps([src_key, dst_key, src_transform, list(shape)])
+        row = self.db.execute("SELECT dst_transform FROM grids WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            return tuple(json.loads(row[0])), True
+
+        dst_transform = compute()
+        bounds = _bounds(src_transform, shape)
+        for reference, reference_bounds in self.db.execute(
+                "SELECT dst_transform, src_bounds FROM grids WHERE src_crs = ? AND dst_crs = ? AND src_pixel = ?",
+                (src_key, dst_key, src_transform[0])):
+            if _overlap(bounds, json.loads(reference_bounds)) >= MIN_OVERLAP:
+                dst_transform = snap(dst_transform, json.loads(reference))
+                break
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO grids VALUES (?, ?, ?, ?, ?, ?)",
+                            (key, src_key, dst_key, src_transform[0], json.dumps(bounds),
+                             json.dumps(list(dst_transform))))
+        return dst_transform, False
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
+import rasterio
+import instrument
+from utils import bcolors
+
+
+# JPEG2000 bands are decoded this many rows at a time
+STRIP_ROWS = 1024
+CACHE_SUFFIX = ".ingest.tif"
+
+
+def cache_path(path):
+    """ GeoTIFF copy of a JP2 band, next to it """
+    return os.path.splitext(path)[0] + CACHE_SUFFIX
+
+
+def fresh(path):
+    """ True when the GeoTIFF copy of a JP2 band exists and was made from its current version """
+    cached = cache_path(path)
+    return (os.path.isfile(cached) and os.path.isfile(path) and
+            int(os.path.getmtime(cached) * 1000) == int(os.path.getmtime(path) * 1000))
+
+
+def cached_band(path):
+    """ The GeoTIFF copy of a JP2 band when it is up to date, else the band itself """
+    if path.endswith(".jp2") and fresh(path):
+        return cache_path(path)
+    return path
+
+
+def transcode(path):
+    """ Decodes a JP2 band once into a tiled, compressed GeoTIFF.
+    The copy takes the modification time of the band, so a new download makes it stale.
+    :returns:
+        (Integer) the size of the GeoTIFF
+    """
+    cached = cache_path(path)
+    with rasterio.open(path) as src:
+        meta = src.meta.copy()
+        meta.update({'driver': 'GTiff', 'tiled': True, 'blockxsize': 512, 'blockysize': 512,
+                     'compress': 'deflate', 'predictor': 2})
+        with rasterio.open(cached + ".part", 'w', **meta) as dst:
+            for row in range(0, src.height, STRIP_ROWS):
+                window = ((row, min(row + STRIP_ROWS, src.height)), (0, src.width))
+                dst.write(src.read(window=window), window=window)
+    mtime = os.path.getmtime(path)
+    os.utime(cached + ".part", (mtime, mtime))
+    os.rename(cached + ".part", cached)
+    return os.path.getsize(cached)
+
+
+def ingest(paths, workers=None):
+    """ Transcodes the JP2 bands among paths that have no up-to-date GeoTIFF copy, several at a time.
+    OpenJPEG decodes a band on one core, so bands are spread over a thread pool (GDAL releases the GIL).
+    :returns:
+        (List) the paths later stages read: the GeoTIFF copies of JP2 bands, other paths unchanged
+    """
+    stale = [path for path in paths if path and path.endswith(".jp2") and not fresh(path)]
+    if stale:
+        print "Transcoding " + str(len(stale)) + " JPEG2000 bands to GeoTIFF"
+        with instrument.stage("ingest", files=len(stale)) as record:
+            pool = ThreadPool(min(len(stale), workers or multiprocessing.cpu_count()))
+            try:
+                record['bytes'] = sum(pool.map(transcode, stale))
+            finally:
+                pool.close()
+                pool.join()
+        print bcolors.OKGREEN + "Bands are cached as GeoTIFF" + bcolors.ENDC
+    return [cached_band(path) if path else path for path in paths]
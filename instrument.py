@@ -0,0 +1,200 @@
+"""Stage timing, memory and throughput records for one opensat run.
+
+Every instrumented stage (download, stack, pansharpen, mask and their steps) adds a record with
+its wall time and peak resident memory, and downloads add their byte rate. The records of a run
+are written as a JSON report for capacity planning when asked for:
+
+    $ python opensat.py download -s LC80020252016253LGN00 -b 2,3,4 -p 432 --report run.json
+    $ python opensat.py download -s LC80020252016253LGN00 -b 2,3,4 -p 432 --profile run.prof
+
+Peak memory is counted per process (Linux VmHWM), not per thread. The count only restarts at a stage
+when no other thread is inside a stage, so stages that overlap in several threads report the peak
+of the whole process over their time: an upper bound, never less than they used.
+"""
+import contextlib
+import functools
+import json
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import threading
+import time
+
+
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+_open_stages = {}  # thread id -> number of stages open in that thread
+_started = time.time()
+# Reports written to the default directory that are kept, newest first
+KEEP_REPORTS = 50
+
+
+def _high_water_mark():
+    """ Peak resident memory of this process in MB since the last reset """
+    try:
+        with open("/proc/self/status") as f:
+            return int(re.search(r"VmHWM:\s+(\d+)", f.read()).group(1)) / 1024.0
+    except (IOError, AttributeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _reset_high_water_mark():
+    """ Linux lets a process restart its peak memory count, so each stage gets its own peak """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except IOError:
+        pass  # the peak then covers everything since the process started
+
+
+@contextlib.contextmanager
+def stage(name, **info):
+    """ Records the wall time and peak memory of a block; the yielded dict takes extra fields,
+    and a 'bytes' field adds a bytes_per_second rate """
+    frames = getattr(_local, "frames", None)
+    if frames is None:
+        frames = _local.frames = []
+    # Enclosing stages keep the peak seen so far before the count restarts for this one
+    peak = _high_water_mark()
+    for frame in frames:
+        frame['peak'] = max(frame['peak'], peak)
+    thread = threading.current_thread().ident
+    with _lock:
+        # The count is process-wide, restarting it would hide the peaks of stages open in other threads
+        alone = not any(count for other, count in _open_stages.items() if other != thread)
+        if alone:
+            _reset_high_water_mark()
+        _open_stages[thread] = _open_stages.get(thread, 0) + 1
+
+    record = dict(info, stage=name, start=round(time.time() - _started, 3), pid=os.getpid())
+    frame = {'peak': 0.0}
+    frames.append(frame)
+    start = time.time()
+    try:
+        yield record
+    finally:
+        seconds = time.time() - start
+        with _lock:
+            _open_stages[thread] -= 1
+            if not _open_stages[thread]:
+                del _open_stages[thread]
+        frames.pop()
+        frame['peak'] = max(frame['peak'], _high_water_mark())
+        for parent in frames:
+            parent['peak'] = max(parent['peak'], frame['peak'])
+        record['seconds'] = round(seconds, 3)
+        record['peak_rss_mb'] = round(frame['peak'], 1)
+        if 'bytes' in record:
+            record['bytes_per_second'] = int(record['bytes'] / seconds) if seconds > 0 else None
+        with _lock:
+            _records.append(record)
+
+
+def skipped(name, **info):
+    """ Records a stage that did not need to run, such as one whose output is up to date """
+    with stage(name, skipped=True, **info):
+        pass
+
+
+def timed(method):
+    """ Records a run method as the stage named by its object's stage attribute """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with stage(self.stage, output_file=self.output_file) as record:
+            output_file = method(self, *args, **kwargs)
+            record['output_file'] = output_file
+            return output_file
+    return wrapper
+
+
+def records():
+    with _lock:
+        return list(_records)
+
+
+def extend(more):
+    """ Adds records collected in a worker process """
+    with _lock:
+        _records.extend(more)
+
+
+def reset():
+    global _started
+    with _lock:
+        del _records[:]
+    _started = time.time()
+
+
+def totals(stage_records):
+    """ Count, seconds and bytes of every stage name """
+    result = {}
+    for record in stage_records:
+        total = result.setdefault(record['stage'], {'count': 0, 'seconds': 0.0})
+        total['count'] += 1
+        total['seconds'] = round(total['seconds'] + record['seconds'], 3)
+        if 'bytes' in record:
+            total['bytes'] = total.get('bytes', 0) + record['bytes']
+            total['bytes_per_second'] = int(total['bytes'] / total['seconds']) if total['seconds'] > 0 else None
+    return result
+
+
+def report(command=None):
+    """ Machine-readable summary of the run so far.
+    :returns:
+        (Dict) host details, total time, peak memory, every stage record and per-stage totals
+    """
+    import platform
+    from cache import PROCESSING_VERSION
+
+    stage_records = sorted(records(), key=lambda record: record['start'])
+    # Restarting the peak count also lowers ru_maxrss, so the stage peaks are part of the maximum
+    peaks = [record['peak_rss_mb'] for record in stage_records]
+    peaks.append(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+    peaks.append(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0)
+    return {'command': command if command is not None else sys.argv[1:],
+            'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(_started)),
+            'seconds': round(time.time() - _started, 3),
+            'host': platform.node(),
+            'cpus': multiprocessing.cpu_count(),
+            'python': platform.python_version(),
+            'version': PROCESSING_VERSION,
+            'peak_rss_mb': round(max(peaks), 1),
+            'stages': stage_records,
+            'totals': totals(stage_records)}
+
+
+def write_report(path, command=None):
+    data = report(command)
+    with open(path + ".part", "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(path + ".part", path)
+    return path
+
+
+def prune_reports(directory, keep=KEEP_REPORTS):
+    """ Deletes all but the newest keep reports of a directory.
+    :returns:
+        (List) paths of the deleted reports
+    """
+    reports = sorted((os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".json")),
+                     key=os.path.getmtime, reverse=True)
+    for path in reports[keep:]:
+        os.remove(path)
+    return reports[keep:]
+
+
+@contextlib.contextmanager
+def profile(path):
+    """ Runs a block under cProfile and saves the stats to path (view them with pstats or snakeviz) """
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
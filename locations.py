@@ -0,0 +1,86 @@
+import math
+import os
+import re
+
+
+LAT_BANDS = "CDEFGHJKLMNPQRSTUVWX"
+# 100km square column letters repeat every three UTM zones, row letters every two
+COLUMN_LETTERS = ("ABCDEFGH", "JKLMNPQR", "STUVWXYZ")
+ROW_LETTERS = "ABCDEFGHJKLMNPQRSTUV"
+MGRS_STEP = 0.05  # degrees between sampled points, well under one 100km square
+
+
+def is_landsat(location):
+    return "," in location
+
+
+def _mgrs_square(zone, easting, northing):
+    column = COLUMN_LETTERS[(zone - 1) % 3][int(easting // 100000) - 1]
+    row = ROW_LETTERS[(int(northing // 100000) + (5 if zone % 2 == 0 else 0)) % 20]
+    return column + row
+
+
+def _spaced(start, stop, step):
+    """ Evenly spaced values from start to stop, both included """
+    count = max(1, int(math.ceil((stop - start) / step)))
+    return [start + (stop - start) * i / float(count) for i in range(count + 1)]
+
+
+def mgrs_squares(left, bottom, right, top):
+    """ Sentinel-2 grid squares (e.g. 18TWL) touching a lon/lat bounding box """
+    from rasterio.warp import transform
+
+    points = {}
+    lons = _spaced(left, right, MGRS_STEP)
+    lats = _spaced(max(bottom, -80), min(top, 84), MGRS_STEP)
+    for lat in lats:
+        for lon in lons:
+            zone = int((lon + 180) // 6) % 60 + 1
+            band = LAT_BANDS[min(int((lat + 80) // 8), len(LAT_BANDS) - 1)]
+            points.setdefault((zone, band, lat >= 0), []).append((lon, lat))
+
+    squares = set()
+    for (zone, band, north), zone_points in points.items():
+        crs = {'init': 'epsg:' + str((32600 if north else 32700) + zone)}
+        eastings, northings = transform({'init': 'epsg:4326'}, crs, [p[0] for p in zone_points],
+                                        [p[1] for p in zone_points])
+        for easting, northing in zip(eastings, northings):
+            squares.add(str(zone).zfill(2) + band + _mgrs_square(zone, easting, northing))
+    return sorted(squares)
+
+
+def wrs2_path_rows(left, bottom, right, top, wrs2):
+    """ Landsat path,row pairs whose WRS-2 footprint (from the USGS shapefile) meets a lon/lat bounding box """
+    import fiona
+
+    path_rows = set()
+    with fiona.open(wrs2) as shapefile:
+        for _, feature in shapefile.items(bbox=(left, bottom, right, top)):
+            properties = feature["properties"]
+            path_rows.add(str(int(properties["PATH"])) + "," + str(int(properties["ROW"])))
+    return sorted(path_rows, key=lambda path_row: [int(value) for value in path_row.split(",")])
+
+
+def parse_locations(location, wrs2=None):
+    """ Expands the -l argument into a list of Landsat "path,row" and Sentinel grid square locations.
+    It accepts one location, several separated by ";" or spaces, a file with one location
+    per line, or "bbox:left,bottom,right,top" in degrees.
+    """
+    if os.path.isfile(location):
+        with open(location) as f:
+            entries = [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+    else:
+        entries = re.split(r"[;\s]+", location.strip())
+
+    found = []
+    for entry in entries:
+        if entry.startswith("bbox:"):
+            left, bottom, right, top = [float(value) for value in entry[5:].split(",")]
+            if wrs2:
+                found.extend(wrs2_path_rows(left, bottom, right, top, wrs2))
+            else:
+                print "No WRS-2 shapefile given (--wrs2), searching Sentinel squares only"
+            found.extend(mgrs_squares(left, bottom, right, top))
+        elif entry:
+            found.append(entry)
+    return [entry for i, entry in enumerate(found) if entry not in found[:i]]
@@ -1,37 +1,127 @@
+import os
+import threading
 import fiona
+import numpy
 import rasterio
-from rasterio.tools.mask import mask
+from multiprocessing.pool import ThreadPool
+from rasterio.features import geometry_mask
+from rasterio.warp import transform_geom
+import instrument
+from utils import crs_key
 
 
+# Pixels per block when masking, all bands together
+BLOCK_PIXELS = 4 * 1024 * 1024
+
+_geometries = {}  # (shapefile, mtime) -> (crs, geometries)
+_reprojected = {}  # (shapefile, mtime, crs) -> geometries
+_lock = threading.Lock()
+
+
+def load_geometries(mask, crs=None):
+    """ Returns the geometries of a shapefile, parsed only once per file version
+    and reprojected only once for every target crs.
+    """
+    key = (os.path.abspath(mask), os.path.getmtime(mask))
+    with _lock:
+        if key not in _geometries:
+            with fiona.open(mask, "r") as shapefile:
+                _geometries[key] = (shapefile.crs, [feature["geometry"] for feature in shapefile])
+        mask_crs, geoms = _geometries[key]
+        if crs is None or not mask_crs or crs_key(mask_crs) == crs_key(crs):
+            return geoms
+
+        reprojected_key = key + (crs_key(crs),)
+        if reprojected_key not in _reprojected:
+            _reprojected[reprojected_key] = [transform_geom(mask_crs, crs, geom) for geom in geoms]
+        return _reprojected[reprojected_key]
+
+
+def _points(coordinates):
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates
+    else:
+        for part in coordinates:
+            for point in _points(part):
+                yield point
+
+
+def geometry_bounds(geoms):
+    """ (left, bottom, right, top) of a list of GeoJSON-like geometries """
+    points = numpy.array([point[:2] for geom in geoms for point in _points(geom["coordinates"])])
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+
+def geometry_window(src, geoms, pad=0):
+    """ Pixel window of src covering the geometries plus pad pixels, clipped to the image.
+    Returns None when the geometries do not overlap the image.
+    """
+    left, bottom, right, top = geometry_bounds(geoms)
+    row_start, col_start = src.index(left, top)
+    row_stop, col_stop = src.index(right, bottom)
+    row_start, col_start = max(int(row_start) - pad, 0), max(int(col_start) - pad, 0)
+    row_stop, col_stop = min(int(row_stop) + 1 + pad, src.height), min(int(col_stop) + 1 + pad, src.width)
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return ((row_start, row_stop), (col_start, col_stop))
+
 
 class Mask(object):
     'Masking processed images'
 
+    stage = "mask"
+
     def __init__(self, input_file, mask):
         self.input = input_file
         self.input_name = self.input.replace(".TIF","")
         self.mask = mask
+        self.output_file = self.input_name + "_masked" + ".TIF"
 
+    @instrument.timed
     def run(self):
-
-        with fiona.open(self.mask, "r") as shapefile:
-            geoms = [feature["geometry"] for feature in shapefile]
-
+        """ Crops the image to the mask bounds and blanks every pixel outside the mask.
+        Only the window under the mask is read, one block of rows at a time.
+        :returns:
+            (String) the path to the masked image
+        """
         with rasterio.open(self.input) as src:
-            out_image, out_transform = mask(src, geoms, crop=True)
-            out_meta = src.meta.copy()
+            geoms = load_geometries(self.mask, src.crs)
+            window = geometry_window(src, geoms)
+            if window is None:
+                raise ValueError("Mask " + self.mask + " does not overlap " + self.input)
+            (row_start, row_stop), (col_start, col_stop) = window
+            width = col_stop - col_start
+            nodata = src.nodata if src.nodata is not None else 0
 
-        out_meta.update({"driver": "GTiff",
-                         "height": out_image.shape[1],
-                         "width": out_image.shape[2],
-                         "transform": out_transform})
+            out_meta = src.meta.copy()
+            out_meta.update({"driver": "GTiff",
+                             "height": row_stop - row_start,
+                             "width": width,
+                             "transform": src.window_transform(window)})
 
-        with rasterio.open(self.input_name + "_masked" + ".TIF", "w", **out_meta) as dest:
-            dest.write(out_image)
+            rows = max(1, BLOCK_PIXELS // (width * src.count))
+            with rasterio.open(self.output_file, "w", **out_meta) as dest:
+                dest.update_tags(**src.tags())
+                for row in range(row_start, row_stop, rows):
+                    block_window = ((row, min(row + rows, row_stop)), (col_start, col_stop))
+                    block = src.read(window=block_window)
+                    outside = geometry_mask(geoms, out_shape=block.shape[1:],
+                                            transform=src.window_transform(block_window))
+                    block[:, outside] = nodata
+                    dest.write(block, window=((row - row_start, block_window[0][1] - row_start), (0, width)))
 
+        return self.output_file
 
 
-#
-# test = Mask("/Users/iaryna/Desktop/rasterio-cookbook-master/recipies/data/LC81810252016195LGN00432.TIF", "/Users/iaryna/Desktop/rasterio-cookbook-master/recipies/data/kyiv_right.shp")
-#
-# test.run()
+def mask_batch(input_files, mask, workers=4):
+    """ Masks many images against one shapefile, which is parsed only once.
+    :returns:
+        (List) the paths to the masked images
+    """
+    load_geometries(mask)
+    pool = ThreadPool(max(1, min(workers, len(input_files))))
+    try:
+        return pool.map(lambda input_file: Mask(input_file, mask).run(), input_files)
+    finally:
+        pool.close()
+        pool.join()
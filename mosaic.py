@@ -0,0 +1,210 @@
+import collections
+import math
+import os
+import numpy
+import rasterio
+from affine import Affine
+from rasterio.warp import reproject, RESAMPLING
+import cog
+import instrument
+from utils import bcolors
+
+
+RULES = ("first", "last", "least-cloudy")
+# Output blocks are square and match the internal tiling of the mosaic
+BLOCK_SIZE = 512
+# Inputs kept open at once; blocks go row by row, so an input is needed for a run of neighbouring blocks
+MAX_OPEN_INPUTS = 16
+
+# What the mosaic needs to know about an input without keeping it open
+Footprint = collections.namedtuple("Footprint", "name bounds res crs count dtype nodata")
+
+
+def scene_id(path):
+    """ Scene id at the start of a processed file name """
+    name = os.path.basename(path)
+    if name.startswith("S2"):
+        return "_".join(name.split("_")[:5])
+    return name.split("_")[0]
+
+
+def cloud_cover(path, catalog=None):
+    """ Cloud coverage tagged on a processed image, or stored in the catalog for its scene """
+    with rasterio.open(path) as src:
+        tag = src.tags().get("CLOUD_COVER")
+    if tag is not None:
+        return float(tag)
+    if catalog is not None:
+        coverage = catalog.cloud_coverage(scene_id(path))
+        if coverage is not None:
+            return coverage
+    return 100.0  # unknown coverage loses against every known one
+
+
+def footprint(path):
+    """ Bounds, resolution and band layout of an image, read without keeping it open """
+    with rasterio.open(path) as src:
+        return Footprint(path, tuple(src.bounds), src.res, src.crs, src.count, src.dtypes[0], src.nodata)
+
+
+class OpenInputs(object):
+    'Dataset handles opened on first use, closing the least recently used one past a limit'
+
+    def __init__(self, limit=None):
+        self.limit = limit or MAX_OPEN_INPUTS
+        self.handles = collections.OrderedDict()
+
+    def get(self, path):
+        src = self.handles.pop(path, None)
+        if src is None:
+            src = rasterio.open(path)
+            if len(self.handles) >= self.limit:
+                self.handles.popitem(last=False)[1].close()
+        self.handles[path] = src  # most recently used last
+        return src
+
+    def close(self):
+        for src in self.handles.values():
+            src.close()
+        self.handles.clear()
+
+
+def union_grid(sources):
+    """ Union extent of open datasets (or footprints) at their finest resolution.
+    :returns:
+        (Tuple) the transform, width and height of the grid
+    """
+    left = min(src.bounds[0] for src in sources)
+    bottom = min(src.bounds[1] for src in sources)
+    right = max(src.bounds[2] for src in sources)
+    top = max(src.bounds[3] for src in sources)
+    resolution = min(min(abs(src.res[0]), abs(src.res[1])) for src in sources)
+    width = int(math.ceil(round((right - left) / resolution, 6)))
+    height = int(math.ceil(round((top - bottom) / resolution, 6)))
+    return Affine(resolution, 0.0, left, 0.0, -resolution, top), width, height
+
+
+def blocks(width, height, size=BLOCK_SIZE):
+    for row in range(0, height, size):
+        for col in range(0, width, size):
+            yield ((row, min(row + size, height)), (col, min(col + size, width)))
+
+
+def block_grid(transform, window):
+    """ Transform and bounds of one window of a grid """
+    (row_start, row_stop), (col_start, col_stop) = window
+    block_transform = transform * Affine.translation(col_start, row_start)
+    bounds = (block_transform.c, block_transform.f + (row_stop - row_start) * block_transform.e,
+              block_transform.c + (col_stop - col_start) * block_transform.a, block_transform.f)
+    return block_transform, bounds
+
+
+def read_block(src, block_transform, shape, nodata):
+    """ All bands of a dataset on one block of the output grid, nodata where the dataset has no pixels.
+    Inputs on the same pixel grid are read straight from the window under the block, others are warped.
+    """
+    data = numpy.full((src.count,) + shape, nodata, dtype=src.dtypes[0])
+    res = src.transform.a
+    col = (block_transform.c - src.transform.c) / res
+    row = (block_transform.f - src.transform.f) / src.transform.e
+    aligned = (src.transform.a == block_transform.a and src.transform.e == block_transform.e and
+               abs(col - round(col)) < 1e-6 and abs(row - round(row)) < 1e-6)
+    if aligned:
+        col, row = int(round(col)), int(round(row))
+        rows = (max(row, 0), min(row + shape[0], src.height))
+        cols = (max(col, 0), min(col + shape[1], src.width))
+        if rows[0] < rows[1] and cols[0] < cols[1]:
+            data[:, rows[0] - row:rows[1] - row, cols[0] - col:cols[1] - col] = src.read(window=(rows, cols))
+        return data
+    for band in range(src.count):
+        # The warper only reads the part of the source under the block
+        reproject(rasterio.band(src, band + 1), data[band], dst_transform=block_transform, dst_crs=src.crs,
+                  src_nodata=nodata, dst_nodata=nodata, resampling=RESAMPLING.nearest)
+    return data
+
+
+def intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class Mosaic(object):
+    'Combines processed scenes into one raster, block by block over their union'
+
+    stage = "mosaic"
+
+    def __init__(self, input_files, output_file, rule="first", output_format="gtiff", compress=None,
+                 catalog=None):
+        if rule not in RULES:
+            raise ValueError("Unknown mosaic rule " + str(rule) + "; use one of " + ", ".join(RULES))
+        if not input_files:
+            raise ValueError("A mosaic needs at least one input image")
+        self.input_files = list(input_files)
+        self.output_file = output_file
+        self.rule = rule
+        self.output_format = output_format
+        self.compress = compress
+        self.catalog = catalog
+
+    def _ordered_inputs(self):
+        """ Inputs in priority order: a pixel comes from the first input that has data there """
+        if self.rule == "last":
+            return self.input_files[::-1]
+        if self.rule == "least-cloudy":
+            clouds = dict((path, cloud_cover(path, self.catalog)) for path in self.input_files)
+            return sorted(self.input_files, key=lambda path: clouds[path])  # stable, so ties keep their order
+        return list(self.input_files)
+
+    @instrument.timed
+    def run(self):
+        """ Fills every output block from the inputs that overlap it, in the order of the overlap rule.
+        Each input is only read where it meets the block, and only opened for the blocks it meets,
+        so neither memory nor open files grow with the number of scenes.
+        :returns:
+            (String) the path to the mosaic
+        """
+        ordered = self._ordered_inputs()
+        print "Mosaicking " + str(len(ordered)) + " images (" + self.rule + ") into " + self.output_file
+        footprints = [footprint(path) for path in ordered]
+        first = footprints[0]
+        mismatched = [fp.name for fp in footprints if fp.crs != first.crs or fp.count != first.count]
+        if mismatched:
+            raise ValueError("Mosaic inputs need the same projection and band count: " + ", ".join(mismatched))
+        transform, width, height = union_grid(footprints)
+        nodata = first.nodata if first.nodata is not None else 0
+
+        options = {'driver': 'GTiff', 'width': width, 'height': height, 'count': first.count,
+                   'dtype': first.dtype, 'nodata': nodata, 'transform': transform, 'crs': first.crs,
+                   'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE}
+        if first.count == 3:
+            options['photometric'] = 'RGB'
+        options.update(cog.creation_options(self.output_format, self.compress, BLOCK_SIZE))
+
+        inputs = OpenInputs()
+        try:
+            with rasterio.open(self.output_file, 'w', **options) as dst:
+                for window in blocks(width, height):
+                    dst.write(self._fill_block(inputs, footprints, transform, window, nodata), window=window)
+        finally:
+            inputs.close()
+
+        cog.finalize(self.output_file, self.output_format, self.compress)
+        print bcolors.OKGREEN + "The mosaic is saved to " + self.output_file + bcolors.ENDC
+        return self.output_file
+
+    def _fill_block(self, inputs, footprints, transform, window, nodata):
+        (row_start, row_stop), (col_start, col_stop) = window
+        shape = (row_stop - row_start, col_stop - col_start)
+        block_transform, block_bounds = block_grid(transform, window)
+
+        block = numpy.full((footprints[0].count,) + shape, nodata, dtype=footprints[0].dtype)
+        filled = numpy.zeros(shape, dtype=bool)
+        for fp in footprints:
+            if not intersects(block_bounds, fp.bounds):
+                continue
+            data = read_block(inputs.get(fp.name), block_transform, shape, nodata)
+            new = (data != nodata).any(axis=0) & ~filled
+            block[:, new] = data[:, new]
+            filled |= new
+            if filled.all():
+                break
+        return block
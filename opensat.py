@@ -1,36 +1,36 @@
+"""Handy tool for downloading, searching and processing Landsat 8 and Sentinel data.
+
+Use it from the command line (python opensat.py --help) or as a library:
+
+    import opensat
+    matches = opensat.search("13,32", clouds=5)
+    opensat.download(matches[0]["id"], bands="2,3,4")
+    output_file = opensat.process(matches[0]["id"], "432")
+
+Geo libraries (rasterio, fiona) are only imported by the functions that need them,
+so searching and --help stay fast.
+"""
 import argparse
 import datetime
+import functools
 import os
-import requests
 import sys
-from tqdm import tqdm
-from processing import *
-from mask import *
-
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument("command", nargs='?', default='false', help="type of command")
-parser.add_argument("-s", "--scene", help="satellite scene id")
-parser.add_argument("-l", "--location", help="satellite scene path and row")
-parser.add_argument("-b", "--bands", help="satellite bands")
-parser.add_argument("-d", "--date", help="satellite date")
-parser.add_argument("-c", "--clouds", help="prc of clouds")
-parser.add_argument("-p", "--processing", help="prc of clouds")
-parser.add_argument("-m", "--mask", help="prc of clouds")
-args = parser.parse_args()
-
-
-class bcolors:
-    OKGREEN = '\033[92m'
-    WARNING = '\033[93m'
-    FAIL = '\033[91m'
-    ENDC = '\033[0m'
+import time
+import cog
+import instrument
+from catalog import Catalog
+from downloader import AOIFetcher, Downloader
+from locations import is_landsat, parse_locations
+from pipeline import Pipeline, index_scene, process_match, process_scene
+from store import SceneStore
+from utils import aoi_directory, bcolors, data_root
 
 
 class Landsat:
     'Generates attributes for Landsat images'
 
+    satellite = "landsat"
+
     def __init__(self, scene, path):
       if scene != None:
         self.scene = scene
@@ -42,7 +42,8 @@ class Landsat:
         path = path.split(',')
         self.path = path[0]
         self.row = path[1]
-        self.api_url = "https://api.developmentseed.org/satellites?search=satellite_name:landsat-8+AND+((path:" + self.path + "+AND+row:" + self.row + "))&limit=2000"
+        self.location = str(int(self.path)) + "," + str(int(self.row))
+        self.api_query = "satellite_name:landsat-8+AND+((path:" + self.path + "+AND+row:" + self.row + "))"
 
     def get_all_bands(self):
         return ["_B1.TIF", "_B2.TIF", "_B3.TIF", "_B4.TIF", "_B5.TIF", "_B6.TIF", "_B7.TIF", "_B8.TIF", "_B9.TIF", "_B10.TIF", "_B11.TIF", "_BQA.TIF", "_MTL.txt"]
@@ -51,6 +52,8 @@ class Landsat:
 class Sentinel:
     'Generates attributes for Sentinel images'
 
+    satellite = "sentinel"
+
     def __init__(self, scene, path):
       if scene != None:
         self.scene = scene
@@ -71,39 +74,28 @@ class Sentinel:
         self.utm_code = path[0:2]
         self.lat_band = path[2]
         self.square = path[3:5]
-        self.api_url = "https://api.developmentseed.org/satellites?search=satellite_name:sentinel-2+AND+((grid_square:" + self.square + "+AND+latitude_band:" + self.lat_band + "+AND+utm_zone:" + self.utm_code + "))&limit=2000"
+        self.location = path[0:5].upper()
+        self.api_query = "satellite_name:sentinel-2+AND+((grid_square:" + self.square + "+AND+latitude_band:" + self.lat_band + "+AND+utm_zone:" + self.utm_code + "))"
 
     def get_all_bands(self):
-        return ["B01.jp2", "B02.jp2", "B03.jp2", "B04.jp2", "B05.jp2", "B06.jp2", "B07.jp2", "B08.jp2", "B09.jp2", "B10.jp2", "B11.jp2", "B12.jp2", "tileInfo.json"]
+        return ["B01.jp2", "B02.jp2", "B03.jp2", "B04.jp2", "B05.jp2", "B06.jp2", "B07.jp2", "B08.jp2", "B8A.jp2", "B09.jp2", "B10.jp2", "B11.jp2", "B12.jp2", "tileInfo.json", "qi/MSK_CLOUDS_B00.gml"]
 
 
-
-command = args.command.lower()   #type of command
-scene = args.scene  #scene ID
-location = args.location  #scene path
-processing_bands = args.processing
-mask = args.mask
-search_matches = []  #list of bands IDs
-
-
-def get_list(pic):  #get json from developmentseed API
-    api_url = getattr(pic, 'api_url')
-    print api_url
-    r = requests.get(api_url)
-    status = r.status_code
-    if status == 200:
-        return r.json()
-    else:
-        sys.exit(bcolors.FAIL + str(status) + " ERROR. Please check later." + bcolors.ENDC)
+def picture(scene):
+    """ Landsat or Sentinel attributes for a scene id """
+    if scene[0] == "L":
+        return Landsat(scene, None)
+    elif scene[0] == "S":
+        return Sentinel(scene, None)
+    raise ValueError("Unknown scene id " + scene)
 
 
 def create_directory(pic): #check if directory exists and craete if needed
-    home = os.path.expanduser("~")
-    pictures_directory = home + "/openasat/"
+    pictures_directory = data_root()
     if not os.path.exists(pictures_directory):
-        os.mkdir(os.path.expanduser(pictures_directory))
+        os.makedirs(pictures_directory)
 
-    satellite_directory = pictures_directory + satellite
+    satellite_directory = pictures_directory + getattr(pic, 'satellite')
     if not os.path.exists(satellite_directory):
         os.mkdir(os.path.expanduser(satellite_directory))
 
@@ -113,83 +105,209 @@ def create_directory(pic): #check if directory exists and craete if needed
     return scene_directory
 
 
-def scene_links(pic): #create links for particular scene
+def scene_links(pic, bands=None, quality=False): #create links for particular scene
     band_url = getattr(pic, 'band_url')
     all_bands = pic.get_all_bands()
-    if args.bands == None:  #download all files
+    if bands == None:  #download all files
         urls = [band_url + band for band in all_bands]
     else:  #download seperate bands
-        bands = args.bands.split(',')
-        if satellite == "landsat":
+        bands = bands.split(',') if isinstance(bands, basestring) else [str(band) for band in bands]
+        if getattr(pic, 'satellite') == "landsat":
             urls = [band_url + "_B" + band + ".TIF" for band in bands]
             urls.append(band_url + "_MTL.txt")
+            if quality:  # per-pixel cloud flags
+                urls.append(band_url + "_BQA.TIF")
         else:
             bands = [band.zfill(2) if len(band) == 1 else band for band in bands]
             urls = [band_url + "B" + band + ".jp2" for band in bands]
             urls.append(band_url + "tileInfo.json")
+            if quality:  # cloud polygons
+                urls.append(band_url + "qi/MSK_CLOUDS_B00.gml")
     return urls
 
 
-def download(pic):
-    dowloaded_path = create_directory(pic)
-    urls = scene_links(pic)
-    for url in urls:
-        local_filename = url.split('/')[-1]
-        check = os.path.isfile(dowloaded_path + "/" + local_filename)
-        if check == True:
-            print local_filename + " is already downloaded"
+def index_bands(bands, indices, satellite):
+    """ The bands to download for a scene: the given ones plus every band the band math indices read.
+    None (all bands) stays None.
+    """
+    if bands == None or not indices:
+        return bands
+    from bandmath import expression_bands
+
+    bands = bands.split(',') if isinstance(bands, basestring) else [str(band) for band in bands]
+    known = set(band.zfill(2) for band in bands)
+    for expression in indices:
+        for band in expression_bands(expression, satellite):
+            if band.zfill(2) not in known:
+                known.add(band.zfill(2))
+                bands.append(band)
+    return ",".join(bands)
+
+
+def search(locations, clouds=None, dates=None, refresh=False, workers=8, wrs2=None, catalog=None):
+    """ Finds the scenes of one or more locations in the local catalog, syncing it first.
+    :param locations: "path,row", a Sentinel grid square, several of them or a bbox (see parse_locations)
+    :param dates: (start, end) ISO dates, both exclusive
+    :returns:
+        (List) dicts with id, satellite, date, clouds and thumbnail, oldest first
+    """
+    if not isinstance(locations, (list, tuple)):
+        locations = parse_locations(locations, wrs2)
+    pictures = []
+    for place in locations:
+        if is_landsat(place):
+            pictures.append(("landsat", Landsat(None, place)))
         else:
-            for i in range(10):
-                try:
-                    response = requests.get(url, stream=True)
-                    # response = requests.get(url, stream=True, timeout=240)
-                    local_filename = url.split('/')[-1]
-                    headers = response.headers
-                    if "content-length" not in headers:
-                        print bcolors.FAIL + "Ooops... SERVER ERROR. Looks like " + local_filename + " doesn't exist" + bcolors.ENDC
-                    else:
-                        print "Downloading " + local_filename
-                        file_chunk_size = int(headers['content-length'])/99
-                        with open(dowloaded_path + "/" + local_filename, 'wb') as f:
-                            for chunk in tqdm(response.iter_content(chunk_size = file_chunk_size), unit='%'):
-                                f.write(chunk)
-                        print bcolors.OKGREEN + "Success! " + local_filename + " is downloaded!" + bcolors.ENDC
-                        print "This file is saved to " + dowloaded_path + "\n"
-                except requests.exceptions.Timeout:
-                    continue
-                break
-    # is_processing()
-
-
-def processing(bands):
-    if satellite == "landsat" and "8" in bands:
-        process = PanSharpen(scene, bands, satellite)
-        process.run()
-    else:
-        if command == "search":
-            for match in search_matches:
-                process = Processing(match['id'], bands, satellite)
-                process.run()
-        elif command == "download":
-            process = Processing(scene, bands, satellite)
-            process.run()
-    if mask != None:
-        mask_img = Mask(process.output_file, mask)
-        mask_img.run()
-
-
-
-def bulk_objects(): # download multiple scenes
-    for match in search_matches:
-        if satellite == "landsat":
-            scene_d = Landsat(match["id"], None)
-        elif satellite == "sentinel":
-            scene_d = Sentinel(match["id"],None)
-        download(scene_d)
-    if processing_bands != None:
-        processing(processing_bands)
-
-
+            pictures.append(("sentinel", Sentinel(None, place)))
+
+    if dates is not None:
+        dates = [datetime.datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d") for date in dates]
+    own_catalog = catalog is None
+    catalog = catalog or Catalog()
+    try:
+        with instrument.stage("search", locations=len(pictures)) as record:
+            catalog.sync(pictures, refresh=refresh, workers=workers)
+            rows = catalog.scenes(pictures, clouds, *(dates or (None, None)))
+            record['scenes'] = len(rows)
+    finally:
+        if own_catalog:
+            catalog.close()
+    return [{'id': row["scene_id"], 'satellite': row["satellite"], 'date': row["date"],
+             'clouds': row["cloud_coverage"], 'thumbnail': row["thumbnail"]} for row in rows]
+
+
+def download(scene, bands=None, workers=4, checksum=None, aoi=None, session=None, quality=False, ingest=False):
+    """ Downloads a scene (id, Landsat or Sentinel object) into ~/openasat (or $OPENSAT_HOME).
+    When OPENSAT_QUOTA is set, old raw bands of processed scenes are evicted afterwards.
+    With aoi, only the parts of the bands covered by that shapefile are fetched.
+    Pass a requests session to reuse its connections across calls.
+    With quality, the cloud mask data (Landsat BQA band, Sentinel MSK_CLOUDS_B00.gml) is fetched too.
+    With ingest, Sentinel JP2 bands are transcoded once to GeoTIFF, which later stages read instead.
+    :returns:
+        (List) local paths of the files, None for failures
+    """
+    pic = picture(scene) if isinstance(scene, basestring) else scene
+    dowloaded_path = create_directory(pic)
+    urls = scene_links(pic, bands, quality)
+    downloader = Downloader(workers=workers, checksum=checksum, session=session)
+    store = SceneStore()
+    try:
+        with store.pin(pic.scene):
+            with instrument.stage("download", scene=pic.scene, files=len(urls)) as record:
+                if aoi != None:
+                    paths = AOIFetcher(aoi, workers, downloader).run(urls, aoi_directory(dowloaded_path + "/", aoi))
+                else:
+                    paths = downloader.run(urls, dowloaded_path)
+                record['bytes'] = downloader.bytes_downloaded
+                record['failed'] = paths.count(None)
+                store.touch(paths)
+            if ingest:
+                from ingest import ingest as transcode
+                store.touch(transcode(paths, workers))
+        store.gc()  # only evicts when a quota is configured
+    finally:
+        store.close()
+    return paths
+
+
+def process(scene, bands, mask=None, **options):
+    """ Stacks (and pan-sharpens when band 8 is included) a downloaded scene, then optionally masks it.
+    Bands are "432", "4,3,2", "8A,11,12" or a list such as ["8A", "11", "12"].
+    Options are passed on to Processing, e.g. memory_budget, output_format or aoi_only.
+    :returns:
+        (String) the path to the processed (or masked) image
+    """
+    return process_scene(scene, bands, picture(scene).satellite, mask, **options)
+
+
+def index(scene, expression, mask=None, aoi_only=False, dtype="float32", workers=None):
+    """ Computes a band math index of a downloaded scene: a preset (NDVI, NDWI, NBR)
+    or an expression of its bands such as (B5-B4)/(B5+B4).
+    :param dtype: "float32", or "int16" for values scaled by 10000
+    :returns:
+        (String) the path to the index (or masked index) image
+    """
+    return index_scene(scene, expression, picture(scene).satellite, mask, aoi_only, dtype, workers)
+
+
+def mask(input_file, shapefile):
+    """ Crops a processed image to a shapefile.
+    :returns:
+        (String) the path to the masked image
+    """
+    from mask import Mask
+    return Mask(input_file, shapefile).run()
+
+
+def mosaic(input_files, output_file, rule="first", output_format="gtiff", compress=None):
+    """ Combines processed images of neighbouring or overlapping scenes into one image.
+    :param rule: which scene wins where they overlap: "first", "last" or "least-cloudy"
+    :returns:
+        (String) the path to the mosaic
+    """
+    from mosaic import Mosaic
+    catalog = Catalog() if rule == "least-cloudy" else None
+    try:
+        return Mosaic(input_files, output_file, rule, output_format, compress, catalog).run()
+    finally:
+        if catalog is not None:
+            catalog.close()
+
+
+def composite(input_files, output_file, method="median", percentile=50, workers=None, output_format="gtiff",
+              compress=None):
+    """ Combines processed images of one footprint from different dates pixel by pixel.
+    :param method: "median", "percentile" or "best" (the clearest pixel, preferring the least cloudy scenes)
+    :returns:
+        (String) the path to the composite
+    """
+    from composite import Composite
+    catalog = Catalog() if method == "best" else None
+    try:
+        return Composite(input_files, output_file, method, percentile, workers, output_format, compress,
+                         catalog=catalog).run()
+    finally:
+        if catalog is not None:
+            catalog.close()
+
+
+def tiles(input_file, output_dir, min_zoom=None, max_zoom=None, tile_format="png", workers=None, changed=None):
+    """ Cuts a processed or mosaicked image into z/x/y web map tiles under output_dir.
+    The zoom levels default to the image resolution down to the level where it fits into one tile.
+    When the image was remade because some scenes changed, pass those scenes as changed
+    and only the tiles over them are made again.
+    :returns:
+        (String) the path to the TileJSON description of the pyramid
+    """
+    from cache import cached
+    from tiles import TilePyramid, image_bounds
+    pyramid = TilePyramid(input_file, output_dir, min_zoom, max_zoom, tile_format, workers)
+    changed_bounds = None
+    if changed and os.path.isfile(pyramid.output_file):
+        areas = [image_bounds(path) for path in changed]
+        changed_bounds = (min(area[0] for area in areas), min(area[1] for area in areas),
+                          max(area[2] for area in areas), max(area[3] for area in areas))
+    return cached("tiles", pyramid.output_file, [input_file], pyramid.cache_params(),
+                  lambda: pyramid.run(changed_bounds))
+
+
+def download_many(matches, bands=None, processing_bands=None, mask=None, workers=4, checksum=None,
+                  process_workers=2, indices=(), index_type="float32", ingest=False, **options):
+    """ Downloads search matches one after another, processing each one as soon as it is complete """
+    aoi = mask if options.get('aoi_only') else None
+
+    def fetch(match):
+        paths = download(match["id"], index_bands(bands, indices, match["satellite"]), workers, checksum, aoi,
+                         quality=bool(options.get('cloud_mask')), ingest=ingest)
+        return None not in paths
+
+    if processing_bands == None and not indices:
+        for match in matches:
+            fetch(match)
+        return []
+    process = functools.partial(process_match, bands=processing_bands, mask=mask, indices=indices,
+                                index_type=index_type, **options)
+    return Pipeline(fetch, process, process_workers, scene=lambda match: match["id"]).run(matches)
 
 
 def download_yes_no(question): #bulk download prompt
@@ -199,92 +317,180 @@ def download_yes_no(question): #bulk download prompt
     sys.stdout.write(bcolors.WARNING + question + bcolors.ENDC)
     choice = raw_input().lower()
     if choice in valid:
-        if valid[choice] == True:
-            print "Downloading collection of scenes..."
-            bulk_objects()
-    else:
-        sys.stdout.write(bcolors.FAIL + "Invalid answer. Please respond with 'yes' or 'no'.\n" + bcolors.ENDC)
+        return valid[choice]
+    sys.stdout.write(bcolors.FAIL + "Invalid answer. Please respond with 'yes' or 'no'.\n" + bcolors.ENDC)
+    return False
 
 
-def search_results(pic):  #print search results
-    search = get_list(pic)
+def print_search_results(matches, location_count):
     print bcolors.OKGREEN + "===== List of scenes: =====" + bcolors.ENDC + "\n"
+    for match in matches:
+        print "scene id: " + bcolors.OKGREEN + match["id"] + bcolors.ENDC
+        print "date:", match["date"]
+        print "cloud coverage:", str(match["clouds"]) + "%"
+        print "preview:", str(match["thumbnail"]) + "\n"
+
+    print "\n======= SEARCH SUMMARY ======="
+    if len(matches) > 0:
+        min_cloud = min(match['clouds'] for match in matches)
+        max_cloud = max(match['clouds'] for match in matches)
+        print bcolors.OKGREEN + str(len(matches)) + " scenes were found for " + str(location_count) + " search location(s)" + bcolors.ENDC
+        print bcolors.OKGREEN + "The min cloud coverage is " + str(min_cloud) + "%" + bcolors.ENDC
+        print bcolors.OKGREEN + "The max cloud coverage is "  +  str(max_cloud) + "%" + bcolors.ENDC
+    else:
+        print bcolors.FAIL + "No results were found" + bcolors.ENDC
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", nargs='?', default='false', help="type of command")
+    parser.add_argument("action", nargs='?', help="store action: stats or gc")
+    parser.add_argument("-s", "--scene", help="satellite scene id")
+    parser.add_argument("-l", "--location", help="satellite scene path and row; several separated by ';', a file or bbox:left,bottom,right,top")
+    parser.add_argument("-b", "--bands", help="satellite bands")
+    parser.add_argument("-d", "--date", help="satellite date")
+    parser.add_argument("-c", "--clouds", help="prc of clouds")
+    parser.add_argument("-p", "--processing", help="bands to stack after downloading, e.g. 432 or 8A,11,12")
+    parser.add_argument("-m", "--mask", help="prc of clouds")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="number of concurrent downloads")
+    parser.add_argument("--checksum", help="verify downloads with a hashlib algorithm, e.g. md5")
+    parser.add_argument("--process-workers", type=int, default=2, help="number of scenes processed in parallel")
+    parser.add_argument("--memory", type=int, help="process images window by window within this many MB")
+    parser.add_argument("--warp-threads", type=int, default=2, help="GDAL threads used to reproject each band")
+    parser.add_argument("--warp-strips", type=int, default=1, help="row strips each band is split into for reprojection")
+    parser.add_argument("-f", "--format", default="gtiff", choices=cog.FORMATS, help="output format of processed images")
+    parser.add_argument("--compress", choices=cog.COMPRESSIONS, help="compression of processed images")
+    parser.add_argument("--index", help="band math after downloading: NDVI, NDWI, NBR or an expression like (B5-B4)/(B5+B4); several separated by ';'")
+    parser.add_argument("--index-type", default="float32", choices=["float32", "int16"], help="index output type; int16 is scaled by 10000")
+    parser.add_argument("--cloud-mask", nargs="?", const="cloud,shadow,cirrus",
+                        help="blank pixels flagged in the quality data: cloud, shadow, snow, cirrus, fill (default: cloud,shadow,cirrus)")
+    parser.add_argument("--quality-band", action="store_true", help="also save the quality flags as <output>_quality.TIF")
+    parser.add_argument("--mosaic", help="mosaic the processed search results into this file")
+    parser.add_argument("--composite", help="composite the processed search results into this file")
+    parser.add_argument("--inputs", help="processed images to mosaic or composite, separated by ';'")
+    parser.add_argument("--output", help="output file of the mosaic and composite commands, directory of the tiles command")
+    parser.add_argument("--method", default="median", choices=["median", "percentile", "best"], help="per-pixel composite of a time series")
+    parser.add_argument("--percentile", type=float, default=50, help="percentile of the percentile composite")
+    parser.add_argument("--rule", default="first", choices=["first", "last", "least-cloudy"], help="which scene wins where mosaicked scenes overlap")
+    parser.add_argument("--ingest", action="store_true", help="transcode Sentinel JP2 bands to tiled GeoTIFF once after downloading")
+    parser.add_argument("--zoom", help="zoom levels of the tiles command as min,max")
+    parser.add_argument("--tile-format", default="png", choices=["png", "webp"], help="image format of the tiles")
+    parser.add_argument("--changed", help="images (separated by ';') whose area is the only part of the tiles to update")
+    parser.add_argument("--aoi-only", action="store_true", help="only fetch the parts of the bands covered by the mask")
+    parser.add_argument("--refresh", action="store_true", help="sync the local scene catalog even if it is recent")
+    parser.add_argument("--wrs2", help="WRS-2 footprint shapefile used to find Landsat path/rows for a bbox")
+    parser.add_argument("--port", type=int, default=8470, help="port of the job server")
+    parser.add_argument("--home", help="data directory used instead of ~/openasat (also OPENSAT_HOME)")
+    parser.add_argument("--report", nargs="?", const="", help="write a JSON run report, to this file or to reports/ in the data directory")
+    parser.add_argument("--profile", help="run under cProfile and save the stats to this file, with a run report")
+    parser.add_argument("--quota", type=float, help="GB the scene store may use before raw bands are evicted (also OPENSAT_QUOTA)")
+    return parser
+
+
+def run_command(command, args, processing_options):
+    indices = args.index.split(";") if args.index else []
+    if command == "search":
+        locations = parse_locations(args.location, args.wrs2)
+        dates = args.date.split(",") if args.date != None else None
+        matches = search(locations, args.clouds, dates, args.refresh, args.workers)
+        print_search_results(matches, len(locations))
+        if matches and download_yes_no("Do you want to download all scenes? " + "[y/n]"):
+            print "Downloading collection of scenes..."
+            results = download_many(matches, args.bands, args.processing, args.mask, args.workers, args.checksum,
+                                    args.process_workers, indices, args.index_type, args.ingest,
+                                    **processing_options)
+            # The stacked image comes first when a scene also has indices
+            images = [result if isinstance(result, basestring) else result[0] for result in results]
+            if args.mosaic and args.processing != None and images:
+                mosaic(images, args.mosaic, args.rule, args.format, args.compress)
+            if args.composite and args.processing != None and images:
+                composite(images, args.composite, args.method, args.percentile, args.process_workers,
+                          args.format, args.compress)
+
+    elif command == "download":
+        aoi = args.mask if args.aoi_only else None
+        bands = index_bands(args.bands, indices, picture(args.scene).satellite)
+        download(args.scene, bands, args.workers, args.checksum, aoi, quality=bool(args.cloud_mask),
+                 ingest=args.ingest)
+        if args.processing != None:
+            process(args.scene, args.processing, args.mask, **processing_options)
+        for expression in indices:
+            index(args.scene, expression, args.mask, args.aoi_only, args.index_type)
+
+    elif command == "mosaic":
+        if not args.inputs or not args.output:
+            print bcolors.FAIL + "Give the images with --inputs and the mosaic file with --output" + bcolors.ENDC
+        else:
+            mosaic(args.inputs.split(";"), args.output, args.rule, args.format, args.compress)
 
-    def print_match():
-        search_matches.append({'id': scene["scene_id"], 'clouds': scene["cloud_coverage"]})
-        print "scene id: " + bcolors.OKGREEN + scene["scene_id"] + bcolors.ENDC
-        print "date:", scene["date"]
-        print "cloud coverage:", str(scene["cloud_coverage"]) + "%"
-        print "preview:", scene["thumbnail"] + "\n"
-
-    def print_summary():
-        match_cases = len(search_matches)
-        min_cloud = min(search_match['clouds'] for search_match in search_matches)
-        max_cloud = max(search_match['clouds'] for search_match in search_matches)
-        print "\n======= SEARCH SUMMARY ======="
-        if match_cases > 0:
-            print bcolors.OKGREEN + str(match_cases) + " scenes were found for the search area" + bcolors.ENDC
-            print bcolors.OKGREEN + "The min cloud coverage is " + str(min_cloud) + "%" + bcolors.ENDC
-            print bcolors.OKGREEN + "The max cloud coverage is "  +  str(max_cloud) + "%" + bcolors.ENDC
-            download_yes_no("Do you want to download all scenes? " + "[y/n]")
+    elif command == "composite":
+        if not args.inputs or not args.output:
+            print bcolors.FAIL + "Give the images with --inputs and the composite file with --output" + bcolors.ENDC
         else:
-            print bcolors.FAIL + "No results were found" + bcolors.ENDC
-
-
-    if (args.clouds != None) & (args.date != None): #check for cloud and date conditions
-        clouds = float(args.clouds)
-        date = args.date.split(",")
-        date_start = datetime.datetime.strptime(date[0], "%Y-%m-%d")
-        date_end = datetime.datetime.strptime(date[1], "%Y-%m-%d")
-        for scene in search["results"]:
-            data_scene = datetime.datetime.strptime(scene["date"], "%Y-%m-%d")
-            if (data_scene < date_end) & (data_scene > date_start) & (scene["cloud_coverage"] <= clouds):
-                print_match()
-        print_summary()
-
-    elif args.clouds != None: #check for clouds condition
-        clouds = float(args.clouds)
-        for scene in search["results"]:
-            if scene["cloud_coverage"] <= clouds:
-                print_match()
-        print_summary()
-
-    elif args.date != None: #check for date condition
-        date = args.date.split(",")
-        date_start = datetime.datetime.strptime(date[0], "%Y-%m-%d")
-        date_end = datetime.datetime.strptime(date[1], "%Y-%m-%d")
-        for scene in search["results"]:
-            data_scene = datetime.datetime.strptime(scene["date"], "%Y-%m-%d")
-            if (data_scene < date_end) & (data_scene > date_start):
-                print_match()
-        print_summary()
-
-    else: # print all scenes
-        for scene in search["results"]:
-            print_match()
-        print_summary()
-
-
-if scene == None and location != None:
-    if "," in location:
-        satellite = "landsat"
-        picture = Landsat(None, location)
-    elif "," not in location:
-        satellite = "sentinel"
-        picture = Sentinel(None, location)
-
-
-if command == "search":
-    search_results(picture)
-
-
-elif command == "download":
-    if scene != None and scene[0] == "L": # Check satellite and type of command
-        satellite = "landsat"
-        picture = Landsat(scene, None)
-    if scene != None and scene[0] == "S":
-        satellite = "sentinel"
-        picture = Sentinel(scene, None)
-    download(picture)
-    if processing_bands != None:
-        processing(processing_bands)
+            composite(args.inputs.split(";"), args.output, args.method, args.percentile, args.process_workers,
+                      args.format, args.compress)
+
+    elif command == "tiles":
+        if not args.inputs or not args.output:
+            print bcolors.FAIL + "Give the image with --inputs and the tile directory with --output" + bcolors.ENDC
+        else:
+            zoom = [int(level) for level in args.zoom.split(",")] if args.zoom else [None, None]
+            tiles(args.inputs, args.output, zoom[0], zoom[-1], args.tile_format, args.process_workers,
+                  args.changed.split(";") if args.changed else None)
+
+    elif command == "serve":
+        from server import serve
+        serve(args.port, args.process_workers)
+
+    elif command == "store":
+        store = SceneStore()
+        try:
+            if args.action == "gc":
+                if store.quota is None:
+                    print bcolors.FAIL + "Set a quota with --quota or OPENSAT_QUOTA to run gc" + bcolors.ENDC
+                else:
+                    store.gc()
+            store.print_stats()
+        finally:
+            store.close()
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    command = args.command.lower()   #type of command
+    if args.home:
+        os.environ["OPENSAT_HOME"] = os.path.abspath(os.path.expanduser(args.home))
+    if args.quota is not None:
+        os.environ["OPENSAT_QUOTA"] = str(args.quota)
+    processing_options = {'memory_budget': args.memory * 1024 * 1024 if args.memory else None,
+                          'warp_threads': args.warp_threads,
+                          'warp_strips': args.warp_strips,
+                          'output_format': args.format,
+                          'compress': args.compress,
+                          'aoi_only': args.aoi_only,
+                          'cloud_mask': args.cloud_mask,
+                          'quality_band': args.quality_band}
+
+    instrument.reset()
+    if args.profile:
+        with instrument.profile(args.profile):
+            run_command(command, args, processing_options)
+        print "Profile saved to " + args.profile
+    else:
+        run_command(command, args, processing_options)
+
+    if args.report is not None or args.profile:
+        report = args.report
+        if not report:
+            reports_directory = data_root() + "reports/"
+            if not os.path.exists(reports_directory):
+                os.makedirs(reports_directory)
+            report = reports_directory + time.strftime("%Y%m%d-%H%M%S") + "-" + command + ".json"
+        instrument.write_report(report, argv if argv is not None else sys.argv[1:])
+        if not args.report:
+            instrument.prune_reports(reports_directory)
+        print "Run report saved to " + report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import Queue
+import threading
+import time
+import traceback
+import instrument
+from cache import cached, shapefile_parts
+from store import SceneStore
+from utils import WorkerWatch, aoi_directory, bcolors, parse_bands, scene_directory
+
+
+_DONE = object()
+POLL_INTERVAL = 0.5  # seconds between looks for dead workers while waiting on them
+
+
+def process_scene(scene, bands, satellite, mask=None, aoi_only=False, **options):
+    """ Runs the processing (and optional masking) steps for one downloaded scene.
+    Steps whose output is up to date with its inputs and options are skipped.
+    With aoi_only the scene was fetched for the mask area only.
+    Extra options are passed on to Processing or PanSharpen.
+    :returns:
+        (String) the path to the final image
+    """
+    from processing import Processing, PanSharpen
+    from mask import Mask
+
+    if aoi_only and mask != None:
+        options['scene_path'] = aoi_directory(scene_directory(satellite, scene), mask)
+    store = SceneStore()
+    try:
+        with store.pin(scene):
+            if satellite == "landsat" and "8" in parse_bands(bands):
+                process = PanSharpen(scene, bands, satellite, **options)
+            else:
+                process = Processing(scene, bands, satellite, **options)
+            output_file = cached(process.stage, process.output_file, process.input_files(),
+                                 process.cache_params(), process.run)
+            store.touch(process.input_files() + [output_file])
+            if mask != None:
+                mask_img = Mask(output_file, mask)
+                output_file = cached("mask", mask_img.output_file, [output_file] + shapefile_parts(mask), {},
+                                     mask_img.run)
+                store.touch([output_file])
+    finally:
+        store.close()
+    return output_file
+
+
+def index_scene(scene, expression, satellite, mask=None, aoi_only=False, dtype="float32", workers=None):
+    """ Computes a band math index (a preset such as NDVI or an expression) for one downloaded scene,
+    then optionally masks it. Skipped when the index is up to date.
+    :returns:
+        (String) the path to the index image
+    """
+    from bandmath import BandMath
+    from mask import Mask
+
+    scene_path = aoi_directory(scene_directory(satellite, scene), mask) if aoi_only and mask != None else None
+    store = SceneStore()
+    try:
+        with store.pin(scene):
+            band_math = BandMath(scene, expression, satellite, dtype, workers, scene_path=scene_path)
+            output_file = cached(band_math.stage, band_math.output_file, band_math.input_files(),
+                                 band_math.cache_params(), band_math.run)
+            store.touch(band_math.input_files() + [output_file])
+            if mask != None:
+                mask_img = Mask(output_file, mask)
+                output_file = cached("mask", mask_img.output_file, [output_file] + shapefile_parts(mask), {},
+                                     mask_img.run)
+    finally:
+        store.close()
+    return output_file
+
+
+def process_match(match, bands, mask=None, indices=(), index_type="float32", **options):
+    """ process_scene (when bands are given) and index_scene for one search match,
+    which carries its own satellite """
+    output_files = []
+    if bands:
+        output_files.append(process_scene(match["id"], bands, match["satellite"], mask, **options))
+    for expression in indices:
+        output_files.append(index_scene(match["id"], expression, match["satellite"], mask,
+                                        options.get('aoi_only', False), index_type))
+    return output_files[0] if len(output_files) == 1 else output_files
+
+
+def _run_stage(process, item):
+    """ Never lets a worker exception escape, so the in-flight slot is always released.
+    The worker's stage records travel back with the result.
+    """
+    instrument.reset()
+    try:
+        return True, process(item), instrument.records()
+    except Exception:
+        return False, traceback.format_exc(), instrument.records()
+
+
+class Pipeline(object):
+    'Overlaps scene downloads with processing through bounded queues'
+
+    def __init__(self, download, process, process_workers=2, queue_size=None, scene=None):
+        self.download = download  # callable(item), returns a falsy value when the scene failed
+        self.process = process  # picklable callable(item) run in a worker process
+        # callable(item) naming the scene to pin in the store from its download until it is processed
+        self.scene = scene
+        self.process_workers = max(1, int(process_workers))
+        # Scenes that are downloaded but not yet picked up by a worker
+        self.queue_size = queue_size if queue_size is not None else self.process_workers
+
+    def _produce(self, items, downloaded):
+        try:
+            for item in items:
+                # A download evicts old bands when over the quota, which must spare the scenes still queued
+                self._pin(item, True)
+                if self.download(item):
+                    downloaded.put(item)  # blocks while processing is behind
+                else:
+                    self._pin(item, False)
+        finally:
+            downloaded.put(_DONE)
+
+    def _pin(self, item, pinned):
+        if self.scene is None:
+            return
+        store = SceneStore()  # called from several threads, which cannot share a connection
+        try:
+            if pinned:
+                store.acquire(self.scene(item))
+            else:
+                store.release(self.scene(item))
+        finally:
+            store.close()
+
+    def run(self, items):
+        """ Downloads items one after another while earlier ones are processed in a worker pool.
+        A worker that dies, e.g. killed for memory, fails its scene and frees its slot.
+        :returns:
+            (List) processing results in the order scenes finished downloading
+        """
+        # Fork the workers before any download thread exists
+        watched = WorkerWatch()
+        pool = watched.pool(self.process_workers)
+        downloaded = Queue.Queue(maxsize=self.queue_size)
+        in_flight = threading.BoundedSemaphore(self.process_workers)
+        producer = threading.Thread(target=self._produce, args=(items, downloaded))
+        producer.daemon = True
+        producer.start()
+
+        pending = []  # (item, result) in download order
+        lost = set()  # indices of pending whose worker died
+
+        def processed(index):
+            # Called once per item: by the pool when it calls back, or by reap when the worker died
+            self._pin(pending[index][0], False)
+            in_flight.release()
+
+        def reap():
+            for index in watched.dead(pool):
+                lost.add(index)
+                processed(index)
+
+        try:
+            while True:
+                item = downloaded.get()
+                if item is _DONE:
+                    break
+                while not in_flight.acquire(False):
+                    reap()
+                    time.sleep(POLL_INTERVAL)
+                index = len(pending)
+                pending.append((item, None))  # in place before the pool can call back
+                pending[index] = (item, watched.apply_async(
+                    pool, index, _run_stage, (self.process, item),
+                    callback=lambda result, index=index: watched.finished(index) and processed(index)))
+            pool.close()
+            producer.join()
+
+            results = []
+            for index, (item, result) in enumerate(pending):
+                while not result.ready() and index not in lost:
+                    result.wait(POLL_INTERVAL)
+                    reap()
+                if index in lost:
+                    print bcolors.FAIL + "Processing failed: the worker process died" + bcolors.ENDC
+                    continue
+                ok, value, stage_records = result.get()
+                instrument.extend(stage_records)
+                if ok:
+                    results.append(value)
+                else:
+                    print bcolors.FAIL + "Processing failed:\n" + value + bcolors.ENDC
+            return results
+        finally:
+            pool.terminate()
+            pool.join()
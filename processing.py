@@ -1,17 +1,85 @@
 import numpy
 import json
 import rasterio
+from affine import Affine
 from rasterio.warp import reproject, RESAMPLING, transform, transform_bounds
+try:
+    from rasterio.vrt import WarpedVRT
+except ImportError:  # rasterio before 1.0
+    WarpedVRT = None
 
-from skimage import transform as sktransform
-from skimage.util import img_as_ubyte
-from skimage.exposure import rescale_intensity
 from polyline.codec import PolylineCodec
 import warnings
 import os
+from multiprocessing.pool import ThreadPool
+import cog
+import instrument
+from gridcache import GridCache
+from ingest import cached_band
+from quality import QualityMask
+from utils import bands_label, bcolors, parse_bands, scene_directory
 
 warnings.filterwarnings("ignore")
 
+# Rough working set per output pixel of one band window in the windowed mode:
+# destination block, warp source chunk, stretch temporaries, the quality mask and the 8-bit result
+WINDOW_BYTES_PER_PIXEL = 32
+# Window size used for strip-wise steps when no memory budget is given
+DEFAULT_WINDOW_BUDGET = 64 * 1024 * 1024
+# Side of the square blocks of the windowed mode, a multiple of the COG tile size when the budget allows
+BLOCK_SIZE = 512
+# Smallest block side, below which the per-block overhead of GDAL dominates
+MIN_BLOCK_SIZE = 64
+
+
+def _histogram_percentile(hist, q):
+    """ Same result as numpy.percentile (linear interpolation) on the values counted in hist """
+    cdf = numpy.cumsum(hist)
+    index = q / 100.0 * (cdf[-1] - 1)
+    lower = int(numpy.floor(index))
+    upper = min(lower + 1, int(cdf[-1]) - 1)
+    value_lower = numpy.searchsorted(cdf, lower, side='right')
+    value_upper = numpy.searchsorted(cdf, upper, side='right')
+    return value_lower + (value_upper - value_lower) * (index - lower)
+
+
+def window_transform(dst_transform, window):
+    """ Geotransform of a window of a grid """
+    (row_start, row_stop), (col_start, col_stop) = window
+    return (dst_transform[0] + col_start * dst_transform[1], dst_transform[1], 0.0,
+            dst_transform[3] + row_start * dst_transform[5], 0.0, dst_transform[5])
+
+
+def warp_window(src, out, dst_transform, dst_crs, shape, window, resampling=RESAMPLING.nearest, threads=1):
+    """ Warps the first band of src into out, the window of a destination grid (geotransform and shape).
+    Warping the window alone lets GDAL's approximate transformer pick source pixels differently for
+    every window size. A warped virtual dataset of the whole grid warps its own fixed blocks instead,
+    so strips, blocks and the whole grid all read the same pixels.
+    """
+    if WarpedVRT is None:  # rasterio before 1.0 has no warped VRT
+        reproject(rasterio.band(src, 1), out, dst_transform=window_transform(dst_transform, window), dst_crs=dst_crs,
+                  resampling=resampling, num_threads=threads)
+        return out
+    with WarpedVRT(src, crs=dst_crs, transform=Affine.from_gdal(*dst_transform), width=shape[1], height=shape[0],
+                   resampling=resampling, warp_extras={'NUM_THREADS': threads}) as vrt:
+        return vrt.read(1, window=window, out=out)
+
+
+def band_file(scene, band, satellite):
+    """ File name of a band ("4", "11" or "8A") of a downloaded scene """
+    if satellite == "landsat":
+        return scene + "_B" + band + ".TIF"
+    return "B" + band.zfill(2) + ".jp2"
+
+
+def band_path(scene_path, name):
+    """ Path of a downloaded band file; the AOI parts of JP2 bands are GeoTIFF,
+    and ingested JP2 bands are read from their GeoTIFF copy """
+    path = scene_path + name
+    jp2_subset = os.path.splitext(path)[0] + ".tif"
+    if not os.path.isfile(path) and os.path.isfile(jp2_subset):
+        path = jp2_subset
+    return cached_band(path)
 
 
 # Stacking bands is based on landsat-util code
@@ -19,69 +87,78 @@ warnings.filterwarnings("ignore")
 class Processing(object):
     'Processing images'
 
-    def __init__(self, scene, bands, satellite):
-        self.bands_values = bands
+    def __init__(self, scene, bands, satellite, memory_budget=None, warp_workers=None, warp_threads=2,
+                 warp_strips=1, output_format="gtiff", compress=None, scene_path=None, cloud_mask=None,
+                 quality_band=False):
+        bands = parse_bands(bands)
+        self.bands_values = bands_label(bands)
+        self.memory_budget = memory_budget  # bytes; enables block-windowed processing
+        self.warp_workers = warp_workers or len(bands)  # bands (or strips) warped at the same time
+        self.warp_threads = warp_threads  # GDAL threads per warp
+        self.warp_strips = max(1, warp_strips)  # row strips per band
+        self.output_format = output_format  # "gtiff" or "cog"
+        self.compress = compress
         self.projection = {'init': 'epsg:3857'}
         self.dst_crs = {'init': u'epsg:3857'}
         self.satellite = satellite
-        if self.satellite == "landsat":
-            self.bands = [scene + "_B" + band + ".TIF" for band in bands]
-        elif self.satellite == "sentinel":
-            self.bands = ["B0" + band + ".jp2" for band in bands]
+        self.bands = [band_file(scene, band, satellite) for band in bands]
         self.scene = scene
 
-        self.output_dir = os.path.expanduser("~") + "/openasat/" + satellite + "/" + self.scene + "/processed/"
+        # scene_path points somewhere else for AOI-only downloads
+        self.scene_path = scene_path or scene_directory(satellite, self.scene)
+        self.output_dir = self.scene_path + "processed/"
         if not os.path.exists(self.output_dir):
             os.mkdir(os.path.expanduser(self.output_dir))
 
-        self.bands_path = []
-        self.scene_path = os.path.expanduser("~") + "/openasat/" + satellite + "/"  + self.scene + "/"
-        for band in self.bands:
-            self.bands_path.append(self.scene_path + band )
+        self.bands_path = [band_path(self.scene_path, band) for band in self.bands]
 
         self.output_file = self.output_dir + self.scene + "_" + self.bands_values + ".TIF"
 
+        # Pixels with the selected quality flags (e.g. "cloud,shadow") are blanked in the output
+        self.quality = None
+        if cloud_mask:
+            self.quality = QualityMask(scene, satellite, self.scene_path, cloud_mask)
+            if not self.quality.available():
+                print bcolors.WARNING + "No quality data at " + self.quality.path + ", clouds are not masked" + bcolors.ENDC
+                self.quality = None
+        self.quality_file = self.output_dir + self.scene + "_" + self.bands_values + "_quality.TIF" \
+            if self.quality and quality_band else None
 
+    stage = "stack"
 
+    def metadata_path(self):
+        if self.satellite == "landsat":
+            return self.scene_path + self.scene + '_MTL.txt'
+        return self.scene_path + 'tileInfo.json'
 
-    def _get_boundaries(self, src, shape):
-
-            output = {'ul': {'x': [0, 0], 'y': [0, 0]},  # ul: upper left
-                      'ur': {'x': [0, 0], 'y': [0, 0]},  # ur: upper right
-                      'll': {'x': [0, 0], 'y': [0, 0]},  # ll: lower left
-                      'lr': {'x': [0, 0], 'y': [0, 0]}}  # lr: lower right
-
-            output['ul']['x'][0] = src['affine'][2]
-            output['ul']['y'][0] = src['affine'][5]
-            output['ur']['x'][0] = output['ul']['x'][0] + self.pixel * src['shape'][1]
-            output['ur']['y'][0] = output['ul']['y'][0]
-            output['ll']['x'][0] = output['ul']['x'][0]
-            output['ll']['y'][0] = output['ul']['y'][0] - self.pixel * src['shape'][0]
-            output['lr']['x'][0] = output['ul']['x'][0] + self.pixel * src['shape'][1]
-            output['lr']['y'][0] = output['ul']['y'][0] - self.pixel * src['shape'][0]
-
-            output['ul']['x'][1], output['ul']['y'][1] = transform(src['crs'], self.projection,
-                                                                   [output['ul']['x'][0]],
-                                                                   [output['ul']['y'][0]])
+    def input_files(self):
+        """ Files the output is made from: the bands and the metafile with the cloud coverage """
+        return self.bands_path + [self.metadata_path()] + ([self.quality.path] if self.quality else [])
 
-            output['ur']['x'][1], output['ur']['y'][1] = transform(src['crs'], self.projection,
-                                                                   [output['ur']['x'][0]],
-                                                                   [output['ur']['y'][0]])
+    def cache_params(self):
+        """ Options that change the pixels of the output (warp threads and strips do not) """
+        return {'bands': self.bands_values,
+                'satellite': self.satellite,
+                'output_format': self.output_format,
+                'compress': self.compress,
+                'windowed': bool(self.memory_budget),
+                'cloud_mask': self.quality.bits if self.quality else None,
+                'quality_band': bool(self.quality_file)}
 
-            output['ll']['x'][1], output['ll']['y'][1] = transform(src['crs'], self.projection,
-                                                                   [output['ll']['x'][0]],
-                                                                   [output['ll']['y'][0]])
 
-            output['lr']['x'][1], output['lr']['y'][1] = transform(src['crs'], self.projection,
-                                                                   [output['lr']['x'][0]],
-                                                                   [output['lr']['y'][0]])
+    def _get_boundaries(self, src, shape):
+        """ Destination geotransform covering the projected corners of the source grid """
+        left, top = src['affine'][2], src['affine'][5]
+        right = left + self.pixel * src['shape'][1]
+        bottom = top - self.pixel * src['shape'][0]
 
-            dst_corner_ys = [output[k]['y'][1][0] for k in output.keys()]
-            dst_corner_xs = [output[k]['x'][1][0] for k in output.keys()]
-            y_pixel = abs(max(dst_corner_ys) - min(dst_corner_ys)) / shape[0]
-            x_pixel = abs(max(dst_corner_xs) - min(dst_corner_xs)) / shape[1]
+        # ul, ur, ll and lr corners projected in one call
+        dst_corner_xs, dst_corner_ys = transform(src['crs'], self.projection,
+                                                 [left, right, left, right], [top, top, bottom, bottom])
+        y_pixel = abs(max(dst_corner_ys) - min(dst_corner_ys)) / shape[0]
+        x_pixel = abs(max(dst_corner_xs) - min(dst_corner_xs)) / shape[1]
 
-            return (min(dst_corner_xs), x_pixel, 0.0, max(dst_corner_ys), 0.0, -y_pixel)
+        return (min(dst_corner_xs), x_pixel, 0.0, max(dst_corner_ys), 0.0, -y_pixel)
 
 
     def _get_image_data(self):
@@ -98,25 +175,51 @@ class Processing(object):
             'shape': src.shape,
             'dst_transform': None
         }
-
-        image_data['dst_transform'] = self._get_boundaries(image_data, image_data['shape'])
+        src.close()
+
+        # Scenes of the same footprint reuse (and align to) the grid of the first one
+        with instrument.stage("grid") as record:
+            grids = GridCache()
+            try:
+                image_data['dst_transform'], record['cached'] = grids.grid(
+                    image_data['crs'], image_data['affine'], image_data['shape'], self.projection,
+                    lambda: self._get_boundaries(image_data, image_data['shape']))
+            finally:
+                grids.close()
 
         return image_data
 
 
-    def _read_bands(self):
-        """ Reads a band with rasterio """
-        bands = []
-        for i, band in enumerate(self.bands_path):
-            bands.append(rasterio.open(band).read(1))
-        return bands
-
-    def _warp(self, proj_data, bands, new_bands):
+    def _warp(self, proj_data, bands, new_bands, resamplings=None):
+        """ Reprojects all bands at once, optionally splitting each destination into row strips.
+        GDAL releases the GIL while warping, so a thread pool keeps every core busy.
+        Bands are paths of band files. GDAL dataset handles are not thread-safe,
+        so every strip reads through its own handle.
+        """
+        resamplings = resamplings or [RESAMPLING.nearest] * len(bands)
+        jobs = []
         for i, band in enumerate(bands):
-            print "Projecting band " +  self.bands[i]
-            reproject(band, new_bands[i], src_transform=proj_data['transform'], src_crs=proj_data['crs'],
-                      dst_transform=proj_data['dst_transform'], dst_crs=self.dst_crs, resampling=RESAMPLING.nearest,
-                      num_threads=2)
+            print "Projecting band " + self.bands[i]
+            shape = new_bands[i].shape
+            rows = -(-shape[0] // self.warp_strips)
+            for row in range(0, shape[0], rows):
+                jobs.append((band, new_bands[i], ((row, min(row + rows, shape[0])), (0, shape[1])), resamplings[i]))
+
+        def warp_strip(job):
+            band, new_band, window, resampling = job
+            (row_start, row_stop), _ = window
+            # A row slice of a C-ordered array is contiguous, so GDAL writes straight into new_band
+            with rasterio.open(band) as src:
+                warp_window(src, new_band[row_start:row_stop], proj_data['dst_transform'], self.dst_crs,
+                            new_band.shape, window, resampling, self.warp_threads)
+
+        pool = ThreadPool(min(self.warp_workers, len(jobs)))
+        try:
+            with instrument.stage("warp", bands=len(bands), strips=self.warp_strips):
+                pool.map(warp_strip, jobs)
+        finally:
+            pool.close()
+            pool.join()
 
 
     def _generate_new_bands(self, shape):
@@ -129,8 +232,7 @@ class Processing(object):
 
     def _write_to_file(self, new_bands, **kwargs):
 
-        # Read coverage from metafile
-        coverage = self._calculate_cloud_ice_perc()
+        coverage = self._stretch_coverage()
 
 
 
@@ -138,37 +240,32 @@ class Processing(object):
 
         for i, band in enumerate(new_bands):
             # Color Correction
-            band = self._color_correction(band, self.bands[i], 0, coverage)
+            with instrument.stage("color_correction", band=self.bands[i]):
+                band = self._color_correction(band, self.bands[i], 0, coverage)
 
-            output.write_band(i + 1, img_as_ubyte(band))
+            with instrument.stage("write", band=self.bands[i]):
+                output.write_band(i + 1, band)
 
             new_bands[i] = None
+        output.update_tags(CLOUD_COVER=str(self.cloud_cover))  # mosaics prefer the least cloudy scenes
+        output.close()
         print "Writing to file " + self.scene + self.bands_values + ".TIF"
+        with instrument.stage("finalize", output_format=self.output_format):
+            cog.finalize(self.output_file, self.output_format, self.compress)
         print "This file is saved to " + self.output_file
         return self.output_file
 
     def _color_correction(self, band, band_id, low, coverage):
-        if self.bands == [4, 5]:
-            return band
-        else:
-            print "Color correcting band " + band_id
-            p_low, cloud_cut_low = self._percent_cut(band, low, 100 - (coverage * 3 / 4))
-            temp = numpy.zeros(numpy.shape(band), dtype=numpy.uint16)
-            cloud_divide = 65000 - coverage * 100
-            mask = numpy.logical_and(band < cloud_cut_low, band > 0)
-            temp[mask] = rescale_intensity(band[mask], in_range=(p_low, cloud_cut_low), out_range=(256, cloud_divide))
-            temp[band >= cloud_cut_low] = rescale_intensity(band[band >= cloud_cut_low],
-                                                            out_range=(cloud_divide, 65535))
-            return temp
-
-    def _percent_cut(self, color, low, high):
-        return numpy.percentile(color[numpy.logical_and(color > 0, color < 65535)], (low, high))
+        """ Stretches a uint16 band straight to uint8 with a histogram and a lookup table """
+        print "Color correcting band " + band_id
+        hist = numpy.bincount(band.ravel(), minlength=65536)
+        return self._stretch_lut(self._stretch_params(hist, low, coverage))[band]
 
     def _calculate_cloud_ice_perc(self):
         """ Return the percentage of pixels that are either cloud or snow according to metafile.
         """
         if self.satellite == "landsat":
-            f = open( self.scene_path + self.scene + '_MTL.txt', 'r')
+            f = open(self.metadata_path(), 'r')
             f = f.read()
             for item in f.split("\n"):
                 if "CLOUD_COVER =" in item:
@@ -176,31 +273,47 @@ class Processing(object):
                     perc = float(perc)
 
         elif self.satellite == "sentinel":
-            with open(self.scene_path + 'tileInfo.json') as data_file:
+            with open(self.metadata_path()) as data_file:
                 data = json.load(data_file)
                 perc = data["cloudyPixelPercentage"]
                 if perc == 0:
                     perc = 0.1
         print "The cloud coverage is " + str(perc) + "%"
+        self.cloud_cover = perc
         return perc
 
-    def run(self):
-        """ Executes the image processing.
-        :returns:
-            (String) the path to the processed image
-        """
-
-        print 'Image processing started for scene ' + self.scene + " and bands " + self.bands_values
-
-        bands = self._read_bands()
-        image_data = self._get_image_data()
-        new_bands = self._generate_new_bands(image_data['shape'])
-        self._warp(image_data, bands, new_bands)
-
-        # Bands are no longer needed
-        del bands
-
-        rasterio_options = {
+    def _stretch_coverage(self):
+        """ Cloud percentage the stretch allows for; masked clouds no longer reach the histograms """
+        coverage = self._calculate_cloud_ice_perc()
+        return 0.1 if self.quality else coverage
+
+    def _quality_options(self, image_data):
+        return {'driver': 'GTiff',
+                'width': image_data['shape'][1],
+                'height': image_data['shape'][0],
+                'count': 1,
+                'dtype': numpy.uint8,
+                'transform': image_data['dst_transform'],
+                'crs': self.dst_crs,
+                'compress': 'deflate',
+                'tiled': True}
+
+    def _apply_quality(self, new_bands, image_data):
+        """ Blanks the pixels with a selected quality flag, so they drop out of the stretch and the output """
+        if not self.quality:
+            return
+        with instrument.stage("quality"):
+            print "Masking " + self.quality.path
+            classes = self.quality.classes(image_data['dst_transform'], self.dst_crs, image_data['shape'])
+            masked = (classes & self.quality.bits) != 0
+            for band in new_bands:
+                band[masked] = 0
+            if self.quality_file:
+                with rasterio.open(self.quality_file, 'w', **self._quality_options(image_data)) as dst:
+                    dst.write(classes, 1)
+
+    def _output_options(self, image_data):
+        options = {
             'driver': 'GTiff',
             'width': image_data['shape'][1],
             'height': image_data['shape'][0],
@@ -211,99 +324,193 @@ class Processing(object):
             'photometric': 'RGB',
             'crs': self.dst_crs
         }
+        options.update(cog.creation_options(self.output_format, self.compress))
+        return options
+
+    def _windows(self, shape):
+        """ Splits the output into full-width row windows that fit into the memory budget """
+        budget = self.memory_budget or DEFAULT_WINDOW_BUDGET
+        rows = max(1, int(budget // (shape[1] * WINDOW_BYTES_PER_PIXEL)))
+        for row in range(0, shape[0], rows):
+            yield ((row, min(row + rows, shape[0])), (0, shape[1]))
+
+    def _blocks(self, shape):
+        """ Splits the output into square blocks that fit into the memory budget, row of blocks by row of blocks.
+        Unlike full-width rows, a block stays small however wide the scene is. Bands are done one after
+        another, so the budget covers the arrays of one band block; it is approximate, GDAL's block cache
+        and the open datasets come on top, and it is never cut below MIN_BLOCK_SIZE pixels a side.
+        """
+        budget = self.memory_budget or DEFAULT_WINDOW_BUDGET
+        side = int(numpy.sqrt(budget / WINDOW_BYTES_PER_PIXEL))
+        side = side // BLOCK_SIZE * BLOCK_SIZE if side >= BLOCK_SIZE else max(MIN_BLOCK_SIZE, side)
+        for row in range(0, shape[0], side):
+            for col in range(0, shape[1], side):
+                yield ((row, min(row + side, shape[0])), (col, min(col + side, shape[1])))
+
+    def _band_histogram(self, src):
+        """ Counts every uint16 value of a source band, reading it block by block:
+        the internal tiles of a tiled band, else square blocks. Masked quality pixels are counted as nodata.
+        """
+        hist = numpy.zeros(65536, dtype=numpy.int64)
+        block_height, block_width = src.block_shapes[0]
+        tiled = block_height > 1 and block_width < src.width
+        windows = [window for _, window in src.block_windows(1)] if tiled else self._blocks(src.shape)
+        for window in windows:
+            data = src.read(1, window=window)
+            if self.quality:
+                data[self.quality.read(src.window_transform(window), src.crs, data.shape)] = 0
+            hist += numpy.bincount(data.ravel(), minlength=65536)
+        return hist
+
+    def _stretch_params(self, hist, low, coverage):
+        """ Derives the _color_correction stretch of a band from its value histogram """
+        counted = hist.copy()
+        counted[0] = 0  # nodata and saturated pixels do not count towards the percentiles
+        counted[65535] = 0
+        p_low = _histogram_percentile(counted, low)
+        cloud_cut_low = _histogram_percentile(counted, 100 - (coverage * 3 / 4))
+
+        # The upper range spans the values actually present, saturated pixels only when there are any
+        high_values = numpy.flatnonzero(hist[int(numpy.ceil(cloud_cut_low)):]) + int(numpy.ceil(cloud_cut_low))
+        return {'p_low': p_low,
+                'cloud_cut_low': cloud_cut_low,
+                'cloud_divide': 65000 - coverage * 100,
+                'high_range': (high_values.min(), high_values.max()) if len(high_values) else None}
+
+    def _stretch_lut(self, params):
+        """ Evaluates the piecewise stretch (and the uint16 to uint8 step) once for every uint16 value.
+        Matches rescale_intensity followed by img_as_ubyte, so a band only needs a single lookup.
+        """
+        values = numpy.arange(65536, dtype=numpy.float64)
+        stretched = numpy.zeros(65536, dtype=numpy.uint16)
 
-        return self._write_to_file(new_bands, **rasterio_options)
+        low = numpy.logical_and(values < params['cloud_cut_low'], values > 0)
+        in_low, in_high = params['p_low'], params['cloud_cut_low']
+        scaled = (numpy.clip(values[low], in_low, in_high) - in_low) / float(in_high - in_low)
+        stretched[low] = (scaled * (params['cloud_divide'] - 256) + 256).astype(numpy.uint16)
 
+        high = values >= params['cloud_cut_low']
+        if params['high_range'] is not None:
+            in_low, in_high = params['high_range']
+            scaled = (numpy.clip(values[high], in_low, in_high) - in_low) / float(in_high - in_low)
+            stretched[high] = (scaled * (65535 - params['cloud_divide']) + params['cloud_divide']).astype(numpy.uint16)
 
-class PanSharpen(Processing):
+        return (stretched >> 8).astype(numpy.uint8)
 
-    def __init__(self, scene, bands, satellite):
-        super(PanSharpen, self).__init__(scene, bands, satellite)
-        self.band8 = self.bands[3]
+    def _run_windowed(self):
+        """ Reads, reprojects, colour-corrects and writes one window at a time.
+        Stretch parameters come from a first statistics pass over the source bands.
+        """
+        image_data = self._get_image_data()
+        coverage = self._stretch_coverage()
+        sources = [rasterio.open(band) for band in self.bands_path]
+        quality_output = None
+        if self.quality_file:
+            quality_output = rasterio.open(self.quality_file, 'w', **self._quality_options(image_data))
+
+        luts = []
+        for i, src in enumerate(sources):
+            print "Collecting statistics for band " + self.bands[i]
+            with instrument.stage("statistics", band=self.bands[i]):
+                luts.append(self._stretch_lut(self._stretch_params(self._band_histogram(src), 0, coverage)))
+
+        with rasterio.open(self.output_file, 'w', **self._output_options(image_data)) as output, \
+                instrument.stage("windows", budget=self.memory_budget):
+            output.update_tags(CLOUD_COVER=str(self.cloud_cover))
+            for window in self._blocks(image_data['shape']):
+                (row_start, row_stop), (col_start, col_stop) = window
+                dst_transform = window_transform(image_data['dst_transform'], window)
+                shape = (row_stop - row_start, col_stop - col_start)
+                masked = None
+                if self.quality:
+                    classes = self.quality.classes(dst_transform, self.dst_crs, shape)
+                    masked = (classes & self.quality.bits) != 0
+                    if quality_output:
+                        quality_output.write_band(1, classes, window=window)
+                for i, src in enumerate(sources):
+                    block = warp_window(src, numpy.zeros(shape, dtype=numpy.uint16), image_data['dst_transform'],
+                                        self.dst_crs, image_data['shape'], window, threads=self.warp_threads)
+                    if masked is not None:
+                        block[masked] = 0
+                    output.write_band(i + 1, luts[i][block], window=window)
+
+        for src in sources:
+            src.close()
+        if quality_output:
+            quality_output.close()
+        with instrument.stage("finalize", output_format=self.output_format):
+            cog.finalize(self.output_file, self.output_format, self.compress)
+        print "This file is saved to " + self.output_file
+        return self.output_file
 
+    @instrument.timed
     def run(self):
-        """ Executes the pansharpen image processing.
+        """ Executes the image processing.
         :returns:
             (String) the path to the processed image
         """
 
-        print 'PanSharpened Image processing started for bands'
-
+        print 'Image processing started for scene ' + self.scene + " and bands " + self.bands_values
 
-        bands = self._read_bands()
+        if self.memory_budget:
+            return self._run_windowed()
 
         image_data = self._get_image_data()
-
         new_bands = self._generate_new_bands(image_data['shape'])
+        self._warp(image_data, self.bands_path, new_bands)
+        self._apply_quality(new_bands, image_data)
 
-        bands[:3] = self._rescale(bands[:3])
-        new_bands.append(numpy.empty(image_data['shape'], dtype=numpy.uint16))
+        return self._write_to_file(new_bands, **self._output_options(image_data))
 
-        self._warp(image_data, bands, new_bands)
-
-        # Bands are no longer needed
-        del bands
-
-        # Calculate pan band
-        pan = self._pansize(new_bands)
-        del self.bands[3]
-        del new_bands[3]
-
-        rasterio_options = {
-            'driver': 'GTiff',
-            'width': image_data['shape'][1],
-            'height': image_data['shape'][0],
-            'count': 3,
-            'dtype': numpy.uint8,
-            'nodata': 0,
-            'transform': image_data['dst_transform'],
-            'photometric': 'RGB',
-            'crs': self.dst_crs
-        }
-
-        return self._write_to_file(new_bands, pan, **rasterio_options)
 
+class PanSharpen(Processing):
 
-    def _write_to_file(self, new_bands, pan, **kwargs):
+    stage = "pansharpen"
 
-        # Read coverage from QBA
-        coverage = self._calculate_cloud_ice_perc()
-
-        print"Final Steps"
+    def __init__(self, scene, bands, satellite, **kwargs):
+        super(PanSharpen, self).__init__(scene, bands, satellite, **kwargs)
+        self.band8 = self.bands[3]
 
-        output = rasterio.open(self.output_file, 'w', **kwargs)
+    @instrument.timed
+    def run(self):
+        """ Executes the pansharpen image processing.
+        :returns:
+            (String) the path to the processed image
+        """
 
-        for i, band in enumerate(new_bands):
-            print "started final step for " + str(i)
-            # Color Correction
-            band = numpy.multiply(band, pan)
-            band = self._color_correction(band, self.bands[i], 0, coverage)
+        print 'PanSharpened Image processing started for bands'
 
-            output.write_band(i + 1, img_as_ubyte(band))
+        # The pan band is last, so the destination grid is already at 15m
+        image_data = self._get_image_data()
 
-            new_bands[i] = None
+        new_bands = self._generate_new_bands(image_data['shape'])
+        new_bands.append(numpy.empty(image_data['shape'], dtype=numpy.uint16))
 
-        print "Writing to file"
+        # Upsample RGB straight onto the pan grid while reprojecting
+        self._warp(image_data, self.bands_path, new_bands, [RESAMPLING.bilinear] * 3 + [RESAMPLING.nearest])
 
-        return self.output_file
+        with instrument.stage("brovey"):
+            self._brovey(new_bands)
+        del self.bands[3]
+        del new_bands[3]
+        self._apply_quality(new_bands, image_data)
 
-    def _pansize(self, bands):
+        return self._write_to_file(new_bands, **self._output_options(image_data))
 
+    def _brovey(self, bands):
+        """ Sharpens the RGB bands in place with the pan band: band * pan / (red + green + blue).
+        The ratio is computed in float32 one row window at a time.
+        """
         print 'Calculating Pan Ratio'
 
-        m = numpy.add(bands[0], bands[1])
-        m = numpy.add(m, bands[2])
-        pan = numpy.multiply(numpy.nan_to_num(numpy.true_divide(1, m)), bands[3])
-        return pan
-
-    def _rescale(self, bands):
-        """ Rescale bands """
-        # self.output("Rescaling", normal=True, arrow=True)
-
-        for key, band in enumerate(bands):
-            print "processing"
-            # self.output("band %s" % self.bands[key], normal=True, color='green', indent=1)
-            bands[key] = sktransform.rescale(band, 2)
-            bands[key] = (bands[key] * 65535).astype('uint16')
-
-        return bands
+        for window in self._windows(bands[3].shape):
+            rows = slice(*window[0])
+            total = bands[0][rows].astype(numpy.float32)
+            total += bands[1][rows]
+            total += bands[2][rows]
+            ratio = numpy.zeros_like(total)
+            numpy.divide(bands[3][rows], total, out=ratio, where=total > 0)
+            for band in bands[:3]:
+                sharpened = numpy.multiply(band[rows], ratio, out=total)
+                numpy.clip(sharpened, 0, 65535, out=sharpened)
+                band[rows] = sharpened
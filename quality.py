@@ -0,0 +1,119 @@
+import os
+import threading
+import numpy
+import rasterio
+from affine import Affine
+from rasterio.features import rasterize
+from rasterio.warp import reproject, RESAMPLING, transform_geom
+from utils import crs_key
+
+
+# Quality classes, one bit each, as stored in the optional quality band
+FILL = 1
+CLOUD = 2
+SHADOW = 4
+SNOW = 8
+CIRRUS = 16
+FLAGS = {'fill': FILL, 'cloud': CLOUD, 'shadow': SHADOW, 'snow': SNOW, 'cirrus': CIRRUS}
+DEFAULT_FLAGS = ("cloud", "shadow", "cirrus")
+
+# First bit of the two-bit confidence of each class in the Landsat 8 BQA band.
+# Pre-collection scenes (LC8...LGN00) reserve the cloud shadow bits without filling them.
+BQA_LAYOUTS = {
+    "pre-collection": {CLOUD: 14, CIRRUS: 12, SNOW: 10},
+    "collection": {CLOUD: 5, SHADOW: 7, SNOW: 9, CIRRUS: 11},
+}
+HIGH_CONFIDENCE = 3
+SENTINEL_MASK = "MSK_CLOUDS_B00.gml"
+SENTINEL_CLASSES = {"OPAQUE": CLOUD, "CIRRUS": CIRRUS}
+
+_luts = {}
+_polygons = {}  # (gml, mtime, crs) -> [(geometry, quality class)]
+_lock = threading.Lock()
+
+
+def parse_flags(flags):
+    """ Quality class bits for "cloud,shadow" or a list of flag names """
+    if isinstance(flags, basestring):
+        flags = flags.split(",")
+    unknown = [flag for flag in flags if flag not in FLAGS]
+    if unknown:
+        raise ValueError("Unknown quality flags " + ", ".join(unknown) + "; use " + ", ".join(sorted(FLAGS)))
+    return reduce(lambda bits, flag: bits | FLAGS[flag], flags, 0)
+
+
+def bqa_layout(scene):
+    return "collection" if scene.startswith("LC08_") else "pre-collection"
+
+
+def bqa_lut(layout):
+    """ Quality classes of every possible BQA value, decoded once with vectorized bit operations """
+    with _lock:
+        if layout not in _luts:
+            values = numpy.arange(65536, dtype=numpy.uint32)
+            classes = (values & 1).astype(numpy.uint8)  # bit 0 is designated fill
+            for quality_class, bit in BQA_LAYOUTS[layout].items():
+                classes[((values >> bit) & 3) >= HIGH_CONFIDENCE] |= quality_class
+            _luts[layout] = classes
+        return _luts[layout]
+
+
+def _affine(transform):
+    return transform if isinstance(transform, Affine) else Affine.from_gdal(*transform)
+
+
+class QualityMask(object):
+    'Per-pixel quality classes of a scene (Landsat BQA band or Sentinel cloud mask) on any grid'
+
+    def __init__(self, scene, satellite, scene_path, flags=DEFAULT_FLAGS):
+        self.scene = scene
+        self.satellite = satellite
+        self.bits = parse_flags(flags)
+        if satellite == "landsat":
+            self.path = scene_path + scene + "_BQA.TIF"
+        else:
+            self.path = scene_path + SENTINEL_MASK
+
+    def available(self):
+        return os.path.isfile(self.path)
+
+    def classes(self, transform, crs, shape):
+        """ Quality classes (uint8 bit flags) of every pixel of a grid """
+        if self.satellite == "landsat":
+            bqa = numpy.zeros(shape, dtype=numpy.uint16)
+            with rasterio.open(self.path) as src:
+                # Nearest neighbour keeps the BQA values intact, so they can be decoded afterwards
+                reproject(rasterio.band(src, 1), bqa, dst_transform=transform, dst_crs=crs,
+                          resampling=RESAMPLING.nearest)
+            return bqa_lut(bqa_layout(self.scene))[bqa]
+
+        classes = numpy.zeros(shape, dtype=numpy.uint8)
+        for quality_class in set(SENTINEL_CLASSES.values()):
+            shapes = [geometry for geometry, polygon_class in self._polygons(crs) if polygon_class == quality_class]
+            if shapes:
+                classes |= rasterize(shapes, out_shape=shape, transform=_affine(transform), fill=0,
+                                     default_value=quality_class, dtype=numpy.uint8)
+        return classes
+
+    def read(self, transform, crs, shape):
+        """ True where a pixel has one of the selected quality classes """
+        return (self.classes(transform, crs, shape) & self.bits) != 0
+
+    def _polygons(self, crs):
+        """ Cloud polygons of the Sentinel mask in crs; a clear tile has an empty mask file """
+        import fiona
+
+        key = (self.path, os.path.getmtime(self.path), crs_key(crs))
+        with _lock:
+            if key not in _polygons:
+                polygons = []
+                try:
+                    with fiona.open(self.path) as src:
+                        for feature in src:
+                            quality_class = SENTINEL_CLASSES.get(feature['properties'].get('maskType'))
+                            if quality_class is not None and feature['geometry'] is not None:
+                                polygons.append((transform_geom(src.crs, crs, feature['geometry']), quality_class))
+                except (IOError, ValueError):
+                    pass
+                _polygons[key] = polygons
+            return _polygons[key]
@@ -0,0 +1,279 @@
+"""Long-running opensat job server.
+
+    $ python opensat.py serve --port 8470 --process-workers 4
+
+Jobs are posted as JSON and run in warm worker processes:
+
+    $ curl -X POST localhost:8470/jobs -d '{"kind": "download", "params": {"scene": "LC80020252016253LGN00", "bands": "2,3,4"}}'
+    $ curl localhost:8470/jobs/<id>
+
+Kinds and params follow the library API: download (scene, bands, checksum, aoi, quality, ingest),
+process (scene, bands, mask and Processing options) and mask (input_file, shapefile).
+The queue lives in ~/openasat/jobs.db (or $OPENSAT_HOME/jobs.db), so queued jobs survive a restart.
+A job that is already done runs again when its result files are gone, or when it is posted with "force": true.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from utils import WorkerWatch, bcolors, data_root
+
+
+KINDS = ("download", "process", "mask")
+POLL_INTERVAL = 0.5  # seconds between looks at the queue when it is idle
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    scene TEXT,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created);
+"""
+
+_session = None  # one pooled HTTP session per worker process
+
+
+def run_job(kind, params):
+    """ Runs one job inside a worker process; never raises so the server always hears back """
+    global _session
+    import opensat
+    from downloader import pooled_session
+
+    try:
+        if kind == "download":
+            if _session is None:
+                _session = pooled_session(8)
+            result = opensat.download(params["scene"], params.get("bands"), params.get("workers", 4),
+                                      params.get("checksum"), params.get("aoi"), session=_session,
+                                      quality=params.get("quality", False), ingest=params.get("ingest", False))
+        elif kind == "process":
+            options = dict((key, value) for key, value in params.items() if key not in ("scene", "bands", "mask"))
+            result = opensat.process(params["scene"], params["bands"], params.get("mask"), **options)
+        else:
+            result = opensat.mask(params["input_file"], params["shapefile"])
+        return True, result
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _native(value):
+    """ json gives unicode strings, which GDAL paths do not accept under Python 2 """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, dict):
+        return dict((_native(key), _native(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_native(item) for item in value]
+    return value
+
+
+def result_paths(value):
+    """ The file paths in a job result: a path or a (nested) list of paths """
+    if isinstance(value, basestring):
+        return [value]
+    if isinstance(value, list):
+        return [path for item in value for path in result_paths(item)]
+    return []
+
+
+def job_id(kind, params):
+    """ Identical jobs get the same id, which is how duplicates are detected """
+    return hashlib.sha1(kind + json.dumps(params, sort_keys=True)).hexdigest()[:16]
+
+
+class JobStore(object):
+    'SQLite-backed job queue shared by the HTTP handlers and the dispatcher'
+
+    def __init__(self, path=None):
+        if path is None:
+            directory = data_root()
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            path = directory + "jobs.db"
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        with self.lock, self.db:
+            # Jobs cut off by a restart are run again
+            self.db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+
+    def submit(self, kind, params, force=False):
+        """ Queues a job unless an identical one is queued, running or done.
+        Failed jobs are retried, and done jobs too when force is set or a file of their result is gone.
+        """
+        if kind not in KINDS:
+            raise ValueError("Unknown job kind " + str(kind))
+        identifier = job_id(kind, params)
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute("SELECT status, result FROM jobs WHERE id = ?", (identifier,)).fetchone()
+            if row is None:
+                self.db.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, 'queued', NULL, NULL, ?, ?)",
+                                (identifier, kind, json.dumps(params), params.get("scene"), now, now))
+            elif row["status"] == "failed" or (row["status"] == "done" and (force or self._missing(row["result"]))):
+                self.db.execute("UPDATE jobs SET status = 'queued', result = NULL, error = NULL, updated = ? "
+                                "WHERE id = ?", (now, identifier))
+        return self.get(identifier)
+
+    def _missing(self, result):
+        """ True when a file of a done job's result no longer exists """
+        paths = result_paths(json.loads(result)) if result else []
+        return any(not os.path.exists(path) for path in paths)
+
+    def get(self, identifier):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (identifier,)).fetchone()
+        return self._record(row) if row is not None else None
+
+    def list(self, status=None):
+        with self.lock:
+            if status is None:
+                rows = self.db.execute("SELECT * FROM jobs ORDER BY created").fetchall()
+            else:
+                rows = self.db.execute("SELECT * FROM jobs WHERE status = ? ORDER BY created", (status,)).fetchall()
+        return [self._record(row) for row in rows]
+
+    def claim(self):
+        """ Marks the oldest queued job as running, skipping scenes another running job is writing to """
+        with self.lock, self.db:
+            busy = set(row[0] for row in self.db.execute("SELECT scene FROM jobs WHERE status = 'running'"))
+            for row in self.db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY created").fetchall():
+                if row["scene"] is None or row["scene"] not in busy:
+                    self.db.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?",
+                                    (time.time(), row["id"]))
+                    return self._record(row)
+        return None
+
+    def finish(self, identifier, ok, value):
+        with self.lock, self.db:
+            if ok:
+                self.db.execute("UPDATE jobs SET status = 'done', result = ?, updated = ? WHERE id = ?",
+                                (json.dumps(value), time.time(), identifier))
+            else:
+                self.db.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                                (value, time.time(), identifier))
+
+    def _record(self, row):
+        return {'id': row["id"], 'kind': row["kind"], 'params': _native(json.loads(row["params"])), 'status': row["status"],
+                'result': json.loads(row["result"]) if row["result"] else None, 'error': row["error"],
+                'created': row["created"], 'updated': row["updated"]}
+
+
+class JobServer(ThreadingMixIn, HTTPServer):
+    'Local HTTP API in front of a JobStore and a pool of warm worker processes'
+
+    daemon_threads = True
+
+    def __init__(self, port=8470, workers=2, store=None, host="127.0.0.1", runner=run_job):
+        # Fork the workers before any server or dispatcher thread exists
+        self.watched = WorkerWatch()
+        self.pool = self.watched.pool(workers)
+        self.workers = workers
+        self.runner = runner
+        self.store = store or JobStore()
+        self.slots = threading.Semaphore(workers)
+        self.running = True
+        HTTPServer.__init__(self, (host, port), JobHandler)
+
+    def dispatch(self):
+        """ Hands queued jobs to the worker pool, at most one per worker """
+        while self.running:
+            self.slots.acquire()
+            job = self.store.claim()
+            if job is None:
+                self.slots.release()
+                time.sleep(POLL_INTERVAL)
+                continue
+            print "Starting " + job["kind"] + " job " + job["id"]
+            self.watched.apply_async(self.pool, job["id"], self.runner, (job["kind"], job["params"]),
+                                     callback=lambda result, job=job: self._done(job, result))
+
+    def watch(self):
+        """ Fails the jobs of workers that died, e.g. killed for memory. The pool replaces the
+        worker but never calls back for its job, which would keep the job running and its slot taken.
+        """
+        while self.running:
+            time.sleep(POLL_INTERVAL)
+            for identifier in self.watched.dead(self.pool):
+                self._finish(self.store.get(identifier), (False, "The worker process running the job died"))
+
+    def _done(self, job, result):
+        if self.watched.finished(job["id"]):  # else already failed by watch
+            self._finish(job, result)
+
+    def _finish(self, job, result):
+        ok, value = result
+        self.store.finish(job["id"], ok, value)
+        if ok:
+            print bcolors.OKGREEN + "Finished " + job["kind"] + " job " + job["id"] + bcolors.ENDC
+        else:
+            print bcolors.FAIL + "Failed " + job["kind"] + " job " + job["id"] + "\n" + value + bcolors.ENDC
+        self.slots.release()
+
+    def run(self):
+        dispatcher = threading.Thread(target=self.dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+        watcher = threading.Thread(target=self.watch)
+        watcher.daemon = True
+        watcher.start()
+        print "opensat job server listening on http://%s:%d" % self.server_address
+        try:
+            self.serve_forever()
+        finally:
+            self.running = False
+            watcher.join()
+            self.pool.terminate()
+            self.pool.join()
+
+
+class JobHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("?")[0].split("/")
+        if parts == ["jobs"]:
+            status = self.path.split("status=")[1].split("&")[0] if "status=" in self.path else None
+            self._reply(200, self.server.store.list(status))
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self.server.store.get(parts[1])
+            self._reply(200 if job else 404, job or {'error': "no such job"})
+        else:
+            self._reply(404, {'error': "unknown path"})
+
+    def do_POST(self):
+        if self.path.strip("/") != "jobs":
+            return self._reply(404, {'error': "unknown path"})
+        try:
+            body = _native(json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0)))))
+            job = self.server.store.submit(body["kind"], body.get("params", {}), bool(body.get("force")))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._reply(400, {'error': str(e)})
+        self._reply(202, job)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8470, workers=2):
+    JobServer(port, workers).run()
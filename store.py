@@ -0,0 +1,234 @@
+import contextlib
+import json
+import os
+import sqlite3
+import time
+from cache import MANIFEST_NAME, Manifest, band_name
+from utils import bcolors, data_root
+
+
+# Downloaded band files, the only files the store ever evicts
+RAW_EXTENSIONS = (".TIF", ".tif", ".jp2")
+SATELLITES = ("landsat", "sentinel")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS access (
+    path TEXT PRIMARY KEY,
+    last_access REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pins (
+    scene TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (scene, pid)
+);
+"""
+
+
+def quota_from_env():
+    """ Quota in bytes from OPENSAT_QUOTA (in GB), None when it is not set """
+    quota = os.environ.get("OPENSAT_QUOTA")
+    return int(float(quota) * 1024 ** 3) if quota else None
+
+
+def human_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
+
+
+def manifest_directories(scene_path):
+    """ Directories of a scene holding outputs with a manifest """
+    return [directory for directory, _, files in os.walk(scene_path) if MANIFEST_NAME in files]
+
+
+def used_bands(scene_path):
+    """ Names of the bands read by the outputs of a scene that still exist, from the manifests next to them """
+    bands = set()
+    for directory in manifest_directories(scene_path):
+        try:
+            with open(os.path.join(directory, MANIFEST_NAME)) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            continue
+        for output, entry in entries.items():
+            if os.path.isfile(os.path.join(directory, output)):
+                bands.update(band_name(name) for name in entry.get('inputs', {}))
+    return bands
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class SceneStore(object):
+    'Tracks access to the scene files under the data root and evicts least recently used raw bands over a quota'
+
+    def __init__(self, root=None, quota=None):
+        self.root = os.path.join(root or data_root(), "")
+        self.quota = quota if quota is not None else quota_from_env()  # bytes, None for no limit
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        # Downloads, workers and the gc command share the database, so wait for each other's writes
+        self.db = sqlite3.connect(self.root + "store.db", timeout=60)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(pins)")]
+        if columns and "count" not in columns:
+            # Pins only live as long as their process, so the old table can go
+            with self.db:
+                self.db.execute("DROP TABLE pins")
+        self.db.executescript(SCHEMA)
+
+    def touch(self, paths):
+        """ Records that files were just written or read """
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO access VALUES (?, ?)",
+                                [(os.path.abspath(path), now) for path in paths if path])
+
+    @contextlib.contextmanager
+    def pin(self, scene):
+        """ Keeps the files of a scene from being evicted while it is downloaded or processed.
+        Pins nest: the scene stays pinned until the outermost pin of the process is released.
+        """
+        self.acquire(scene)
+        try:
+            yield
+        finally:
+            self.release(scene)
+
+    def acquire(self, scene):
+        """ Pins a scene until release, for pins that do not fit in a with block """
+        key = (scene, os.getpid())
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO pins VALUES (?, ?, 0)", key)
+            self.db.execute("UPDATE pins SET count = count + 1 WHERE scene = ? AND pid = ?", key)
+
+    def release(self, scene):
+        key = (scene, os.getpid())
+        with self.db:
+            self.db.execute("UPDATE pins SET count = count - 1 WHERE scene = ? AND pid = ?", key)
+            self.db.execute("DELETE FROM pins WHERE scene = ? AND pid = ? AND count <= 0", key)
+
+    def pinned(self):
+        """ Scenes used by a live process or by a queued or running job of the job server """
+        scenes = set()
+        for scene, pid in self.db.execute("SELECT scene, pid FROM pins").fetchall():
+            if _alive(pid):
+                scenes.add(scene)
+            else:
+                with self.db:
+                    self.db.execute("DELETE FROM pins WHERE scene = ? AND pid = ?", (scene, pid))
+        if os.path.isfile(self.root + "jobs.db"):
+            jobs = sqlite3.connect(self.root + "jobs.db", timeout=60)
+            try:
+                scenes.update(row[0] for row in jobs.execute("SELECT scene FROM jobs WHERE status IN ('queued', 'running')")
+                              if row[0] is not None)
+            except sqlite3.OperationalError:
+                pass
+            finally:
+                jobs.close()
+        return scenes
+
+    def scenes(self):
+        """ Every scene directory in the store.
+        :returns:
+            (List) dicts with satellite, scene, path, raw and processed sizes, the raw files, the bands
+            its outputs were made from and last access
+        """
+        last_access = dict(self.db.execute("SELECT path, last_access FROM access").fetchall())
+        scenes = []
+        for satellite in SATELLITES:
+            satellite_path = self.root + satellite + "/"
+            if not os.path.isdir(satellite_path):
+                continue
+            for scene in sorted(os.listdir(satellite_path)):
+                scene_path = satellite_path + scene + "/"
+                if not os.path.isdir(scene_path):
+                    continue
+                info = {'satellite': satellite, 'scene': scene, 'path': scene_path,
+                        'raw': 0, 'processed': 0, 'other': 0, 'raw_files': [], 'last_access': 0}
+                for directory, _, files in os.walk(scene_path):
+                    for name in files:
+                        path = os.path.join(directory, name)
+                        size = os.path.getsize(path)
+                        accessed = last_access.get(os.path.abspath(path), os.path.getmtime(path))
+                        info['last_access'] = max(info['last_access'], accessed)
+                        if directory.startswith(scene_path + "processed"):
+                            info['processed'] += size
+                        elif name.endswith(RAW_EXTENSIONS):
+                            info['raw'] += size
+                            info['raw_files'].append((accessed, path, size))
+                        else:
+                            info['other'] += size
+                info['used_bands'] = used_bands(scene_path)
+                scenes.append(info)
+        return scenes
+
+    def usage(self, scenes=None):
+        scenes = scenes if scenes is not None else self.scenes()
+        return sum(info['raw'] + info['processed'] + info['other'] for info in scenes)
+
+    def gc(self, quota=None):
+        """ Deletes least recently used raw bands of unpinned scenes until usage fits the quota.
+        Only bands that an existing output was made from are evicted, so a band downloaded
+        for a product that was not made yet stays. The manifests note the evicted bands,
+        so their outputs stay up to date without them.
+        :returns:
+            (List) paths of the deleted files
+        """
+        quota = quota if quota is not None else self.quota
+        if quota is None:
+            return []
+        scenes = self.scenes()
+        usage = self.usage(scenes)
+        if usage <= quota:
+            return []
+
+        pinned = self.pinned()
+        candidates = sorted(raw_file + (info['path'],) for info in scenes if info['scene'] not in pinned
+                            for raw_file in info['raw_files']
+                            if band_name(os.path.basename(raw_file[1])) in info['used_bands'])
+        deleted = []
+        evicted = {}  # scene path -> names of its deleted bands
+        for accessed, path, size, scene_path in candidates:
+            if usage <= quota:
+                break
+            os.remove(path)
+            with self.db:
+                self.db.execute("DELETE FROM access WHERE path = ?", (os.path.abspath(path),))
+            usage -= size
+            deleted.append(path)
+            evicted.setdefault(scene_path, []).append(os.path.basename(path))
+        for scene_path, names in evicted.items():
+            for directory in manifest_directories(scene_path):
+                Manifest(directory).evicted(names)
+        print bcolors.OKGREEN + "Evicted " + str(len(deleted)) + " raw band files, the store now uses " + \
+            human_size(usage) + bcolors.ENDC
+        if usage > quota:
+            print bcolors.WARNING + "The store is still over its quota of " + human_size(quota) + \
+                "; the rest is processed output, metadata or pinned scenes" + bcolors.ENDC
+        return deleted
+
+    def print_stats(self):
+        scenes = self.scenes()
+        print bcolors.OKGREEN + "===== Scene store: " + self.root + " =====" + bcolors.ENDC + "\n"
+        for satellite in SATELLITES:
+            satellite_scenes = [info for info in scenes if info['satellite'] == satellite]
+            if not satellite_scenes:
+                continue
+            print satellite + ": " + str(len(satellite_scenes)) + " scenes, " + human_size(self.usage(satellite_scenes))
+            for info in sorted(satellite_scenes, key=lambda info: info['last_access'], reverse=True):
+                print "  " + info['scene'] + "  raw " + human_size(info['raw']) + \
+                    "  processed " + human_size(info['processed']) + \
+                    "  last used " + time.strftime("%Y-%m-%d %H:%M", time.localtime(info['last_access']))
+        quota = " of " + human_size(self.quota) if self.quota is not None else " (no quota)"
+        print "\nTotal: " + human_size(self.usage(scenes)) + quota
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,102 @@
+""" Local HTTP file server with Range support for the download tests """
+import os
+import re
+import socket
+import struct
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def do_GET(self):
+        self._respond(body=True)
+
+    def _respond(self, body):
+        name = self.path.split("?")[0].lstrip("/")
+        self.server.log.append((self.command, name, self.headers.get("Range")))
+        if name in self.server.errors:
+            self.server.errors[name] -= 1
+            if self.server.errors[name] == 0:
+                del self.server.errors[name]
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        path = os.path.join(self.server.directory, name)
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+
+        start, stop = 0, len(data)
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */" + str(len(data)))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if match.group(2):
+                stop = min(stop, int(match.group(2)) + 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, stop - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(stop - start))
+        self.end_headers()
+        if not body:
+            return
+
+        if name in self.server.resets:
+            # Send half of the body, then reset the connection
+            self.server.resets.discard(name)
+            self.wfile.write(data[start:start + (stop - start) // 2])
+            self.wfile.flush()
+            time.sleep(0.2)  # let the client read what was sent
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:stop])
+
+
+class RangeServer(ThreadingMixIn, HTTPServer):
+    'Serves the files of a directory on a free local port'
+
+    daemon_threads = True
+
+    def __init__(self, directory):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), _Handler)
+        self.directory = directory
+        self.log = []  # (method, file name, Range header) of every request
+        self.resets = set()  # file names whose next GET is cut off halfway
+        self.errors = {}  # file name -> number of 503 answers before it is served
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def url(self, name):
+        return "http://127.0.0.1:%d/%s" % (self.server_address[1], name)
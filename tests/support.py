@@ -0,0 +1,21 @@
+""" Shared fixtures of the tests """
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TemporaryHomeTest(unittest.TestCase):
+    'Points OPENSAT_HOME at an empty directory for each test'
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix="opensat-test-")
+        self._saved_home = os.environ.get("OPENSAT_HOME")
+        os.environ["OPENSAT_HOME"] = self.home + "/openasat"
+
+    def tearDown(self):
+        if self._saved_home is None:
+            os.environ.pop("OPENSAT_HOME", None)
+        else:
+            os.environ["OPENSAT_HOME"] = self._saved_home
+        shutil.rmtree(self.home)
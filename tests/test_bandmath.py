@@ -0,0 +1,71 @@
+import unittest
+from multiprocessing.pool import ThreadPool
+import numpy
+import rasterio
+from bandmath import BandMath, INT_NODATA, expression_bands
+from benchmark import LANDSAT_SCENE, SENTINEL_SCENE, write_landsat_scene, write_sentinel_scene
+from support import TemporaryHomeTest
+from utils import bounded_imap, scene_directory
+
+
+class BandMathTest(TemporaryHomeTest):
+
+    def read(self, path):
+        with rasterio.open(path) as src:
+            return src.read(1)
+
+    def test_ndvi_matches_numpy(self):
+        write_landsat_scene(self.home, 300, "45")
+        scene_path = scene_directory("landsat", LANDSAT_SCENE)
+        red = self.read(scene_path + LANDSAT_SCENE + "_B4.TIF").astype(numpy.float32)
+        nir = self.read(scene_path + LANDSAT_SCENE + "_B5.TIF").astype(numpy.float32)
+        expected = (nir - red) / (nir + red)
+        expected[(red == 0) | (nir == 0)] = numpy.nan
+
+        # A small budget splits the scene into many blocks for three workers
+        index = BandMath(LANDSAT_SCENE, "ndvi", "landsat", workers=3, memory_budget=64 * 1024).run()
+        numpy.testing.assert_allclose(self.read(index), expected, rtol=1e-6)
+
+        scaled = self.read(BandMath(LANDSAT_SCENE, "NDVI", "landsat", "int16", workers=3).run())
+        valid = numpy.isfinite(expected)
+        self.assertTrue((scaled[~valid] == INT_NODATA).all())
+        self.assertLessEqual(numpy.abs(scaled[valid] - expected[valid] * 10000).max(), 0.5 + 1e-3)
+
+    def test_coarser_bands_are_read_on_the_finest_grid(self):
+        write_sentinel_scene(self.home, 240, bands=("04", "8A"))
+        scene_path = scene_directory("sentinel", SENTINEL_SCENE)
+        index = self.read(BandMath(SENTINEL_SCENE, "B8A-B04", "sentinel", workers=2).run())
+        red = self.read(scene_path + "B04.jp2").astype(numpy.float32)
+        nir = self.read(scene_path + "B8A.jp2").astype(numpy.float32).repeat(2, 0).repeat(2, 1)
+        valid = (red > 0) & (nir > 0)
+        self.assertEqual(index.shape, (240, 240))
+        numpy.testing.assert_array_equal(index[valid], (nir - red)[valid])
+
+    def test_expression_bands(self):
+        self.assertEqual(expression_bands("nbr", "sentinel"), ["12", "8A"])
+        self.assertEqual(expression_bands("(B5-B4)/(B5+B4)", "landsat"), ["4", "5"])
+
+
+class BoundedImapTest(unittest.TestCase):
+
+    def test_at_most_limit_blocks_wait_for_the_writer(self):
+        submitted = []
+
+        def blocks():
+            for block in range(50):
+                submitted.append(block)
+                yield block
+
+        pool = ThreadPool(4)
+        try:
+            for written, result in enumerate(bounded_imap(pool, abs, blocks(), 6)):
+                self.assertEqual(result, written)
+                self.assertLessEqual(len(submitted) - written, 6)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(len(submitted), 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Pool
+import cache
+
+
+def record_outputs(job):
+    directory, worker = job
+    for index in range(20):
+        output_file = os.path.join(directory, "out_%d_%d.TIF" % (worker, index))
+        with open(output_file, "w") as f:
+            f.write("pixels")
+        cache.Manifest(directory).record(output_file, "key", "stack", [], {})
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_concurrent_writers_keep_every_entry(self):
+        pool = Pool(4)
+        try:
+            pool.map(record_outputs, [(self.directory, worker) for worker in range(4)])
+        finally:
+            pool.close()
+            pool.join()
+        with open(os.path.join(self.directory, cache.MANIFEST_NAME)) as f:
+            self.assertEqual(len(json.load(f)), 80)
+        self.assertEqual([name for name in os.listdir(self.directory) if name.endswith(".part")], [])
+
+    def test_version_change_makes_outputs_stale(self):
+        output_file = os.path.join(self.directory, "out.TIF")
+        built = []
+
+        def build():
+            built.append(1)
+            with open(output_file, "w") as f:
+                f.write("pixels")
+            return output_file
+
+        cache.cached("stack", output_file, [], {}, build)
+        cache.cached("stack", output_file, [], {}, build)
+        self.assertEqual(len(built), 1)
+        version = cache.PROCESSING_VERSION
+        cache.PROCESSING_VERSION = version + 1
+        try:
+            cache.cached("stack", output_file, [], {}, build)
+        finally:
+            cache.PROCESSING_VERSION = version
+        self.assertEqual(len(built), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import catalog
+import opensat
+from catalog import Catalog
+
+
+class _API(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        limit, page = int(query["limit"][0]), int(query["page"][0])
+        if self.server.ignore_paging:
+            page = 1
+        body = {'results': self.server.scenes[(page - 1) * limit:page * limit]}
+        if self.server.report_found:
+            body['meta'] = {'found': len(self.server.scenes)}
+        self.server.pages.append(page)
+        self.server.queries.append(query["search"][0])
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeAPITest(unittest.TestCase):
+    'Runs a catalog against a local stand-in for the developmentseed API'
+
+    page_size = 3
+
+    def setUp(self):
+        self.limit = catalog.API_LIMIT
+        catalog.API_LIMIT = self.page_size
+        self.start_server()
+        self.directory = tempfile.mkdtemp()
+        self.catalog = self.open_catalog()
+
+    def start_server(self):
+        self.server = HTTPServer(("127.0.0.1", 0), _API)
+        self.server.pages = []
+        self.server.queries = []
+        self.server.scenes = []
+        self.server.report_found = True
+        self.server.ignore_paging = False
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def open_catalog(self, ttl=catalog.DEFAULT_TTL):
+        return Catalog(self.directory + "/catalog.db", ttl,
+                       "http://127.0.0.1:%d/satellites" % self.server.server_address[1])
+
+    def tearDown(self):
+        catalog.API_LIMIT = self.limit
+        self.catalog.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def serve(self, count):
+        self.server.scenes = [{'scene_id': "scene%d" % index, 'date': "2016-08-%02d" % (index + 1),
+                               'cloud_coverage': float(index)} for index in range(count)]
+
+
+class PagingTest(FakeAPITest):
+
+    def request(self):
+        return [scene["scene_id"] for scene in self.catalog._request("cloudCoverage:[0+TO+5]")]
+
+    def test_pages_up_to_the_reported_total(self):
+        self.serve(7)
+        self.assertEqual(self.request(), ["scene%d" % index for index in range(7)])
+        self.assertEqual(self.server.pages, [1, 2, 3])
+
+    def test_pages_until_a_short_page_without_a_total(self):
+        self.server.report_found = False
+        self.serve(7)
+        self.assertEqual(len(self.request()), 7)
+        self.serve(6)
+        self.server.pages = []
+        self.assertEqual(len(self.request()), 6)
+        self.assertEqual(self.server.pages, [1, 2, 3])
+
+    def test_api_that_ignores_paging(self):
+        self.server.report_found = False
+        self.server.ignore_paging = True
+        self.serve(7)
+        self.assertRaises(ValueError, self.request)
+
+
+class SyncTest(FakeAPITest):
+
+    page_size = 100
+
+    def search(self, clouds=None, dates=None, catalog=None):
+        return [match["id"] for match in opensat.search("13,32", clouds, dates, catalog=catalog or self.catalog)]
+
+    def test_search_filters_the_stored_scenes(self):
+        self.serve(5)
+        self.assertEqual(self.search(), ["scene%d" % index for index in range(5)])
+        self.assertEqual(self.search(clouds=2), ["scene0", "scene1", "scene2"])
+        self.assertEqual(self.search(dates=("2016-08-01", "2016-08-04")), ["scene1", "scene2"])
+        # Only the first search asked the API, the others ran on the local catalog
+        self.assertEqual(len(self.server.queries), 1)
+
+    def test_stale_location_only_asks_for_newer_scenes(self):
+        self.serve(5)
+        self.search()
+        stale = self.open_catalog(ttl=0)
+        try:
+            self.search(catalog=stale)
+        finally:
+            stale.close()
+        self.assertEqual(len(self.server.queries), 2)
+        self.assertIn(" AND date:[2016-08-05 TO ", self.server.queries[1])
+
+    def test_unreachable_api_falls_back_to_the_catalog(self):
+        self.serve(3)
+        self.search()
+        stale = self.open_catalog(ttl=0)
+        self.server.shutdown()
+        self.server.server_close()
+        self.start_server()  # for tearDown; the catalog still asks the old port
+        try:
+            self.assertEqual(self.search(catalog=stale), ["scene0", "scene1", "scene2"])
+        finally:
+            stale.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
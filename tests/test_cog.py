@@ -0,0 +1,45 @@
+import unittest
+import numpy
+import rasterio
+from affine import Affine
+from benchmark import LANDSAT_SCENE, write_landsat_scene
+from cog import TILE_OFFSETS, _read_ifds, validate
+from processing import Processing
+from support import TemporaryHomeTest
+
+
+class CogTest(TemporaryHomeTest):
+
+    def write_plain(self, path, **options):
+        data = numpy.random.RandomState(0).randint(1, 255, (1, 1100, 1000)).astype(numpy.uint8)
+        with rasterio.open(path, 'w', driver='GTiff', width=1000, height=1100, count=1, dtype=numpy.uint8,
+                           crs={'init': 'epsg:3857'}, transform=Affine(10.0, 0.0, 0.0, 0.0, -10.0, 0.0),
+                           **options) as dst:
+            dst.write(data)
+        return path
+
+    def test_processed_cog_layout(self):
+        write_landsat_scene(self.home, 1200)
+        output_file = Processing(LANDSAT_SCENE, "432", "landsat", output_format="cog", compress="deflate").run()
+        self.assertEqual(validate(output_file), [])
+
+        with rasterio.open(output_file) as src:
+            self.assertEqual(src.block_shapes[0], (512, 512))
+            self.assertEqual(src.overviews(1), [2, 4])
+        with open(output_file, 'rb') as f:
+            ifds = list(_read_ifds(f))
+        self.assertEqual(len(ifds), 3)
+        # Every IFD comes before the first tile of image data
+        self.assertLess(max(offset for offset, _ in ifds), min(tags[TILE_OFFSETS] for _, tags in ifds))
+
+    def test_striped_geotiff_is_rejected(self):
+        path = self.write_plain(self.home + "/striped.TIF")
+        self.assertEqual(validate(path), ["image is not tiled"])
+
+    def test_tiled_geotiff_without_overviews_is_rejected(self):
+        path = self.write_plain(self.home + "/tiled.TIF", tiled=True, blockxsize=512, blockysize=512)
+        self.assertIn("image has no internal overviews", validate(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import numpy
+import rasterio
+from affine import Affine
+import quality
+from composite import Composite, nanpercentile, quality_file
+from support import TemporaryHomeTest
+
+
+CRS = {'init': 'epsg:32618'}
+TRANSFORM = Affine(10.0, 0.0, 500000.0, 0.0, -10.0, 4500000.0)
+
+
+class NanPercentileTest(unittest.TestCase):
+
+    def test_matches_numpy(self):
+        values = numpy.random.RandomState(0).uniform(0, 255, (7, 40, 30)).astype(numpy.float32)
+        values[numpy.random.RandomState(1).rand(*values.shape) < 0.3] = numpy.nan
+        values[:, 0, 0] = numpy.nan
+        for percentile in (0, 10, 50, 75.5, 100):
+            expected = numpy.nanpercentile(values, percentile, axis=0)
+            numpy.testing.assert_allclose(nanpercentile(values, percentile), expected, rtol=1e-5)
+
+
+class CompositeTest(TemporaryHomeTest):
+
+    def write(self, index, data, clouds, flagged=None):
+        path = "%s/scene%d_432.TIF" % (self.home, index)
+        with rasterio.open(path, 'w', driver='GTiff', width=data.shape[2], height=data.shape[1], count=3,
+                           dtype=numpy.uint8, nodata=0, crs=CRS, transform=TRANSFORM) as dst:
+            dst.write(data)
+            dst.update_tags(CLOUD_COVER=str(clouds))
+        if flagged is not None:
+            classes = numpy.where(flagged, quality.parse_flags("cloud"), 0).astype(numpy.uint16)
+            with rasterio.open(quality_file(path), 'w', driver='GTiff', width=data.shape[2], height=data.shape[1],
+                               count=1, dtype=numpy.uint16, crs=CRS, transform=TRANSFORM) as dst:
+                dst.write(classes, 1)
+        return path
+
+    def setUp(self):
+        TemporaryHomeTest.setUp(self)
+        rng = numpy.random.RandomState(2)
+        self.stack = rng.randint(1, 256, (5, 3, 600, 560)).astype(numpy.uint8)
+        self.stack[rng.rand(5, 600, 560)[:, numpy.newaxis].repeat(3, 1) < 0.2] = 0  # nodata in every band
+        self.stack[:, :, :4, :4] = 0  # no scene has data here
+        self.inputs = [self.write(index, scene, 10.0 * index) for index, scene in enumerate(self.stack)]
+
+    def composite(self, method, percentile=50):
+        output_file = Composite(self.inputs, self.home + "/composite.TIF", method, percentile, workers=2).run()
+        with rasterio.open(output_file) as src:
+            return src.read()
+
+    def assert_percentile(self, block, percentile):
+        """ Compares pixels spread over every block with numpy.percentile of the scenes with data there """
+        rng = numpy.random.RandomState(3)
+        for row, col in zip([0] + list(rng.randint(0, 600, 400)), [0] + list(rng.randint(0, 560, 400))):
+            for band in range(3):
+                values = self.stack[:, band, row, col]
+                values = values[values > 0]
+                expected = int(numpy.round(numpy.percentile(values.astype(numpy.float32), percentile))) if len(values) else 0
+                self.assertEqual(block[band, row, col], expected)
+
+    def test_median(self):
+        self.assert_percentile(self.composite("median"), 50)
+
+    def test_percentile(self):
+        for percentile in (10, 90):
+            self.assert_percentile(self.composite("percentile", percentile), percentile)
+
+    def test_best_prefers_clear_pixels_of_the_least_cloudy_scenes(self):
+        flagged = numpy.zeros((600, 560), dtype=bool)
+        flagged[100:200] = True
+        clear = numpy.full((3, 600, 560), 50, dtype=numpy.uint8)
+        cloudy = numpy.full((3, 600, 560), 200, dtype=numpy.uint8)
+        self.inputs = [self.write(5, cloudy, 40.0), self.write(6, clear, 1.0, flagged)]
+        block = self.composite("best")
+        self.assertTrue((block[:, :100] == 50).all())
+        self.assertTrue((block[:, 100:200] == 200).all())  # flagged in the clear scene
+        self.assertTrue((block[:, 200:] == 50).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+import rasterio
+from benchmark import LANDSAT_SCENE, write_landsat_scene, write_mask
+from downloader import AOIFetcher, Downloader
+from httpserver import RangeServer
+from support import TemporaryHomeTest
+
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.served = tempfile.mkdtemp()
+        self.directory = tempfile.mkdtemp()
+        self.data = os.urandom(3 * 1024 * 1024 + 123)
+        with open(os.path.join(self.served, "B4.TIF"), "wb") as f:
+            f.write(self.data)
+        self.server = RangeServer(self.served).start()
+        self.downloader = Downloader(workers=2, retries=4, backoff=0, timeout=10)
+        self.local_path = os.path.join(self.directory, "B4.TIF")
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.served)
+        shutil.rmtree(self.directory)
+
+    def download(self):
+        return self.downloader.run([self.server.url("B4.TIF")], self.directory)
+
+    def downloaded(self):
+        with open(self.local_path, "rb") as f:
+            return f.read()
+
+    def test_resumes_after_connection_reset(self):
+        self.server.resets.add("B4.TIF")
+        self.assertEqual(self.download(), [self.local_path])
+        self.assertEqual(self.downloaded(), self.data)
+        ranges = [header for method, name, header in self.server.log if method == "GET"]
+        self.assertEqual(ranges[0], None)
+        self.assertEqual(len(ranges), 2)
+        self.assertTrue(ranges[1].startswith("bytes=") and ranges[1] != "bytes=0-")
+        self.assertFalse(os.path.exists(self.local_path + ".part"))
+
+    def test_complete_part_file_is_kept_on_416(self):
+        with open(self.local_path + ".part", "wb") as f:
+            f.write(self.data)
+        self.assertEqual(self.download(), [self.local_path])
+        self.assertEqual(self.downloaded(), self.data)
+        self.assertEqual([header for _, _, header in self.server.log], ["bytes=%d-" % len(self.data)])
+        self.assertEqual(self.downloader.bytes_downloaded, 0)
+
+    def test_stale_part_file_with_a_different_size_is_downloaded_again(self):
+        with open(self.local_path + ".part", "wb") as f:
+            f.write(os.urandom(len(self.data) + 10))
+        self.assertEqual(self.download(), [self.local_path])
+        self.assertEqual(self.downloaded(), self.data)
+        self.assertEqual([header for _, _, header in self.server.log][-1], None)
+
+    def test_missing_file_fails_without_stopping_the_others(self):
+        paths = self.downloader.run([self.server.url("B5.TIF"), self.server.url("B4.TIF")], self.directory)
+        self.assertEqual(paths, [None, self.local_path])
+
+
+class AOIFetcherTest(TemporaryHomeTest):
+
+    def setUp(self):
+        TemporaryHomeTest.setUp(self)
+        write_landsat_scene(self.home, 400, "4")
+        self.mask = write_mask(self.home, "landsat", 400)
+        self.served = self.home + "/openasat/landsat/" + LANDSAT_SCENE + "/"
+        self.name = LANDSAT_SCENE + "_B4.TIF"
+        self.directory = self.home + "/aoi"
+        self.server = RangeServer(self.served).start()
+        self.fetcher = AOIFetcher(self.mask, downloader=Downloader(retries=3, backoff=0))
+
+    def tearDown(self):
+        self.server.stop()
+        TemporaryHomeTest.tearDown(self)
+
+    def fetch(self):
+        return self.fetcher.run([self.server.url(self.name)], self.directory)[0]
+
+    def test_reads_the_mask_window_with_range_requests(self):
+        path = self.fetch()
+        with rasterio.open(path) as aoi, rasterio.open(self.served + self.name) as full:
+            self.assertLess(aoi.width, full.width / 2 + 20)
+            column, row = ~full.affine * (aoi.affine.c, aoi.affine.f)
+            window = ((int(row), int(row) + aoi.height), (int(column), int(column) + aoi.width))
+            numpy.testing.assert_array_equal(aoi.read(1), full.read(1, window=window))
+        self.assertTrue(all(header for method, _, header in self.server.log if method == "GET"))
+
+    def test_retries_server_errors(self):
+        self.server.errors[self.name] = 2
+        self.assertIsNotNone(self.fetch())
+        self.assertNotIn(self.name, self.server.errors)
+
+    def test_gives_up_after_the_retries(self):
+        self.server.errors[self.name] = 10
+        self.assertIsNone(self.fetch())
+        self.assertEqual(self.server.errors[self.name], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
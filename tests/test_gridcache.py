@@ -0,0 +1,71 @@
+import shutil
+import tempfile
+import unittest
+from gridcache import GridCache, snap
+
+
+UTM18 = {'init': 'epsg:32618'}
+MERCATOR = {'init': 'epsg:3857'}
+# Source grids are rasterio affines (a, b, c, d, e, f); destination grids GDAL geotransforms
+SOURCE = (30.0, 0.0, 500000.0, 0.0, -30.0, 4500000.0)
+SHAPE = (1000, 1000)
+
+
+class SnapTest(unittest.TestCase):
+
+    def test_snaps_onto_the_reference_lattice(self):
+        reference = (-8500000.0, 38.2, 0.0, 5300000.0, 0.0, -38.2)
+        snapped = snap((-8499123.4, 38.25, 0.0, 5299001.7, 0.0, -38.25), reference)
+        self.assertEqual(snapped[1], 38.2)
+        self.assertEqual(snapped[5], -38.2)
+        for offset in ((snapped[0] - reference[0]) / 38.2, (snapped[3] - reference[3]) / 38.2):
+            self.assertAlmostEqual(offset, round(offset), places=6)
+        # The nearest lattice point, so the grid moves by half a pixel at most
+        self.assertLessEqual(abs(snapped[0] - -8499123.4), 38.2 / 2)
+        self.assertLessEqual(abs(snapped[3] - 5299001.7), 38.2 / 2)
+
+
+class GridCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.grids = GridCache(self.directory + "/grids.db")
+        self.computed = []
+
+    def tearDown(self):
+        self.grids.close()
+        shutil.rmtree(self.directory)
+
+    def grid(self, src_transform, dst_transform, dst_crs=MERCATOR):
+        def compute():
+            self.computed.append(dst_transform)
+            return dst_transform
+        return self.grids.grid(UTM18, src_transform, SHAPE, dst_crs, compute)
+
+    def test_seen_grid_is_not_computed_again(self):
+        first = (-8500000.0, 38.2, 0.0, 5300000.0, 0.0, -38.2)
+        self.assertEqual(self.grid(SOURCE, first), (first, False))
+        self.assertEqual(self.grid(SOURCE, None), (first, True))
+        self.assertEqual(len(self.computed), 1)
+
+    def test_new_date_of_a_footprint_is_snapped_onto_the_first(self):
+        first = (-8500000.0, 38.2, 0.0, 5300000.0, 0.0, -38.2)
+        self.grid(SOURCE, first)
+        # The same path/row a few pixels off, as the next acquisition usually is
+        shifted = SOURCE[:2] + (SOURCE[2] + 90.0,) + SOURCE[3:5] + (SOURCE[5] - 60.0,)
+        dst_transform, cached = self.grid(shifted, (-8499885.3, 38.21, 0.0, 5299925.1, 0.0, -38.21))
+        self.assertFalse(cached)
+        self.assertEqual(dst_transform, snap((-8499885.3, 38.21, 0.0, 5299925.1, 0.0, -38.21), first))
+
+    def test_other_footprints_and_projections_are_left_alone(self):
+        first = (-8500000.0, 38.2, 0.0, 5300000.0, 0.0, -38.2)
+        self.grid(SOURCE, first)
+        elsewhere = SOURCE[:2] + (SOURCE[2] + 25000.0,) + SOURCE[3:]  # overlaps by less than half
+        other = (-8400000.3, 38.21, 0.0, 5300000.7, 0.0, -38.21)
+        self.assertEqual(self.grid(elsewhere, other), (other, False))
+        projected = (500000.0, 30.0, 0.0, 4500000.0, 0.0, -30.0)
+        self.assertEqual(self.grid(SOURCE, projected, dst_crs=UTM18), (projected, False))
+
+
+if __name__ == "__main__":
+    unittest.main()
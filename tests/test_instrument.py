@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+import unittest
+import instrument
+import opensat
+from support import TemporaryHomeTest
+
+
+class ReportTest(TemporaryHomeTest):
+
+    def reports(self):
+        directory = self.home + "/openasat/reports"
+        return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+    def test_reports_are_only_written_when_asked_for(self):
+        opensat.main(["store", "stats"])
+        self.assertEqual(self.reports(), [])
+        opensat.main(["store", "stats", "--report"])
+        self.assertEqual(len(self.reports()), 1)
+        opensat.main(["store", "stats", "--report", self.home + "/run.json"])
+        self.assertTrue(os.path.isfile(self.home + "/run.json"))
+        self.assertEqual(len(self.reports()), 1)
+
+    def test_prune_keeps_the_newest_reports(self):
+        directory = self.home + "/reports"
+        os.makedirs(directory)
+        for index in range(5):
+            path = "%s/%d.json" % (directory, index)
+            open(path, "w").close()
+            os.utime(path, (1000 + index, 1000 + index))
+        self.assertEqual(len(instrument.prune_reports(directory, keep=2)), 3)
+        self.assertEqual(sorted(os.listdir(directory)), ["3.json", "4.json"])
+
+
+class PeakTest(unittest.TestCase):
+
+    def setUp(self):
+        instrument.reset()
+        self.resets = []
+        self._reset = instrument._reset_high_water_mark
+        instrument._reset_high_water_mark = lambda: self.resets.append(threading.current_thread().name)
+
+    def tearDown(self):
+        instrument._reset_high_water_mark = self._reset
+        instrument.reset()
+
+    def test_peak_count_does_not_restart_under_a_stage_of_another_thread(self):
+        inside, done = threading.Event(), threading.Event()
+
+        def download():
+            with instrument.stage("download"):
+                inside.set()
+                done.wait(10)
+
+        thread = threading.Thread(target=download, name="download")
+        thread.start()
+        inside.wait(10)
+        with instrument.stage("warp"):
+            pass
+        done.set()
+        thread.join()
+        with instrument.stage("write"):
+            pass
+        self.assertEqual(self.resets, ["download", threading.current_thread().name])
+        self.assertEqual([record['stage'] for record in instrument.records()], ["warp", "download", "write"])
+
+
+if __name__ == "__main__":
+    unittest.main()
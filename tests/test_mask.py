@@ -0,0 +1,77 @@
+import unittest
+import fiona
+import numpy
+import rasterio
+from affine import Affine
+from rasterio.warp import transform
+from mask import Mask, geometry_window, load_geometries, mask_batch
+from support import TemporaryHomeTest
+
+
+MERCATOR = {'init': 'epsg:3857'}
+WGS84 = {'init': 'epsg:4326'}
+TRANSFORM = Affine(10.0, 0.0, 1000000.0, 0.0, -10.0, 6000000.0)
+
+
+class MaskTest(TemporaryHomeTest):
+
+    def write_image(self, name, size=200):
+        path = self.home + "/" + name + ".TIF"
+        with rasterio.open(path, 'w', driver='GTiff', width=size, height=size, count=3, dtype=numpy.uint8,
+                           nodata=0, crs=MERCATOR, transform=TRANSFORM) as dst:
+            dst.write(numpy.full((3, size, size), 7, dtype=numpy.uint8))
+        return path
+
+    def write_shapefile(self, name, pixels):
+        """ A polygon through (column, row) pixel corners of the image, stored in longitude and latitude """
+        xs, ys = zip(*[TRANSFORM * pixel for pixel in pixels + pixels[:1]])
+        lons, lats = transform(MERCATOR, WGS84, list(xs), list(ys))
+        path = self.home + "/" + name + ".shp"
+        schema = {'geometry': 'Polygon', 'properties': {'id': 'int'}}
+        with fiona.open(path, 'w', driver='ESRI Shapefile', crs=WGS84, schema=schema) as dst:
+            dst.write({'geometry': {'type': 'Polygon', 'coordinates': [zip(lons, lats)]}, 'properties': {'id': 1}})
+        return path
+
+    def test_geometry_in_another_crs(self):
+        image = self.write_image("image")
+        shapefile = self.write_shapefile("triangle", [(20, 20), (180, 20), (20, 180)])
+        with rasterio.open(image) as src:
+            window = geometry_window(src, load_geometries(shapefile, src.crs))
+        # The geometries are reprojected onto the image before its window is found
+        self.assertEqual(window, ((20, 181), (20, 181)))
+
+        with rasterio.open(Mask(image, shapefile).run()) as src:
+            self.assertEqual(src.shape, (161, 161))
+            data = src.read()
+        # Inside the triangle the image is kept, outside it is nodata
+        self.assertTrue((data[:, 5, 5] == 7).all())
+        self.assertTrue((data[:, 150, 150] == 0).all())
+        self.assertAlmostEqual((data[0] == 7).sum(), 160 * 160 / 2.0, delta=200)
+
+    def test_reprojected_geometries_are_cached(self):
+        shapefile = self.write_shapefile("triangle", [(20, 20), (180, 20), (20, 180)])
+        self.assertIs(load_geometries(shapefile, MERCATOR), load_geometries(shapefile, MERCATOR))
+        self.assertIsNot(load_geometries(shapefile, MERCATOR), load_geometries(shapefile))
+
+    def test_geometry_outside_the_image(self):
+        image = self.write_image("image")
+        shapefile = self.write_shapefile("elsewhere", [(400, 400), (500, 400), (400, 500)])
+        with rasterio.open(image) as src:
+            self.assertIsNone(geometry_window(src, load_geometries(shapefile, src.crs)))
+        self.assertRaises(ValueError, Mask(image, shapefile).run)
+
+    def test_mask_batch(self):
+        images = [self.write_image("a"), self.write_image("b", 100)]
+        shapefile = self.write_shapefile("square", [(10, 10), (60, 10), (60, 60), (10, 60)])
+        outputs = mask_batch(images, shapefile)
+        self.assertEqual(outputs, [self.home + "/a_masked.TIF", self.home + "/b_masked.TIF"])
+        for output_file in outputs:
+            with rasterio.open(output_file) as src:
+                self.assertEqual(src.shape, (51, 51))
+                data = src.read()
+                self.assertTrue((data[:, 1:49, 1:49] == 7).all())
+                self.assertAlmostEqual((data[0] == 7).sum(), 50 * 50, delta=101)
+
+
+if __name__ == "__main__":
+    unittest.main()
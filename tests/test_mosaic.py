@@ -0,0 +1,74 @@
+import unittest
+import numpy
+import rasterio
+from affine import Affine
+import mosaic
+from mosaic import Mosaic, OpenInputs
+from support import TemporaryHomeTest
+
+
+CRS = {'init': 'epsg:32618'}
+
+
+class MosaicTest(TemporaryHomeTest):
+
+    def write(self, name, col, value, clouds, width=100, height=60):
+        """ A 3-band image of one value starting col pixels right of the origin, with a nodata hole """
+        path = self.home + "/" + name + ".TIF"
+        data = numpy.full((3, height, width), value, dtype=numpy.uint8)
+        data[:, :10, :10] = 0
+        with rasterio.open(path, 'w', driver='GTiff', width=width, height=height, count=3, dtype=numpy.uint8,
+                           nodata=0, crs=CRS, transform=Affine(10.0, 0.0, 500000.0 + col * 10, 0.0, -10.0, 4500000.0)) as dst:
+            dst.write(data)
+            dst.update_tags(CLOUD_COVER=str(clouds))
+        return path
+
+    def setUp(self):
+        TemporaryHomeTest.setUp(self)
+        self.inputs = [self.write("a", 0, 10, 30.0), self.write("b", 50, 20, 5.0), self.write("c", 25, 30, 50.0)]
+
+    def run_mosaic(self, rule):
+        output_file = Mosaic(self.inputs, self.home + "/mosaic_" + rule + ".TIF", rule).run()
+        with rasterio.open(output_file) as src:
+            self.assertEqual((src.width, src.height), (150, 60))
+            return src.read(1)
+
+    def test_first(self):
+        band = self.run_mosaic("first")
+        self.assertEqual(band[30, 5], 10)
+        self.assertEqual(band[30, 60], 10)  # a, b and c overlap
+        self.assertEqual(band[30, 120], 20)
+        self.assertFalse((band == 30).any())  # c lies under a and b everywhere
+        self.assertEqual(band[5, 5], 0)  # the hole of a is nobody's
+
+    def test_last(self):
+        band = self.run_mosaic("last")
+        self.assertEqual(band[30, 30], 30)
+        self.assertEqual(band[30, 60], 30)
+        self.assertEqual(band[30, 130], 20)
+        self.assertEqual(band[5, 30], 10)  # under the hole of c
+
+    def test_least_cloudy(self):
+        band = self.run_mosaic("least-cloudy")
+        self.assertEqual(band[30, 60], 20)
+        self.assertEqual(band[30, 30], 10)
+        self.assertEqual(band[5, 55], 10)  # under the hole of b, a has fewer clouds than c
+
+    def test_inputs_are_opened_only_while_needed(self):
+        expected = self.run_mosaic("least-cloudy")
+        limit = mosaic.MAX_OPEN_INPUTS
+        mosaic.MAX_OPEN_INPUTS = 1
+        try:
+            numpy.testing.assert_array_equal(self.run_mosaic("least-cloudy"), expected)
+        finally:
+            mosaic.MAX_OPEN_INPUTS = limit
+
+        inputs = OpenInputs(2)
+        for path in self.inputs + self.inputs[:1]:
+            inputs.get(path)
+        self.assertEqual(list(inputs.handles), [self.inputs[2], self.inputs[0]])
+        inputs.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import threading
+import unittest
+from pipeline import Pipeline
+from support import TemporaryHomeTest
+
+
+def double_or_die(item):
+    if item < 0:
+        os._exit(1)  # like a worker killed for memory: no exception, no callback
+    return 2 * item
+
+
+def double_or_fail(item):
+    if item < 0:
+        raise ValueError("negative scene")
+    return 2 * item
+
+
+class PipelineTest(TemporaryHomeTest):
+
+    def run_pipeline(self, process, items, workers=2):
+        """ Runs a pipeline in a thread, so a hanging one fails the test instead of blocking it """
+        results = []
+        runner = threading.Thread(target=lambda: results.append(Pipeline(lambda item: True, process, workers).run(items)))
+        runner.daemon = True
+        runner.start()
+        runner.join(60)
+        self.assertFalse(runner.is_alive(), "the pipeline hangs")
+        return results[0]
+
+    def test_results_in_download_order(self):
+        self.assertEqual(self.run_pipeline(double_or_die, range(6)), [0, 2, 4, 6, 8, 10])
+
+    def test_failed_scenes_are_left_out(self):
+        self.assertEqual(self.run_pipeline(double_or_fail, [1, -1, 2]), [2, 4])
+
+    def test_dead_workers_free_their_slots(self):
+        # More deaths than workers: every lost slot has to come back for the last scenes to run
+        items = [1, -1, 2, -2, -3, 3, -4, 4]
+        self.assertEqual(self.run_pipeline(double_or_die, items), [2, 4, 6, 8])
+
+    def test_items_that_failed_to_download_are_skipped(self):
+        pipeline = Pipeline(lambda item: item != 2, double_or_die, 1)
+        self.assertEqual(pipeline.run([1, 2, 3]), [2, 6])
+
+
+if __name__ == "__main__":
+    unittest.main()
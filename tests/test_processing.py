@@ -0,0 +1,140 @@
+import os
+import unittest
+import numpy
+import rasterio
+from skimage.exposure import rescale_intensity
+from skimage.util import img_as_ubyte
+from benchmark import LANDSAT_SCENE, SENTINEL_SCENE, write_landsat_scene, write_sentinel_scene
+from pipeline import process_scene
+from processing import MIN_BLOCK_SIZE, PanSharpen, Processing, WINDOW_BYTES_PER_PIXEL
+from support import TemporaryHomeTest
+from utils import parse_bands
+
+
+def float_color_correction(band, low, coverage):
+    """ The float stretch _color_correction used before the lookup table """
+    p_low, cloud_cut_low = numpy.percentile(band[numpy.logical_and(band > 0, band < 65535)],
+                                            (low, 100 - (coverage * 3 / 4)))
+    temp = numpy.zeros(numpy.shape(band), dtype=numpy.uint16)
+    cloud_divide = 65000 - coverage * 100
+    mask = numpy.logical_and(band < cloud_cut_low, band > 0)
+    temp[mask] = rescale_intensity(band[mask], in_range=(p_low, cloud_cut_low), out_range=(256, cloud_divide))
+    temp[band >= cloud_cut_low] = rescale_intensity(band[band >= cloud_cut_low], out_range=(cloud_divide, 65535))
+    return img_as_ubyte(temp)
+
+
+class StretchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processing = Processing.__new__(Processing)
+
+    def lut_color_correction(self, band, low, coverage):
+        hist = numpy.bincount(band.ravel(), minlength=65536)
+        return self.processing._stretch_lut(self.processing._stretch_params(hist, low, coverage))[band]
+
+    def assert_matches_float_path(self, band, coverage):
+        expected = float_color_correction(band, 0, coverage).astype(int)
+        result = self.lut_color_correction(band, 0, coverage).astype(int)
+        self.assertLessEqual(numpy.abs(result - expected).max(), 1)
+
+    def test_band_without_saturated_pixels(self):
+        band = numpy.random.RandomState(0).gamma(2.0, 4000, (400, 400)).clip(1, 40000).astype(numpy.uint16)
+        band[:20] = 0
+        self.assertFalse((band == 65535).any())
+        for coverage in (0.1, 5.0, 30.0):
+            self.assert_matches_float_path(band, coverage)
+
+    def test_band_with_saturated_pixels(self):
+        band = numpy.random.RandomState(1).randint(1, 30000, (300, 300)).astype(numpy.uint16)
+        band[:5, :5] = 65535
+        self.assert_matches_float_path(band, 2.0)
+
+
+class BandsTest(TemporaryHomeTest):
+
+    def test_parse_bands(self):
+        self.assertEqual(parse_bands("432"), ["4", "3", "2"])
+        self.assertEqual(parse_bands("8A,11,12"), ["8A", "11", "12"])
+        self.assertEqual(parse_bands(["8A", 11, 12]), ["8A", "11", "12"])
+
+    def test_two_digit_sentinel_bands(self):
+        write_sentinel_scene(self.home, 120, bands=("8A", "11", "12"))
+        for bands in ("8A,11,12", ["8A", "11", "12"]):
+            processing = Processing(SENTINEL_SCENE, bands, "sentinel")
+            self.assertEqual(processing.bands, ["B8A.jp2", "B11.jp2", "B12.jp2"])
+            self.assertTrue(processing.output_file.endswith(SENTINEL_SCENE + "_8A-11-12.TIF"))
+
+        output_file = process_scene(SENTINEL_SCENE, "8A,11,12", "sentinel")
+        self.assertTrue(os.path.isfile(output_file))
+        with rasterio.open(output_file) as src:
+            self.assertEqual(src.count, 3)
+            self.assertTrue(src.read(1).any())
+
+    def test_single_digit_bands_keep_their_file_name(self):
+        write_sentinel_scene(self.home, 60)
+        self.assertEqual(Processing(SENTINEL_SCENE, "4,3,2", "sentinel").output_file,
+                         Processing(SENTINEL_SCENE, "432", "sentinel").output_file)
+
+
+class WarpTest(TemporaryHomeTest):
+
+    def pansharpen(self, workers, strips):
+        output_file = PanSharpen(LANDSAT_SCENE, "4328", "landsat", warp_workers=workers, warp_strips=strips).run()
+        with rasterio.open(output_file) as src:
+            return src.read()
+
+    def test_pansharpen_strips_read_through_their_own_handles(self):
+        write_landsat_scene(self.home, 200, "2348")
+        expected = self.pansharpen(1, 1)
+        numpy.testing.assert_array_equal(self.pansharpen(8, 4), expected)
+
+
+class BlocksTest(TemporaryHomeTest):
+
+    def test_blocks_cover_the_image_once(self):
+        processing = Processing.__new__(Processing)
+        processing.memory_budget = 1024 * 1024
+        coverage = numpy.zeros((1300, 1100), dtype=int)
+        for (row_start, row_stop), (col_start, col_stop) in processing._blocks(coverage.shape):
+            self.assertLessEqual(max(row_stop - row_start, col_stop - col_start), 512)
+            coverage[row_start:row_stop, col_start:col_stop] += 1
+        self.assertTrue((coverage == 1).all())
+
+    def test_blocks_fit_small_budgets(self):
+        processing = Processing.__new__(Processing)
+        for budget in (256 * 1024, 1024 * 1024, 4 * 1024 * 1024):
+            processing.memory_budget = budget
+            for (row_start, row_stop), (col_start, col_stop) in processing._blocks((3000, 3000)):
+                self.assertLessEqual((row_stop - row_start) * (col_stop - col_start) * WINDOW_BYTES_PER_PIXEL, budget)
+        processing.memory_budget = 1024
+        self.assertEqual(next(processing._blocks((3000, 3000))), ((0, MIN_BLOCK_SIZE), (0, MIN_BLOCK_SIZE)))
+
+    def test_windowed_output_matches_the_in_memory_output(self):
+        write_landsat_scene(self.home, 900)
+        outputs = []
+        for budget in (None, 1024 * 1024):
+            with rasterio.open(Processing(LANDSAT_SCENE, "432", "landsat", memory_budget=budget).run()) as src:
+                outputs.append(src.read().astype(int))
+        # Only the stretch differs: the windowed mode counts the source pixels, not the warped ones
+        self.assertLessEqual(numpy.abs(outputs[0] - outputs[1]).max(), 3)
+
+    def test_band_histogram_of_stripped_and_tiled_bands(self):
+        write_landsat_scene(self.home, 700, "4")
+        processing = Processing(LANDSAT_SCENE, "4", "landsat", memory_budget=1024 * 1024)
+        stripped = processing.bands_path[0]
+        tiled = self.home + "/tiled.TIF"
+        with rasterio.open(stripped) as src:
+            band = src.read(1)
+            meta = src.meta.copy()
+        meta.update({'tiled': True, 'blockxsize': 256, 'blockysize': 256})
+        with rasterio.open(tiled, 'w', **meta) as dst:
+            dst.write(band, 1)
+
+        expected = numpy.bincount(band.ravel(), minlength=65536)
+        for path in (stripped, tiled):
+            with rasterio.open(path) as src:
+                numpy.testing.assert_array_equal(processing._band_histogram(src), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import numpy
+import rasterio
+from affine import Affine
+from quality import (BQA_LAYOUTS, CIRRUS, CLOUD, FILL, SHADOW, SNOW, QualityMask, bqa_layout, bqa_lut,
+                     parse_flags)
+from support import TemporaryHomeTest
+
+
+COLLECTION_SCENE = "LC08_L1TP_013032_20160409_20170326_01_T1"
+UTM18 = {'init': 'epsg:32618'}
+TRANSFORM = Affine(30.0, 0.0, 300000.0, 0.0, -30.0, 4500000.0)
+
+
+def decode(value, layout):
+    """ Quality classes of one BQA value, one bit at a time """
+    classes = FILL if value & 1 else 0
+    for quality_class, bit in BQA_LAYOUTS[layout].items():
+        if (value >> bit) & 1 and (value >> (bit + 1)) & 1:
+            classes |= quality_class
+    return classes
+
+
+def confidence(bit, level):
+    """ BQA bits of a two-bit confidence level (0-3) starting at bit """
+    return level << bit
+
+
+class FlagsTest(unittest.TestCase):
+
+    def test_parse_flags(self):
+        self.assertEqual(parse_flags("cloud,shadow"), CLOUD | SHADOW)
+        self.assertEqual(parse_flags(["snow", "cirrus"]), SNOW | CIRRUS)
+        self.assertRaises(ValueError, parse_flags, "cloud,haze")
+
+    def test_layouts(self):
+        self.assertEqual(bqa_layout(COLLECTION_SCENE), "collection")
+        self.assertEqual(bqa_layout("LC80130322016100LGN00"), "pre-collection")
+
+    def test_lookup_table_matches_bit_by_bit_decoding(self):
+        values = numpy.random.RandomState(0).randint(0, 65536, 5000)
+        for layout in BQA_LAYOUTS:
+            lut = bqa_lut(layout)
+            self.assertEqual([int(lut[value]) for value in values], [decode(value, layout) for value in values])
+
+    def test_only_high_confidence_counts(self):
+        lut = bqa_lut("collection")
+        self.assertEqual(lut[confidence(5, 3)], CLOUD)
+        self.assertEqual(lut[confidence(5, 2)], 0)
+        self.assertEqual(lut[confidence(7, 3) | confidence(9, 1)], SHADOW)
+        self.assertEqual(lut[1 | confidence(9, 3)], FILL | SNOW)
+
+
+class QualityMaskTest(TemporaryHomeTest):
+
+    def test_mask_of_a_bqa_band(self):
+        # Quarters of cloud, cloud shadow, snow and clear pixels, with medium-confidence cloud in the clear one
+        bqa = numpy.zeros((100, 100), dtype=numpy.uint16)
+        bqa[:50, :50] = confidence(5, 3)
+        bqa[:50, 50:] = confidence(7, 3) | confidence(5, 1)
+        bqa[50:, :50] = confidence(9, 3)
+        bqa[50:, 50:] = confidence(5, 2)
+        scene_path = self.home + "/"
+        with rasterio.open(scene_path + COLLECTION_SCENE + "_BQA.TIF", 'w', driver='GTiff', width=100, height=100,
+                           count=1, dtype=numpy.uint16, crs=UTM18, transform=TRANSFORM) as dst:
+            dst.write(bqa, 1)
+
+        quality = QualityMask(COLLECTION_SCENE, "landsat", scene_path, "cloud,shadow")
+        self.assertTrue(quality.available())
+        classes = quality.classes(TRANSFORM.to_gdal(), UTM18, bqa.shape)
+        expected = numpy.vectorize(lambda value: decode(value, "collection"))(bqa)
+        numpy.testing.assert_array_equal(classes, expected)
+
+        masked = quality.read(TRANSFORM.to_gdal(), UTM18, bqa.shape)
+        self.assertTrue(masked[:50].all())
+        self.assertFalse(masked[50:].any())  # snow is not a selected flag
+
+
+if __name__ == "__main__":
+    unittest.main()
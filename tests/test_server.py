@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+import unittest
+import urllib2
+from benchmark import SENTINEL_SCENE, write_sentinel_scene
+from server import JobServer, JobStore, run_job
+from support import TemporaryHomeTest
+
+
+def run_or_die(kind, params):
+    """ Job runner whose worker exits without a word when asked to """
+    if params.get("die"):
+        os._exit(1)
+    return run_job(kind, params)
+
+
+class JobServerTest(TemporaryHomeTest):
+
+    def setUp(self):
+        TemporaryHomeTest.setUp(self)
+        write_sentinel_scene(self.home, 120)
+        self.server = JobServer(0, workers=1, store=JobStore(self.home + "/jobs.db"), runner=run_or_die)
+        self.thread = threading.Thread(target=self.server.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        TemporaryHomeTest.tearDown(self)
+
+    def request(self, path, body=None):
+        url = "http://127.0.0.1:%d/%s" % (self.server.server_address[1], path)
+        data = json.dumps(body) if body is not None else None
+        return json.load(urllib2.urlopen(url, data, timeout=10))
+
+    def submit(self, params, force=False):
+        return self.request("jobs", {'kind': "process", 'params': params, 'force': force})
+
+    def wait(self, identifier):
+        for _ in range(200):
+            job = self.request("jobs/" + identifier)
+            if job["status"] in ("done", "failed"):
+                return job
+            time.sleep(0.1)
+        self.fail("job " + identifier + " did not finish")
+
+    def test_round_trip_and_de_duplication(self):
+        params = {'scene': SENTINEL_SCENE, 'bands': "432"}
+        job = self.submit(params)
+        self.assertEqual(job["status"], "queued")
+        done = self.wait(job["id"])
+        self.assertEqual(done["status"], "done", done["error"])
+        self.assertTrue(os.path.isfile(done["result"]))
+
+        # An identical job is the same job, and is not run again while its output exists
+        again = self.submit(params)
+        self.assertEqual((again["id"], again["status"]), (job["id"], "done"))
+        self.assertEqual(len(self.request("jobs")), 1)
+
+        self.assertEqual(self.submit(params, force=True)["status"], "queued")
+        self.assertEqual(self.wait(job["id"])["status"], "done")
+
+        os.remove(done["result"])
+        self.assertEqual(self.submit(params)["status"], "queued")
+        self.assertTrue(os.path.isfile(self.wait(job["id"])["result"]))
+
+    def test_dead_worker_fails_its_job_and_frees_its_slot(self):
+        dead = self.wait(self.submit({'scene': SENTINEL_SCENE, 'bands': "432", 'die': True})["id"])
+        self.assertEqual(dead["status"], "failed")
+        self.assertIn("died", dead["error"])
+        # The only worker slot is free again
+        job = self.wait(self.submit({'scene': SENTINEL_SCENE, 'bands': "432"})["id"])
+        self.assertEqual(job["status"], "done", job["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import time
+import unittest
+from benchmark import LANDSAT_SCENE, write_landsat_scene
+from cache import Manifest
+from pipeline import Pipeline, process_scene
+from store import SceneStore
+from support import TemporaryHomeTest
+from utils import scene_directory
+
+
+SCENE = "S2A_tile_20160823_18TWL_0"
+
+
+class StoreTest(TemporaryHomeTest):
+
+    def setUp(self):
+        TemporaryHomeTest.setUp(self)
+        self.scene_path = scene_directory("sentinel", SCENE)
+        os.makedirs(self.scene_path + "processed")
+        for name in ("B02.jp2", "B03.jp2", "B04.jp2", "B04.ingest.tif", "B08.jp2"):
+            self.write(self.scene_path + name)
+        self.store = SceneStore()
+
+    def tearDown(self):
+        self.store.close()
+        TemporaryHomeTest.tearDown(self)
+
+    def write(self, path):
+        with open(path, "wb") as f:
+            f.write("0" * 1000)
+        return path
+
+    def record(self, name, inputs):
+        output_file = self.write(self.scene_path + "processed/" + name)
+        Manifest(self.scene_path + "processed").record(output_file, "key", "stack",
+                                                       [self.scene_path + band for band in inputs], {})
+        return output_file
+
+    def remaining(self):
+        return sorted(name for name in os.listdir(self.scene_path) if name != "processed")
+
+    def test_gc_only_evicts_bands_used_by_an_output(self):
+        self.record(SCENE + "_432.TIF", ["B02.jp2", "B03.jp2", "B04.ingest.tif"])
+        self.store.gc(quota=0)
+        self.assertEqual(self.remaining(), ["B08.jp2"])
+
+    def test_gc_keeps_bands_of_deleted_outputs(self):
+        os.remove(self.record(SCENE + "_432.TIF", ["B02.jp2", "B03.jp2", "B04.jp2"]))
+        self.assertEqual(self.store.gc(quota=0), [])
+
+    def test_nested_pins(self):
+        self.record(SCENE + "_432.TIF", ["B02.jp2", "B03.jp2", "B04.jp2"])
+        with self.store.pin(SCENE):
+            with self.store.pin(SCENE):
+                pass
+            self.assertIn(SCENE, self.store.pinned())
+            self.assertEqual(self.store.gc(quota=0), [])
+        self.assertNotIn(SCENE, self.store.pinned())
+
+
+def slow_process(item):
+    time.sleep(0.5)
+    return item
+
+
+class ReprocessTest(TemporaryHomeTest):
+
+    def test_output_stays_up_to_date_after_its_bands_are_evicted(self):
+        scene_path = write_landsat_scene(self.home, 100)
+        output_file = process_scene(LANDSAT_SCENE, "432", "landsat")
+        made = os.path.getmtime(output_file)
+        store = SceneStore()
+        try:
+            self.assertEqual(len(store.gc(quota=0)), 3)
+        finally:
+            store.close()
+        self.assertFalse(os.path.isfile(scene_path + LANDSAT_SCENE + "_B4.TIF"))
+
+        self.assertEqual(process_scene(LANDSAT_SCENE, "432", "landsat"), output_file)
+        self.assertEqual(os.path.getmtime(output_file), made)
+
+    def test_new_download_of_an_evicted_band_makes_the_output_stale(self):
+        scene_path = write_landsat_scene(self.home, 100)
+        output_file = process_scene(LANDSAT_SCENE, "432", "landsat")
+        store = SceneStore()
+        try:
+            store.gc(quota=0)
+        finally:
+            store.close()
+        write_landsat_scene(self.home, 100, seed=1)
+        process_scene(LANDSAT_SCENE, "432", "landsat")
+        self.assertNotIn('evicted', Manifest(scene_path + "processed").entries[os.path.basename(output_file)])
+
+    def test_queued_scenes_stay_pinned(self):
+        pinned = []
+
+        def download(item):
+            store = SceneStore()
+            try:
+                pinned.append(store.pinned())
+            finally:
+                store.close()
+            return True
+
+        self.assertEqual(Pipeline(download, slow_process, 1, scene=str).run(["a", "b"]), ["a", "b"])
+        self.assertIn("a", pinned[0])
+        self.assertEqual(pinned[1], set(["a", "b"]))
+        store = SceneStore()
+        try:
+            self.assertEqual(store.pinned(), set())
+        finally:
+            store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import json
+import os
+import unittest
+import numpy
+import rasterio
+from affine import Affine
+from PIL import Image
+from support import TemporaryHomeTest
+from tiles import TILE_SIZE, TilePyramid, WEB_MERCATOR, _merge_tile, _tile_path, tile_range, tile_span
+
+
+HALF = TILE_SIZE // 2
+
+
+class MergeTileTest(TemporaryHomeTest):
+
+    def write_child(self, x, y, rgb, alpha=None):
+        rgba = numpy.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=numpy.uint8)
+        rgba[:, :, :3] = rgb
+        rgba[:, :, 3] = 255 if alpha is None else alpha
+        path = _tile_path(self.home, 4, x, y, "png")
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        Image.fromarray(rgba, "RGBA").save(path, "PNG")
+
+    def assert_pixels(self, pixels, value):
+        self.assertTrue((pixels == value).all(), str(pixels[0, 0]) + " != " + str(value))
+
+    def merge(self):
+        self.assertTrue(_merge_tile((self.home, "png", 3, 2, 1)))
+        return numpy.asarray(Image.open(_tile_path(self.home, 3, 2, 1, "png")).convert("RGBA"))
+
+    def test_parent_averages_covered_pixels_of_its_children(self):
+        self.write_child(4, 2, (255, 0, 0))
+        # Only half of every 2x2 block is covered; the colour under transparent pixels does not count
+        checkerboard = numpy.indices((TILE_SIZE, TILE_SIZE)).sum(axis=0) % 2 == 0
+        rgb = numpy.where(checkerboard[:, :, numpy.newaxis], 100, 200)
+        self.write_child(5, 2, rgb, numpy.where(checkerboard, 255, 0))
+        # 2x2 blocks of 10, 20, 30 and 41 average to 25.25
+        rgb = numpy.tile(numpy.array([[10, 20], [30, 41]]), (HALF, HALF))[:, :, numpy.newaxis]
+        self.write_child(4, 3, rgb)
+        # The fourth child is missing
+
+        tile = self.merge()
+        self.assert_pixels(tile[:HALF, :HALF], (255, 0, 0, 255))
+        self.assert_pixels(tile[:HALF, HALF:], (100, 100, 100, 255))
+        self.assert_pixels(tile[HALF:, :HALF], (25, 25, 25, 255))
+        self.assertFalse(tile[HALF:, HALF:, 3].any())
+
+    def test_parent_of_empty_children_is_removed(self):
+        self.write_child(4, 2, (255, 0, 0))
+        self.merge()
+        os.remove(_tile_path(self.home, 4, 4, 2, "png"))
+        self.assertFalse(_merge_tile((self.home, "png", 3, 2, 1)))
+        self.assertFalse(os.path.isfile(_tile_path(self.home, 3, 2, 1, "png")))
+
+
+class TilePyramidTest(TemporaryHomeTest):
+
+    def test_pyramid_of_a_uniform_image(self):
+        # A 300 pixel square of one colour at the pixel size of zoom 10, off the tile boundaries
+        resolution = tile_span(10) / TILE_SIZE
+        input_file = self.home + "/image.TIF"
+        with rasterio.open(input_file, 'w', driver='GTiff', width=300, height=300, count=3, dtype=numpy.uint8,
+                           nodata=0, crs=WEB_MERCATOR,
+                           transform=Affine(resolution, 0.0, 1000000.0, 0.0, -resolution, 6000000.0)) as dst:
+            for band, value in enumerate((50, 100, 150)):
+                dst.write(numpy.full((300, 300), value, dtype=numpy.uint8), band + 1)
+
+        pyramid = TilePyramid(input_file, self.home + "/tiles", min_zoom=7, workers=2)
+        self.assertEqual(pyramid.max_zoom, 10)
+        with open(pyramid.run()) as f:
+            self.assertEqual(json.load(f)['minzoom'], 7)
+
+        for zoom in range(7, 11):
+            tiles = tile_range(pyramid.bounds, zoom)
+            covered = 0
+            for x, y in tiles:
+                tile = numpy.asarray(Image.open(_tile_path(pyramid.output_dir, zoom, x, y, "png")).convert("RGBA"))
+                opaque = tile[:, :, 3] == 255
+                self.assertTrue((opaque | (tile[:, :, 3] == 0)).all())
+                # Averaging never blends the image with the empty space around it
+                self.assertTrue((tile[opaque][:, :3] == (50, 100, 150)).all())
+                covered += opaque.sum()
+            # Every level covers about the image, a quarter as many pixels per level up
+            self.assertAlmostEqual(covered, 300 * 300 / 4.0 ** (10 - zoom), delta=2 * 300 / 2 ** (10 - zoom) + 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+import json
+import math
+import multiprocessing
+import os
+import numpy
+import rasterio
+from affine import Affine
+from PIL import Image
+from rasterio.warp import reproject, transform_bounds, RESAMPLING
+import instrument
+from utils import bcolors
+
+
+TILE_SIZE = 256
+# Half the width of the web mercator world in metres
+ORIGIN = 20037508.342789244
+WEB_MERCATOR = {'init': 'epsg:3857'}
+FORMATS = {"png": "PNG", "webp": "WEBP"}
+TILEJSON_NAME = "tiles.json"
+
+# The image being tiled, opened once by every worker process
+_source = {}
+
+
+def tile_span(zoom):
+    return 2 * ORIGIN / 2 ** zoom
+
+
+def tile_transform(zoom, x, y):
+    span = tile_span(zoom)
+    return Affine(span / TILE_SIZE, 0.0, -ORIGIN + x * span, 0.0, -span / TILE_SIZE, ORIGIN - y * span)
+
+
+def tile_range(bounds, zoom):
+    """ Columns and rows of the tiles of a zoom level covering web mercator bounds """
+    span = tile_span(zoom)
+    last = 2 ** zoom - 1
+    left = max(0, int(math.floor((bounds[0] + ORIGIN) / span)))
+    right = min(last, int(math.ceil((bounds[2] + ORIGIN) / span)) - 1)
+    top = max(0, int(math.floor((ORIGIN - bounds[3]) / span)))
+    bottom = min(last, int(math.ceil((ORIGIN - bounds[1]) / span)) - 1)
+    return [(x, y) for x in range(left, right + 1) for y in range(top, bottom + 1)]
+
+
+def native_zoom(resolution):
+    """ First zoom level whose pixels are at least as fine as the image """
+    return max(0, int(math.ceil(math.log(tile_span(0) / TILE_SIZE / resolution, 2) - 1e-9)))
+
+
+def overview_zoom(bounds):
+    """ Deepest zoom level at which the image still fits into a single tile """
+    size = max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+    return max(0, int(math.floor(math.log(tile_span(0) / size, 2))))
+
+
+def image_bounds(path):
+    """ Web mercator bounds of an image """
+    with rasterio.open(path) as src:
+        return transform_bounds(src.crs, WEB_MERCATOR, *src.bounds)
+
+
+def _open_source(input_file):
+    _source['src'] = rasterio.open(input_file)
+
+
+def _tile_path(output_dir, zoom, x, y, extension):
+    return os.path.join(output_dir, str(zoom), str(x), str(y) + "." + extension)
+
+
+def _save(rgba, path, extension):
+    """ Writes a tile, or removes an old one when the tile has become empty """
+    if not rgba[:, :, 3].any():
+        if os.path.isfile(path):
+            os.remove(path)
+        return False
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:  # another worker made it first
+            pass
+    Image.fromarray(rgba, "RGBA").save(path + ".part", FORMATS[extension], lossless=True)
+    os.rename(path + ".part", path)
+    return True
+
+
+def _render_tile(job):
+    """ Reads the window of the image under one tile of the deepest zoom level """
+    output_dir, extension, zoom, x, y = job
+    src = _source['src']
+    nodata = src.nodata if src.nodata is not None else 0
+    bands = numpy.full((src.count, TILE_SIZE, TILE_SIZE), nodata, dtype=src.dtypes[0])
+    for band in range(src.count):
+        # GDAL only reads the part of the image under the tile
+        reproject(rasterio.band(src, band + 1), bands[band], dst_transform=tile_transform(zoom, x, y),
+                  dst_crs=WEB_MERCATOR, src_nodata=nodata, dst_nodata=nodata, resampling=RESAMPLING.nearest)
+    rgba = numpy.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=numpy.uint8)
+    rgba[:, :, :3] = numpy.moveaxis(bands[:3] if src.count >= 3 else bands[[0, 0, 0]], 0, -1)
+    rgba[:, :, 3] = numpy.where((bands != nodata).any(axis=0), 255, 0)
+    return _save(rgba, _tile_path(output_dir, zoom, x, y, extension), extension)
+
+
+def _merge_tile(job):
+    """ Builds a tile from its four children, averaging the covered pixels of each 2x2 block """
+    output_dir, extension, zoom, x, y = job
+    children = numpy.zeros((2 * TILE_SIZE, 2 * TILE_SIZE, 4), dtype=numpy.float32)
+    for dx in (0, 1):
+        for dy in (0, 1):
+            path = _tile_path(output_dir, zoom + 1, 2 * x + dx, 2 * y + dy, extension)
+            if os.path.isfile(path):
+                children[dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = \
+                    numpy.asarray(Image.open(path).convert("RGBA"))
+    covered = (children[:, :, 3] > 0).astype(numpy.float32)
+    blocks = (children[:, :, :3] * covered[:, :, numpy.newaxis]).reshape(TILE_SIZE, 2, TILE_SIZE, 2, 3)
+    count = covered.reshape(TILE_SIZE, 2, TILE_SIZE, 2).sum(axis=(1, 3))
+    rgba = numpy.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=numpy.uint8)
+    with numpy.errstate(invalid="ignore"):
+        rgba[:, :, :3] = numpy.nan_to_num(numpy.round(blocks.sum(axis=(1, 3)) / count[:, :, numpy.newaxis]))
+    rgba[:, :, 3] = numpy.where(count > 0, 255, 0)
+    return _save(rgba, _tile_path(output_dir, zoom, x, y, extension), extension)
+
+
+class TilePyramid(object):
+    'Cuts an 8-bit processed or mosaicked image into a z/x/y web map tile pyramid'
+
+    stage = "tiles"
+
+    def __init__(self, input_file, output_dir, min_zoom=None, max_zoom=None, tile_format="png", workers=None):
+        if tile_format not in FORMATS:
+            raise ValueError("Unknown tile format " + str(tile_format) + "; use " + " or ".join(sorted(FORMATS)))
+        with rasterio.open(input_file) as src:
+            if src.dtypes[0] != "uint8":
+                raise ValueError("Tiles are cut from 8-bit images, " + input_file + " is " + src.dtypes[0])
+            self.bounds = transform_bounds(src.crs, WEB_MERCATOR, *src.bounds)
+            resolution = (self.bounds[2] - self.bounds[0]) / src.width
+        self.input_file = input_file
+        self.output_dir = output_dir
+        self.output_file = os.path.join(output_dir, TILEJSON_NAME)
+        self.max_zoom = max_zoom if max_zoom is not None else native_zoom(resolution)
+        self.min_zoom = min_zoom if min_zoom is not None else min(overview_zoom(self.bounds), self.max_zoom)
+        self.tile_format = tile_format
+        self.workers = workers or multiprocessing.cpu_count()
+
+    def cache_params(self):
+        return {'min_zoom': self.min_zoom, 'max_zoom': self.max_zoom, 'format': self.tile_format}
+
+    @instrument.timed
+    def run(self, changed_bounds=None):
+        """ Renders the deepest zoom level from the image, then every level above from the one below.
+        With changed_bounds (web mercator), only the tiles over that area are made again.
+        :returns:
+            (String) the path to the TileJSON description of the pyramid
+        """
+        area = self.bounds if changed_bounds is None else (
+            max(self.bounds[0], changed_bounds[0]), max(self.bounds[1], changed_bounds[1]),
+            min(self.bounds[2], changed_bounds[2]), min(self.bounds[3], changed_bounds[3]))
+        print "Cutting tiles of zoom " + str(self.min_zoom) + " to " + str(self.max_zoom) + " from " + self.input_file
+
+        # Every worker opens the image once; handles are not shared between processes
+        pool = multiprocessing.Pool(self.workers, _open_source, (self.input_file,))
+        try:
+            tiles = set(tile_range(area, self.max_zoom))
+            for zoom in range(self.max_zoom, self.min_zoom - 1, -1):
+                with instrument.stage("tiles_zoom", zoom=zoom, tiles=len(tiles)) as record:
+                    jobs = [(self.output_dir, self.tile_format, zoom, x, y) for x, y in sorted(tiles)]
+                    written = pool.map(_render_tile if zoom == self.max_zoom else _merge_tile, jobs, chunksize=16)
+                    record['written'] = sum(written)
+                print "Zoom " + str(zoom) + ": " + str(sum(written)) + " of " + str(len(tiles)) + " tiles"
+                tiles = set((x // 2, y // 2) for x, y in tiles)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self._write_tilejson()
+        print bcolors.OKGREEN + "Tiles are saved to " + self.output_dir + bcolors.ENDC
+        return self.output_file
+
+    def _write_tilejson(self):
+        bounds = transform_bounds(WEB_MERCATOR, {'init': 'epsg:4326'}, *self.bounds)
+        description = {'tilejson': '2.2.0',
+                       'name': os.path.basename(self.input_file),
+                       'tiles': ["{z}/{x}/{y}." + self.tile_format],
+                       'minzoom': self.min_zoom,
+                       'maxzoom': self.max_zoom,
+                       'bounds': list(bounds)}
+        with open(self.output_file + ".part", "w") as f:
+            json.dump(description, f, indent=2, sort_keys=True)
+        os.rename(self.output_file + ".part", self.output_file)
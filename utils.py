@@ -0,0 +1,116 @@
+import collections
+import os
+import threading
+from multiprocessing import Pool
+from multiprocessing.queues import SimpleQueue
+
+
+class bcolors:
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+
+
+def data_root():
+    """ Directory holding all opensat data, ~/openasat unless OPENSAT_HOME is set, with a trailing slash """
+    return os.path.join(os.environ.get("OPENSAT_HOME") or os.path.expanduser("~") + "/openasat", "")
+
+
+def crs_key(crs):
+    """ Hashable, order-independent form of a crs dict, for comparing crs and keying caches by them """
+    return repr(sorted(dict(crs).items()))
+
+
+def scene_directory(satellite, scene):
+    """ Directory a scene is downloaded to, with a trailing slash """
+    return data_root() + satellite + "/" + scene + "/"
+
+
+def aoi_directory(scene_path, mask):
+    """ Directory holding the parts of a scene's bands that cover one mask """
+    return scene_path + "aoi_" + os.path.splitext(os.path.basename(mask))[0] + "/"
+
+
+def parse_bands(bands):
+    """ Band names of "4,3,2", "8A,11,12" or a list; digits without commas ("432") are one band each.
+    :returns:
+        (List) band names as strings
+    """
+    if isinstance(bands, basestring):
+        if "," in bands:
+            return [band.strip() for band in bands.split(",") if band.strip()]
+        return list(bands) if bands.isdigit() else [bands]
+    return [str(band) for band in bands]
+
+
+def bands_label(bands):
+    """ Output file label of a band list: 432 for single-digit bands, 8A-11-12 otherwise """
+    if all(len(band) == 1 for band in bands):
+        return "".join(bands)
+    return "-".join(bands)
+
+
+def bounded_imap(pool, function, items, limit):
+    """ pool.imap that keeps at most limit tasks queued or finished but not yet consumed.
+    pool.imap queues every item at once, so results pile up in memory when the consumer is slower.
+    :returns:
+        (Generator) the results in the order of items
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= limit:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+_started = None  # queue on which a pool worker announces the task it starts
+
+
+def _announce_tasks(started):
+    global _started
+    _started = started
+
+
+def _announced(identifier, function, args):
+    _started.put((identifier, os.getpid()))
+    return function(*args)
+
+
+class WorkerWatch(object):
+    'Notices the tasks of pool workers that died, e.g. killed for memory, which the pool never calls back for'
+
+    def __init__(self):
+        self.started = SimpleQueue()  # unbuffered, so a worker that dies right after still gets it out
+        self.active = {}  # id of every task handed to the pool -> pid of the worker running it, once known
+        self.lock = threading.Lock()
+
+    def pool(self, processes):
+        """ A pool whose workers announce the task they start """
+        return Pool(processes, _announce_tasks, (self.started,))
+
+    def apply_async(self, pool, identifier, function, args, callback=None):
+        with self.lock:
+            self.active[identifier] = None
+        return pool.apply_async(_announced, (identifier, function, args), callback=callback)
+
+    def finished(self, identifier):
+        """ Forgets a task that called back. False when it was already reported dead """
+        with self.lock:
+            return self.active.pop(identifier, False) is not False
+
+    def dead(self, pool):
+        """ Forgets and returns the tasks whose worker is gone """
+        while not self.started.empty():
+            identifier, pid = self.started.get()
+            with self.lock:
+                if identifier in self.active:
+                    self.active[identifier] = pid
+        alive = set(process.pid for process in pool._pool if process.is_alive())
+        with self.lock:
+            dead = [identifier for identifier, pid in self.active.items() if pid is not None and pid not in alive]
+            for identifier in dead:
+                del self.active[identifier]
+        return dead